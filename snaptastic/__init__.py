@@ -1,4 +1,5 @@
 import sys
+from types import ModuleType
 
 __author__ = 'Thierry Schellenbach'
 __copyright__ = 'Copyright 2012, Thierry Schellenbach'
@@ -10,21 +11,35 @@ __maintainer__ = 'Thierry Schellenbach'
 __email__ = 'thierryschellenbach@gmail.com'
 __status__ = 'Production'
 
-setup_install = any(
-    'setup.py' in arg for arg in sys.argv) and 'install' in sys.argv
+# the public api, imported on first access so that the cli only loads
+# the settings, logging and snapshotters of the commands it runs
+LAZY_ATTRIBUTES = {
+    'get_ec2_conn': 'snaptastic.utils',
+    'get_cloudwatch_conn': 'snaptastic.utils',
+    'get_snapshotter': 'snaptastic.metaclass',
+    'Snapshotter': 'snaptastic.snapshotter',
+    'EBSVolume': 'snaptastic.ebs_volume',
+}
 
-if not setup_install:
-    from snaptastic.utils import get_ec2_conn, log, sub, get_cloudwatch_conn
-    from snaptastic.metaclass import get_snapshotter
-    from snapshotter import Snapshotter
-    from ebs_volume import EBSVolume
-    from snaptastic import settings
 
-    # setup logging
-    from snaptastic.utils.log import dictConfig
-    dictConfig(settings.LOGGING_CONFIG)
+class LazyModule(ModuleType):
+    '''
+    The snaptastic package, importing the public api on first access
+    '''
+    def __getattr__(self, name):
+        if name not in LAZY_ATTRIBUTES:
+            raise AttributeError(name)
+        module = __import__(LAZY_ATTRIBUTES[name], None, None, [name])
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
 
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(LAZY_ATTRIBUTES))
 
-if not setup_install:
-    # register the examples
-    from examples import *
+
+# keep a reference to the original module, python 2 clears the globals
+# of garbage collected modules
+original_module = sys.modules[__name__]
+lazy_module = sys.modules[__name__] = LazyModule(__name__, __doc__)
+lazy_module.__dict__.update(original_module.__dict__)
@@ -0,0 +1,264 @@
+import fnmatch
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from snaptastic.utils import ensure_dir, get_start_time_filter
+from snaptastic.utils import iter_snapshots
+
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogSnapshot(object):
+    '''
+    Snapshot as stored in the catalog, has the attributes of a boto
+    snapshot which snaptastic uses
+    '''
+    FIELDS = ['id', 'volume_id', 'volume_size', 'status', 'start_time',
+              'description', 'owner_id']
+
+    def __init__(self, tags=None, **kwargs):
+        for field in self.FIELDS:
+            setattr(self, field, kwargs.get(field))
+        self.tags = tags or {}
+
+    @classmethod
+    def from_boto(cls, snapshot):
+        kwargs = dict((f, getattr(snapshot, f, None)) for f in cls.FIELDS)
+        return cls(tags=dict(snapshot.tags), **kwargs)
+
+    def __repr__(self):
+        return 'Snapshot:%s' % self.id
+
+
+class SnapshotCatalog(object):
+    '''
+    On disk (sqlite) catalog of snapshots, so repeated runs don't have to
+    list all snapshots from EC2 again
+
+    Snapshots are stored per scope, the filters (and owner) used to list
+    them. The start-time filter isn't part of the scope, as the lookup
+    window moves every day, it is applied when reading. Within the ttl a
+    scope is served from disk without any API call. After that it is
+    refreshed incrementally: only snapshots started since the last seen
+    start_time and the ones which are still pending are fetched. Once
+    every full_refresh seconds the scope is listed again completely, to
+    drop snapshots deleted by others.
+    '''
+    # fall back to a full listing if we are this many days behind
+    MAX_INCREMENTAL_DAYS = 31
+    # snapshots read from disk at a time by iter_snapshots
+    READ_BATCH_SIZE = 1000
+
+    def __init__(self, connection, path, ttl=60, full_refresh=24 * 3600):
+        self.con = connection
+        self.path = path
+        self.ttl = ttl
+        self.full_refresh = full_refresh
+        self.lock = threading.Lock()
+        self.ensure_schema()
+
+    def connect(self):
+        # a connection per operation, sqlite connections can't be shared
+        # between the threads of concurrent mounts
+        return sqlite3.connect(self.path, timeout=30)
+
+    def ensure_schema(self):
+        ensure_dir(self.path)
+        db = self.connect()
+        try:
+            db.execute('''CREATE TABLE IF NOT EXISTS snapshots (
+                scope TEXT, id TEXT, volume_id TEXT, volume_size INTEGER,
+                status TEXT, start_time TEXT, description TEXT,
+                owner_id TEXT, tags TEXT, PRIMARY KEY (scope, id))''')
+            db.execute('''CREATE TABLE IF NOT EXISTS scopes (
+                scope TEXT PRIMARY KEY, refreshed_at REAL,
+                full_refreshed_at REAL)''')
+            db.commit()
+        finally:
+            db.close()
+
+    def get_scope(self, filters, owner=None):
+        filters = dict(filters)
+        filters.pop('start-time', None)
+        return json.dumps(dict(filters=filters, owner=owner), sort_keys=True)
+
+    def get_snapshots(self, filters, owner=None):
+        '''
+        Returns the snapshots matching the EC2 filters (and owner)
+        '''
+        return list(self.iter_snapshots(filters, owner))
+
+    def iter_snapshots(self, filters, owner=None):
+        '''
+        Like get_snapshots, but yields the snapshots as they are read from
+        disk in batches, so large scopes aren't held in memory
+        '''
+        scope = self.get_scope(filters, owner)
+        with self.lock:
+            db = self.connect()
+            try:
+                self.refresh(db, scope, filters, owner)
+            finally:
+                db.close()
+        start_times = filters.get('start-time')
+        if isinstance(start_times, basestring):
+            start_times = [start_times]
+        for snapshot in self.read_snapshots(scope):
+            if start_times and not any(
+                    fnmatch.fnmatchcase(snapshot.start_time or '', pattern)
+                    for pattern in start_times):
+                continue
+            yield snapshot
+
+    def purge(self, db, scope, now):
+        '''
+        Removes the other scopes nobody asked for since the last full
+        refresh, eg. the ones of filters which are no longer used
+        '''
+        stale = [row[0] for row in db.execute(
+            'SELECT scope FROM scopes WHERE refreshed_at < ? AND scope != ?',
+            (now - self.full_refresh, scope))]
+        if stale:
+            logger.info('removing %s stale scopes from the catalog',
+                        len(stale))
+        for scope in stale:
+            db.execute('DELETE FROM snapshots WHERE scope = ?', (scope,))
+            db.execute('DELETE FROM scopes WHERE scope = ?', (scope,))
+
+    def refresh(self, db, scope, filters, owner):
+        now = time.time()
+        row = db.execute(
+            'SELECT refreshed_at, full_refreshed_at FROM scopes '
+            'WHERE scope = ?', (scope,)).fetchone()
+        if row and row[0] and now - row[0] < self.ttl:
+            logger.info('using the snapshot catalog at %s', self.path)
+            return
+        if row and row[1] and now - row[1] < self.full_refresh:
+            try:
+                self.refresh_incremental(db, scope, filters, owner)
+                db.execute('UPDATE scopes SET refreshed_at = ? '
+                           'WHERE scope = ?', (now, scope))
+                db.commit()
+                return
+            except Exception, e:
+                logger.warn('incremental catalog refresh failed: %s', e)
+                db.rollback()
+        self.refresh_full(db, scope, filters, owner)
+        self.purge(db, scope, now)
+        db.execute('INSERT OR REPLACE INTO scopes VALUES (?, ?, ?)',
+                   (scope, now, now))
+        db.commit()
+
+    def refresh_full(self, db, scope, filters, owner):
+        logger.info('listing all snapshots for the catalog')
+        snapshots = self.fetch(filters, owner)
+        db.execute('DELETE FROM snapshots WHERE scope = ?', (scope,))
+        self.store(db, scope, snapshots)
+
+    def refresh_incremental(self, db, scope, filters, owner):
+        last_start_time, = db.execute(
+            'SELECT MAX(start_time) FROM snapshots WHERE scope = ?',
+            (scope,)).fetchone()
+        if last_start_time:
+            # the days since the last snapshot we have seen
+            first_day = datetime.strptime(
+                last_start_time[:10], '%Y-%m-%d').date()
+            today = datetime.utcnow().date()
+            days = (today - first_day).days
+            if days > self.MAX_INCREMENTAL_DAYS:
+                raise ValueError('catalog is %s days behind' % days)
+            new_filters = dict(filters)
+            new_filters['start-time'] = get_start_time_filter(
+                first_day, today)
+            self.store(db, scope, self.fetch(new_filters, owner))
+
+        pending_ids = [row[0] for row in db.execute(
+            'SELECT id FROM snapshots WHERE scope = ? AND status != ?',
+            (scope, 'completed'))]
+        if pending_ids:
+            self.store(db, scope, self.con.get_all_snapshots(
+                snapshot_ids=pending_ids))
+
+    def fetch(self, filters, owner):
+        return iter_snapshots(self.con, filters=filters, owner=owner)
+
+    def store(self, db, scope, snapshots):
+        def rows():
+            # streamed, so pages are written as they come in
+            for snapshot in snapshots:
+                snapshot = CatalogSnapshot.from_boto(snapshot)
+                values = [getattr(snapshot, f) for f in CatalogSnapshot.FIELDS]
+                yield [scope] + values + [json.dumps(snapshot.tags)]
+        db.executemany('INSERT OR REPLACE INTO snapshots '
+                       '(scope, id, volume_id, volume_size, status, '
+                       'start_time, description, owner_id, tags) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows())
+
+    def read_snapshots(self, scope):
+        '''
+        Yields the snapshots of the scope, READ_BATCH_SIZE rows per query
+        '''
+        query = 'SELECT %s, tags FROM snapshots WHERE scope = ? AND id > ? ' \
+            'ORDER BY id LIMIT ?' % ', '.join(CatalogSnapshot.FIELDS)
+        last_id = ''
+        while True:
+            # the lock isn't held while the caller handles the batch, so
+            # eg. forget can be called while iterating
+            with self.lock:
+                db = self.connect()
+                try:
+                    params = (scope, last_id, self.READ_BATCH_SIZE)
+                    rows = db.execute(query, params).fetchall()
+                finally:
+                    db.close()
+            for row in rows:
+                kwargs = dict(zip(CatalogSnapshot.FIELDS, row))
+                yield CatalogSnapshot(tags=json.loads(row[-1]), **kwargs)
+            if len(rows) < self.READ_BATCH_SIZE:
+                return
+            last_id = rows[-1][0]
+
+    def forget(self, snapshot_ids):
+        '''
+        Removes deleted snapshots from the catalog
+        '''
+        with self.lock:
+            db = self.connect()
+            try:
+                db.executemany('DELETE FROM snapshots WHERE id = ?',
+                               [(i,) for i in snapshot_ids])
+                db.commit()
+            finally:
+                db.close()
+
+    def expire(self):
+        '''
+        Forces a full refresh on the next lookup
+        '''
+        with self.lock:
+            db = self.connect()
+            try:
+                db.execute('DELETE FROM scopes')
+                db.commit()
+            finally:
+                db.close()
+
+
+def get_snapshot_catalog(connection):
+    '''
+    Returns the catalog configured in the settings or None if the
+    SNAPSHOT_CATALOG_PATH setting is empty
+    '''
+    from snaptastic import settings
+    path = getattr(settings, 'SNAPSHOT_CATALOG_PATH', None)
+    if not path:
+        return None
+    return SnapshotCatalog(
+        connection, path, ttl=settings.SNAPSHOT_CATALOG_TTL,
+        full_refresh=settings.SNAPSHOT_CATALOG_FULL_REFRESH)
@@ -1,12 +1,31 @@
 import datetime
 import collections
 import logging
-from snaptastic import get_ec2_conn, get_cloudwatch_conn
+import os
+import re
+from snaptastic.utils import get_ec2_conn, get_cloudwatch_conn
+from snaptastic.catalog import get_snapshot_catalog
+from snaptastic.deleter import BulkDeleter, DeletionJournal
+from snaptastic.inventory import Inventory
+from snaptastic.metrics import get_metric_data
+from snaptastic.retention import RetainedSnapshot, RetentionPolicy
+from snaptastic.utils.concurrency import map_concurrently
 logger = logging.getLogger(__name__)
 
 
 class Cleaner(object):
-    def __init__(self, userdata=None, metadata=None, connection=None, bdm=None):
+    # the number of resources to delete at the same time
+    DELETE_CONCURRENCY = 8
+    # instances averaging less than this cpu percentage over the window
+    # are reported by cleanup_instances
+    LOW_UTILIZATION_THRESHOLD = 5
+    UTILIZATION_WINDOW = 24 * 3600
+    # instances per GetMetricData request and concurrent requests
+    METRIC_BATCH_SIZE = 500
+    METRIC_CONCURRENCY = 4
+
+    def __init__(self, userdata=None, metadata=None, connection=None, bdm=None,
+                 catalog=None):
         '''
         Goes through the steps needed to mount the specified volume
         - checks if we have a snapshot
@@ -20,82 +39,92 @@ class Cleaner(object):
         :type metadata: dict
         :param connection: boto connection object
         :param bdm: dictionary describing the device mapping
+        :param catalog: SnapshotCatalog to read snapshots from, defaults to
+            the one configured in the settings, False disables it
 
         '''
         # self.userdata = get_userdata_dict() if userdata is None else userdata
         # self.metadata = get_instance_metadata(
         # ) if metadata is None else metadata
         self.con = get_ec2_conn() if connection is None else connection
+        self.catalog = get_snapshot_catalog(
+            self.con) if catalog is None else catalog
+        self.inventory = self.get_inventory()
+
+    def get_inventory(self):
+        '''
+        The listings of the account shared by all steps of a cleanup
+        '''
+        return Inventory(self.con, self.get_owners(), catalog=self.catalog)
 
     def get_running_amis(self):
-        reservations = self.con.get_all_instances()
         running_amis = collections.defaultdict(list)
-        for reservation in reservations:
-            for instance in reservation.instances:
-                if instance.state == 'running':
-                    running_amis[instance.image_id].append(instance)
+        for instance in self.get_running_instances():
+            running_amis[instance.image_id].append(instance)
         return running_amis
 
     def get_running_instances(self):
         running_instances = []
-        reservations = self.con.get_all_instances()
-        for reservation in reservations:
-            for instance in reservation.instances:
-                if instance.state == 'running':
-                    running_instances.append(instance)
+        for instance in self.inventory.instances:
+            if instance.state == 'running':
+                running_instances.append(instance)
         return running_instances
 
     def cleanup_instances(self):
         instances = self.get_running_instances()
         running_instances = len(instances)
         logger.info('running %s instances', running_instances)
-        c = get_cloudwatch_conn()
-
-        low_utilized_instances = []
-
-        class InstanceDimension(dict):
-            def __init__(self, name, value):
-                self[name] = value
-
-        for instance in instances:
-            from boto.exception import BotoServerError
-            try:
-                end = datetime.datetime.now()
-                start = end - datetime.timedelta(days=1)
-                stats = c.get_metric_statistics(
-                    60 * 60 * 24,
-                    start,
-                    end,
-                    'CPUUtilization',
-                    'AWS/EC2',
-                    'Average',
-                    InstanceDimension("InstanceId", instance.id)
-                )
-                for stat in stats[-1:]:
-                    average = stat['Average']
-                    if average < 5:
-                        instance.cpu_utilization = average
-                        low_utilized_instances.append(instance)
-
-            except BotoServerError, e:
-                print e
+        low_utilized_instances = self.get_low_utilized_instances(instances)
 
         logger.info('found %s instances with low cpu utilization',
                     len(low_utilized_instances))
         from pprint import pformat
-        for instance in low_utilized_instances:
+        outcomes = map_concurrently(
+            lambda instance: instance.get_attribute('userData'),
+            low_utilized_instances, self.METRIC_CONCURRENCY)
+        for instance, (userdata, error) in zip(low_utilized_instances,
+                                               outcomes):
             logger.info('===' * 10)
             logger.info(instance)
-            logger.info(pformat(instance.get_attribute('userData')))
+            logger.info(pformat(error if error is not None else userdata))
             logger.info(pformat(instance.tags))
 
+    def get_low_utilized_instances(self, instances):
+        '''
+        The instances whose average cpu utilization over the last
+        UTILIZATION_WINDOW seconds is below LOW_UTILIZATION_THRESHOLD
+        '''
+        from boto.exception import BotoServerError
+        end = datetime.datetime.utcnow()
+        start = end - datetime.timedelta(seconds=self.UTILIZATION_WINDOW)
+        try:
+            utilization = get_metric_data(
+                get_cloudwatch_conn(), 'AWS/EC2', 'CPUUtilization',
+                'InstanceId', [i.id for i in instances], start, end,
+                period=self.UTILIZATION_WINDOW,
+                batch_size=self.METRIC_BATCH_SIZE,
+                workers=self.METRIC_CONCURRENCY)
+        except BotoServerError, e:
+            logger.warn('couldnt get the cpu utilization: %s', e)
+            return []
+        low_utilized_instances = []
+        for instance in instances:
+            # newest first
+            averages = utilization.get(instance.id)
+            if averages and averages[0] < self.LOW_UTILIZATION_THRESHOLD:
+                instance.cpu_utilization = averages[0]
+                low_utilized_instances.append(instance)
+        return low_utilized_instances
+
     def get_owners(self):
         owners = ['612857642705']
         return owners
 
-    def get_our_amis(self):
-        owners = self.get_owners()
-        images = self.con.get_all_images(owners=owners)
+    def get_our_images(self):
+        return self.inventory.images
+
+    def get_our_amis(self, images=None):
+        images = self.get_our_images() if images is None else images
         image_ids = []
         image_dict = collections.defaultdict(list)
         for image in images:
@@ -122,29 +151,105 @@ class Cleaner(object):
             missing_amis_dict[m] = running
         return missing_amis_dict
 
+    def get_journal(self, name):
+        '''
+        The journal of an interrupted cleanup of name, in the directory
+        of the CLEANUP_JOURNAL_DIR setting
+        '''
+        from snaptastic import settings
+        journal_dir = getattr(settings, 'CLEANUP_JOURNAL_DIR', None)
+        if not journal_dir:
+            return None
+        path = os.path.join(journal_dir, 'cleanup-%s.journal' % name)
+        try:
+            return DeletionJournal(path)
+        except (IOError, OSError), e:
+            logger.warn('cleaning up without a journal: %s', e)
+
+    def get_deleter(self, name, delete, **kwargs):
+        return BulkDeleter(name, delete, workers=self.DELETE_CONCURRENCY,
+                           journal=self.get_journal(name), **kwargs)
+
     def delete_amis(self, unused_amis):
-        for ami in unused_amis:
+        def delete(ami):
             logger.info('now removing %s', ami)
             self.con.deregister_image(ami)
+        deleter = self.get_deleter('amis', delete, get_id=lambda ami: ami)
+        try:
+            deleter.run(unused_amis)
+        finally:
+            self.inventory.forget_images(deleter.deleted_ids)
 
     def get_our_snapshots(self):
-        owners = self.get_owners()
-        snapshots = self.con.get_all_snapshots(owner=owners[0])
-        return snapshots
+        return self.inventory.snapshots
+
+    def iter_our_snapshots(self):
+        return self.inventory.iter_snapshots()
 
     def filter_expired_snapshots(self, snapshots):
+        return list(self.iter_expired(snapshots))
+
+    def iter_expired(self, snapshots):
+        '''
+        Yields the expired snapshots
+
+        With a retention policy the snapshots of our mount points are
+        grouped and expired by the policy once all of them are seen, the
+        others are expired right away by their expiry date
+        '''
         now = datetime.datetime.today()
-        expired_snapshots = []
+        policy = self.get_retention_policy()
+        groups = collections.defaultdict(list)
         for snapshot in snapshots:
-            expiry_date = self.get_snapshot_expiry_date(snapshot)
-            if expiry_date < now:
-                expired_snapshots.append(snapshot)
-        return expired_snapshots
+            group = self.get_retention_group(snapshot) if policy else None
+            if group is not None:
+                groups[group].append(RetainedSnapshot(
+                    snapshot.id, snapshot.volume_size, snapshot.status,
+                    self.get_start_time(snapshot)))
+            elif self.get_snapshot_expiry_date(snapshot) < now:
+                yield snapshot
+        if policy is not None:
+            for snapshot in policy.get_expired(groups):
+                yield snapshot
+
+    # snapshots with the same values for these tags form a retention group
+    RETENTION_GROUP_TAGS = ('environment', 'cluster', 'role', 'mount_point')
+
+    def get_retention_policy(self):
+        '''
+        The RetentionPolicy configured by the SNAPSHOT_RETENTION setting,
+        None for a flat expiry
+        '''
+        from snaptastic import settings
+        retention = getattr(settings, 'SNAPSHOT_RETENTION', None)
+        if not retention:
+            return None
+        return RetentionPolicy(**retention)
+
+    def get_retention_group(self, snapshot):
+        '''
+        The group of a snapshot made by snaptastic, None for other
+        snapshots and ones with an explicit expiry or expiry_delta tag
+        '''
+        tags = snapshot.tags
+        if 'mount_point' not in tags:
+            return None
+        if tags.get('expiry') or self.get_expiry_delta(snapshot):
+            return None
+        return tuple(tags.get(tag) for tag in self.RETENTION_GROUP_TAGS)
 
     def delete_snapshots(self, snapshots):
-        for snapshot in snapshots:
+        def delete(snapshot):
             logger.info('removing snapshot %s' % snapshot)
             self.con.delete_snapshot(snapshot.id)
+        deleter = self.get_deleter(
+            'snapshots', delete, get_size=lambda s: s.volume_size)
+        try:
+            deleter.run(snapshots)
+        finally:
+            if self.catalog:
+                self.catalog.forget(deleter.deleted_ids)
+            self.inventory.forget('snapshots', deleter.deleted_ids)
 
     def sum_snapshot_size(self, snapshots):
         volume_sizes = []
@@ -155,42 +260,112 @@ class Cleaner(object):
 
     EXPIRY_FORMAT_STRING = '%Y-%m-%d'
 
+    def get_start_time(self, snapshot):
+        return datetime.datetime.strptime(
+            snapshot.start_time, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def get_expiry_delta(self, snapshot):
+        '''
+        The timedelta of the expiry_delta tag (in days), None if the
+        snapshot has none or it isn't a number
+        '''
+        expiry_delta = snapshot.tags.get('expiry_delta')
+        if not expiry_delta:
+            return None
+        # tag values are strings
+        try:
+            return datetime.timedelta(days=float(expiry_delta))
+        except OverflowError:
+            return datetime.timedelta.max
+        except (TypeError, ValueError):
+            logger.warn('ignoring the expiry_delta %r of snapshot %s',
+                        expiry_delta, snapshot.id)
+            return None
+
     def get_snapshot_expiry_date(self, snapshot):
         tags = snapshot.tags
         expiry_date_string = tags.get('expiry')
-        expiry_delta = tags.get('expiry_delta')
-        start_time = datetime.datetime.strptime(
-            snapshot.start_time, '%Y-%m-%dT%H:%M:%S.%fZ')
+        expiry_delta = self.get_expiry_delta(snapshot)
+        start_time = self.get_start_time(snapshot)
         if expiry_date_string:
             expiry_date = datetime.datetime.strptime(
                 expiry_date_string, self.EXPIRY_FORMAT_STRING)
         elif expiry_delta:
-            expiry_date = start_time + datetime.timedelta(days=expiry_delta)
+            try:
+                expiry_date = start_time + expiry_delta
+            except OverflowError:
+                expiry_date = datetime.datetime.max
         else:
             expiry_date = start_time + datetime.timedelta(days=7)
         return expiry_date
 
+    # CreateImage describes snapshots as "Created by CreateImage(i-...) for
+    # ami-... from vol-..."
+    AMI_ID_PATTERN = re.compile(r'\bami-[0-9a-f]+\b')
+
+    def get_ami_snapshot_ids(self, images):
+        '''
+        The ids of the snapshots backing the images, from their block
+        device mappings
+        '''
+        snapshot_ids = set()
+        for image in images:
+            mapping = image.block_device_mapping or {}
+            for device in mapping.values():
+                if device.snapshot_id:
+                    snapshot_ids.add(device.snapshot_id)
+        return snapshot_ids
+
+    def is_ami_snapshot(self, snapshot, our_amis, ami_snapshot_ids):
+        '''
+        Checks the block device mapping index first, then falls back to the
+        ami ids in the snapshot description
+        '''
+        if snapshot.id in ami_snapshot_ids:
+            return True
+        ami_ids = self.AMI_ID_PATTERN.findall(snapshot.description or '')
+        return any(ami_id in our_amis for ami_id in ami_ids)
+
     def get_expired_snapshots(self):
-        our_amis = self.get_our_amis()
-        snapshots = self.get_our_snapshots()
-        total_size = self.sum_snapshot_size(snapshots)
+        return list(self.iter_expired_snapshots())
+
+    def iter_expired_snapshots(self):
+        '''
+        Yields the expired snapshots which don't belong to our amis
+
+        Snapshots are classified page by page as they are fetched, so only
+        the image index and a page of snapshots are held in memory
+        '''
+        images = self.get_our_images()
+        our_amis = self.get_our_amis(images)
+        ami_snapshot_ids = self.get_ami_snapshot_ids(images)
+        logger.info('found %s amis backed by %s snapshots', len(our_amis),
+                    len(ami_snapshot_ids))
+        counts = collections.defaultdict(int)
+
+        def non_ami_snapshots():
+            for snapshot in self.iter_our_snapshots():
+                counts['total'] += 1
+                counts['size'] += snapshot.volume_size or 0
+                if not self.is_ami_snapshot(
+                        snapshot, our_amis, ami_snapshot_ids):
+                    counts['non_ami'] += 1
+                    yield snapshot
+
+        for snapshot in self.iter_expired(non_ami_snapshots()):
+            counts['expired'] += 1
+            yield snapshot
         logger.info('found %s snapshots in total, with size of %s GB' % (
-            len(snapshots), total_size))
-        logger.info(our_amis)
-        non_ami_snapshots = [s for s in snapshots if not any(
-            [a in s.description for a in our_amis])]
-        logger.info('found %s non ami snapshots' % len(non_ami_snapshots))
-        expired_snapshots = self.filter_expired_snapshots(non_ami_snapshots)
-        logger.info('found %s rotten snapshots from %s snapshots in total' % (
-            len(expired_snapshots), len(non_ami_snapshots)))
-        return expired_snapshots
+            counts['total'], counts['size']))
+        logger.info('found %s rotten snapshots from %s non ami snapshots' % (
+            counts['expired'], counts['non_ami']))
 
     def cleanup_snapshots(self):
-        expired_snapshots = self.get_expired_snapshots()
-        self.delete_snapshots(expired_snapshots)
+        # deletes start while later pages are still being fetched
+        self.delete_snapshots(self.iter_expired_snapshots())
 
     def useless_volumes(self):
-        volumes = self.con.get_all_volumes()
+        volumes = self.inventory.volumes
         available_volumes = []
         for v in volumes:
             if v.status == 'available':
@@ -203,14 +378,26 @@ class Cleaner(object):
 
     def cleanup_images(self):
         unused_amis = self.get_unused_amis()
-        for ami in unused_amis:
+
+        def delete(ami):
             logger.info('removing ami %s' % ami)
             self.con.deregister_image(ami, delete_snapshot=True)
+        deleter = self.get_deleter('images', delete, get_id=lambda ami: ami)
+        try:
+            deleter.run(unused_amis)
+        finally:
+            self.inventory.forget_images(
+                deleter.deleted_ids, with_snapshots=True)
 
     def delete_volumes(self, volumes):
-        for v in volumes:
+        def delete(v):
             logger.info('removing volume v %s' % v.id)
             v.delete()
+        deleter = self.get_deleter('volumes', delete, get_size=lambda v: v.size)
+        try:
+            deleter.run(volumes)
+        finally:
+            self.inventory.forget('volumes', deleter.deleted_ids)
 
     def clean(self, component):
         if component == 'volumes':
@@ -222,6 +409,10 @@ class Cleaner(object):
         elif component == 'instances':
             self.cleanup_instances()
         elif component == 'all':
+            # a fresh inventory for this run, listed concurrently once
+            self.inventory = self.get_inventory()
+            # the snapshots are streamed by cleanup_snapshots
+            self.inventory.load('instances', 'images', 'volumes')
             self.cleanup_images()
             self.cleanup_volumes()
             self.cleanup_snapshots()
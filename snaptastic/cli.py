@@ -8,12 +8,11 @@ parent = os.path.join(path, '../', '../')
 sys.path.append(parent)
 
 from argh import command, ArghParser
-from snaptastic import get_snapshotter
-from snaptastic import settings
 import json
 
 
 def configure_snapshotter(snapshotter_name, userdata=None):
+    from snaptastic.metaclass import get_snapshotter
     snapshotter_class = get_snapshotter(snapshotter_name)
     if userdata:
         userdata = json.loads(userdata)
@@ -25,6 +24,7 @@ def configure_log_level(level):
     '''
     Setup the root log level to the level specified in the string loglevel
     '''
+    from snaptastic import settings
     level_object = getattr(logging, level)
     root_logger = logging.getLogger()
     root_logger.setLevel(level_object)
@@ -40,17 +40,20 @@ def configure_log_level(level):
 
 
 @command
-def make_snapshots(snapshotter_name, userdata=None, loglevel='DEBUG'):
+def make_snapshots(snapshotter_name, userdata=None, loglevel='DEBUG',
+                   consistency_group=False):
     configure_log_level(loglevel)
     snap = configure_snapshotter(snapshotter_name, userdata)
-    snap.make_snapshots()
+    snap.make_snapshots(consistency_group=consistency_group)
 
 
 @command
 def mount_snapshots(snapshotter_name, userdata=None, loglevel='DEBUG',
-                    ignore_mounted=False, dry_run=False):
+                    ignore_mounted=False, dry_run=False, refresh=False):
     configure_log_level(loglevel)
     snap = configure_snapshotter(snapshotter_name, userdata)
+    if refresh and snap.catalog:
+        snap.catalog.expire()
     snap.mount_snapshots(ignore_mounted=ignore_mounted, dry_run=dry_run)
 
 
@@ -73,7 +76,8 @@ def list_volumes(snapshotter_name, userdata=None, loglevel='DEBUG'):
 
 
 @command
-def clean(component, userdata=None, force=False, loglevel='DEBUG'):
+def clean(component, userdata=None, force=False, loglevel='DEBUG',
+          refresh=False):
     configure_log_level(loglevel)
     from snaptastic.cleaner import Cleaner
     run = True
@@ -82,12 +86,15 @@ def clean(component, userdata=None, force=False, loglevel='DEBUG'):
         run = clean in ['y', 'yeay', 'yes']
     if run:
         cleaner = Cleaner()
+        if refresh and cleaner.catalog:
+            cleaner.catalog.expire()
         cleaner.clean(component)
 
 
 @command
 def test(loglevel='DEBUG'):
-    from snaptastic.utils import get_userdata_dict
+    configure_log_level(loglevel)
+    from snaptastic.utils import get_userdata_dict, get_metadata_dict
     logger.info('trying to get userdata, requires boto and valid keys')
     try:
         userdata = get_userdata_dict()
@@ -95,34 +102,80 @@ def test(loglevel='DEBUG'):
     except Exception, e:
         logger.exception('Userdata lookup doesnt work, error %s', e)
     logger.info('next up instance metadata')
-    from boto.utils import get_instance_metadata
     try:
-        metadata = get_instance_metadata()
+        metadata = get_metadata_dict()
         logger.info('found instance metadata %s', metadata)
     except Exception, e:
         logger.exception('Metadata lookup doesnt work, error %s', e)
 
 
 @command
-def check_backups(age, environment, cluster, role, loglevel='DEBUG'):
+def check_backups(age, environment, cluster, role, loglevel='DEBUG',
+                  refresh=False):
+    configure_log_level(loglevel)
     from snaptastic.utils import check_backups
     from snaptastic.utils import age_to_seconds
+    from snaptastic.catalog import get_snapshot_catalog
+    from snaptastic.utils import get_ec2_conn
     max_age = age_to_seconds(age)
+    catalog = get_snapshot_catalog(get_ec2_conn())
+    if refresh and catalog:
+        catalog.expire()
     missing = check_backups(
-        max_age, environment=environment, cluster=cluster, role=role)
+        max_age, environment=environment, cluster=cluster, role=role,
+        catalog=catalog or False)
     sys.exit(missing > 0 and 1 or 0)
 
 
+@command
+def check_all_backups(age, targets_file, loglevel='DEBUG', refresh=False):
+    '''
+    Checks the backups of every "environment cluster role" line in
+    targets_file (- reads stdin) and prints a verdict per target
+    '''
+    configure_log_level(loglevel)
+    from snaptastic.utils import check_many_backups, read_backup_targets
+    from snaptastic.utils import age_to_seconds
+    from snaptastic.catalog import get_snapshot_catalog
+    from snaptastic.utils import get_ec2_conn
+    max_age = age_to_seconds(age)
+    if targets_file == '-':
+        targets = read_backup_targets(sys.stdin)
+    else:
+        with open(targets_file) as lines:
+            targets = read_backup_targets(lines)
+    catalog = get_snapshot_catalog(get_ec2_conn())
+    if refresh and catalog:
+        catalog.expire()
+    results = check_many_backups(max_age, targets, catalog=catalog or False)
+    row_format = '%-20s %-20s %-20s %-8s %s'
+    print row_format % ('environment', 'cluster', 'role', 'status',
+                        'missing')
+    for target in sorted(results):
+        missing = results[target]
+        status = 'MISSING' if missing else 'OK'
+        print row_format % (target + (status, ', '.join(
+            '%s (%s)' % (mp, ', '.join(ids))
+            for mp, ids in sorted(missing.items()))))
+    sys.exit(any(results.values()) and 1 or 0)
+
+
 def main():
     from snaptastic import __version__
     if '--version' in sys.argv:
         print 'Snaptastic version %s' % __version__
+        return
 
     p = ArghParser()
     commands = [make_snapshots, mount_snapshots, check_backups,
+                check_all_backups,
                 list_volumes, unmount_snapshots, clean, test]
     p.add_commands(commands)
-    p.dispatch()
+    try:
+        p.dispatch()
+    finally:
+        from snaptastic.utils import log_connection_stats
+        log_connection_stats()
 
 
 if __name__ == '__main__':
@@ -47,3 +47,34 @@ from snaptastic.utils import sub
 
 # setup the file logging if available
 LOGGING_CONFIG = setup_file_logging(BASE_LOGGING_CONFIG)
+
+# on disk catalog of snapshots, eg. '/var/lib/snaptastic/catalog.db'
+# leave empty to list the snapshots from EC2 on every run
+SNAPSHOT_CATALOG_PATH = None
+# seconds the catalog is used without asking EC2 for new snapshots
+SNAPSHOT_CATALOG_TTL = 60
+# seconds between full listings, which drop snapshots deleted by others
+SNAPSHOT_CATALOG_FULL_REFRESH = 24 * 3600
+
+# client side rate limiting and retries of throttled EC2 calls
+EC2_THROTTLING = True
+# overrides of the rates per api class, eg. {'mutate': (2, 20)}
+# as (requests per second, burst), see snaptastic.throttle.Throttler
+EC2_RATE_LIMITS = None
+
+# the instance metadata and userdata are cached here once per boot,
+# leave empty to read them from the metadata service on every run
+INSTANCE_CACHE_DIR = '/var/cache/snaptastic'
+
+# journal of the deletions of a cleanup, so an interrupted clean resumes
+# where it stopped, leave empty to disable
+CLEANUP_JOURNAL_DIR = '/var/lib/snaptastic'
+
+# the freeze timings of the last 1000 freezes, one JSON line per freeze,
+# so the freeze percentiles cover earlier runs. every snapshotter keeps
+# its own file, eg. freeze-stats-redis.jsonl. leave empty to disable
+FREEZE_STATS_PATH = '/var/lib/snaptastic/freeze-stats.jsonl'
+
+# grandfather-father-son retention of our snapshots, instead of expiring
+# them after a week, eg. dict(hourly=24, daily=7, weekly=4, monthly=12)
+SNAPSHOT_RETENTION = None
@@ -0,0 +1,148 @@
+import logging
+import os
+import threading
+import time
+
+from snaptastic import exceptions
+from snaptastic.utils import ensure_dir
+from snaptastic.utils.concurrency import imap_concurrently
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeletionJournal(object):
+    '''
+    Append only file with the ids of the deleted resources
+
+    An interrupted cleanup skips everything in the journal when it is
+    restarted. The journal is removed once a cleanup completes.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.deleted = set()
+        if os.path.isfile(path):
+            with open(path) as journal_file:
+                self.deleted = set(line.strip() for line in journal_file)
+            self.deleted.discard('')
+            logger.info('resuming from %s, %s resources already deleted',
+                        path, len(self.deleted))
+        ensure_dir(path)
+        self.journal_file = open(path, 'a')
+
+    def __contains__(self, resource_id):
+        return resource_id in self.deleted
+
+    def record(self, resource_id):
+        with self.lock:
+            self.deleted.add(resource_id)
+            self.journal_file.write('%s\n' % resource_id)
+            self.journal_file.flush()
+
+    def complete(self):
+        with self.lock:
+            self.journal_file.close()
+            os.remove(self.path)
+
+
+class BulkDeleter(object):
+    '''
+    Deletes resources with bounded concurrency, logging the progress
+
+    Pacing comes from the connection: with EC2_THROTTLING enabled every
+    delete takes a token of the mutate bucket and throttled deletes are
+    retried, so more workers never means more RequestLimitExceeded errors.
+    Resources which are already gone count as deleted.
+
+    :param name: what is deleted, eg. 'snapshots'
+    :param delete: function deleting a single item
+    :param get_id: function returning the resource id of an item
+    :param get_size: function returning the GB reclaimed by an item
+    :param journal: DeletionJournal to record and skip deletions
+    '''
+    NOT_FOUND_ERRORS = ('InvalidSnapshot.NotFound', 'InvalidVolume.NotFound',
+                        'InvalidAMIID.NotFound', 'InvalidAMIID.Unavailable')
+    # seconds between progress reports
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, name, delete, get_id=None, get_size=None, workers=8,
+                 journal=None):
+        self.name = name
+        self.delete = delete
+        self.get_id = get_id or (lambda item: item.id)
+        self.get_size = get_size or (lambda item: 0)
+        self.workers = workers
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.deleted_ids = []
+
+    def run(self, items):
+        '''
+        Deletes the items, returning the ids of the deleted ones
+
+        items can be a generator, it is consumed while the deletes run and
+        only the ids of the deleted items are kept. Raises PartialFailure
+        if some of the deletes failed, the journal is kept in that case so
+        the next run retries just those
+        '''
+        self.deleted = 0
+        self.deleted_ids = []
+        self.reclaimed = 0
+        self.skipped = 0
+        self.started = self.reported = time.time()
+        total = 0
+        errors = []
+        outcomes = imap_concurrently(
+            self.delete_item, self.skip_journaled(items), self.workers)
+        for item, (result, error) in outcomes:
+            total += 1
+            if error is not None:
+                errors.append((item, error))
+        if self.skipped:
+            logger.info('skipped %s %s deleted by an earlier run',
+                        self.skipped, self.name)
+        self.report(total, force=True)
+        if errors:
+            error_format = 'failed to delete %s out of %s %s'
+            raise exceptions.PartialFailure(
+                error_format % (len(errors), total, self.name),
+                results=self.deleted_ids, errors=errors)
+        if self.journal is not None:
+            self.journal.complete()
+        return self.deleted_ids
+
+    def skip_journaled(self, items):
+        for item in items:
+            if self.journal is not None and self.get_id(item) in self.journal:
+                self.skipped += 1
+                continue
+            yield item
+
+    def delete_item(self, item):
+        resource_id = self.get_id(item)
+        try:
+            self.delete(item)
+        except Exception, e:
+            if getattr(e, 'error_code', None) not in self.NOT_FOUND_ERRORS:
+                raise
+            logger.info('%s was already deleted', resource_id)
+        if self.journal is not None:
+            self.journal.record(resource_id)
+        with self.lock:
+            self.deleted += 1
+            self.deleted_ids.append(resource_id)
+            self.reclaimed += self.get_size(item) or 0
+        self.report()
+
+    def report(self, total=None, force=False):
+        with self.lock:
+            now = time.time()
+            if not force and now - self.reported < self.PROGRESS_INTERVAL:
+                return
+            self.reported = now
+            deleted, reclaimed = self.deleted, self.reclaimed
+        rate = deleted / max(now - self.started, 0.001)
+        logger.info('deleted %s %s%s (%.1f per second), reclaimed %s GB',
+                    deleted, self.name, ' of %s' % total if total else '',
+                    rate, reclaimed)
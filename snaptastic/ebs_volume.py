@@ -46,7 +46,8 @@ class EBSVolume(object):
 
     def __init__(self, device, mount_point, size=5, delete_on_termination=True,
                  file_system=FILESYSTEMS.XFS, mount_options="defaults",
-                 check_support=True, iops=False, device_name_offset=0):
+                 check_support=True, iops=False, device_name_offset=0,
+                 flush_passes=0):
         self.device = device
         self.size = size
         self.mount_point = mount_point
@@ -56,6 +57,8 @@ class EBSVolume(object):
         self.iops = iops
         # Support for CentOS
         self.device_name_offset = device_name_offset
+        # sync the filesystem up to this many times before freezing it
+        self.flush_passes = flush_passes
         if check_support:
             self.ensure_filesytem_supported()
 
@@ -127,8 +130,18 @@ class EBSVolume(object):
             logger.error(msg)
             raise exceptions.MountException(msg)
 
-    def freeze(self):
-        return freeze(self.mount_point, self.file_system.freeze_cmd)
+    def freeze(self, stats=None):
+        return freeze(self.mount_point, self.file_system.freeze_cmd,
+                      filesystem=self.file_system.name, stats=stats,
+                      flush_passes=self.flush_passes)
+
+    def hydrate(self, **kwargs):
+        '''
+        Reads the whole device, so a volume restored from a snapshot
+        doesn't load its blocks lazily when the application needs them
+        '''
+        from snaptastic.hydrate import Hydrator
+        return Hydrator(self.instance_device, **kwargs).run()
 
     def unmount(self):
         try:
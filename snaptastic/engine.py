@@ -0,0 +1,125 @@
+import logging
+import threading
+import Queue
+
+from snaptastic import exceptions
+from snaptastic.waiter import SnapshotWaiter, VolumeWaiter
+
+
+logger = logging.getLogger(__name__)
+
+
+class Operation(object):
+    '''
+    Handle for an operation running on the engine
+    '''
+    def __init__(self, description):
+        self.description = description
+        self.finished = threading.Event()
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return 'Operation %s' % self.description
+
+    def done(self):
+        return self.finished.isSet()
+
+    def wait(self, timeout=None):
+        '''
+        Blocks till the operation is done, returns its result or raises
+        its exception
+        '''
+        self.finished.wait(timeout)
+        if not self.done():
+            error_format = '%s didnt finish within %s seconds'
+            raise exceptions.WaitTimeout(error_format % (self, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Engine(object):
+    '''
+    Runs make_snapshots, mount_snapshots and unmount_snapshots of several
+    snapshotters at the same time, from a single process
+
+    Snapshotters on the same connection share their volume and snapshot
+    waiters, so all of their polling is batched into one describe call
+    per tick. The synchronous Snapshotter API is unchanged, the engine
+    simply calls it in the background:
+
+        engine = Engine()
+        operations = [engine.make_snapshots(s) for s in snapshotters]
+        engine.wait_all(operations)
+    '''
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        # id of the connection -> (volume waiter, snapshot waiter)
+        self.waiters = {}
+
+    def attach(self, snapshotter):
+        '''
+        Shares the waiters of snapshotters using the same connection
+        '''
+        con = snapshotter.con
+        with self.lock:
+            if id(con) not in self.waiters:
+                self.waiters[id(con)] = (
+                    VolumeWaiter(con), SnapshotWaiter(con))
+            volume_waiter, snapshot_waiter = self.waiters[id(con)]
+        snapshotter.volume_waiter = volume_waiter
+        snapshotter.snapshot_waiter = snapshot_waiter
+
+    def submit(self, function, *args, **kwargs):
+        description = getattr(function, '__name__', repr(function))
+        operation = Operation(description)
+        self.queue.put((operation, function, args, kwargs))
+        with self.lock:
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        return operation
+
+    def work(self):
+        while True:
+            operation, function, args, kwargs = self.queue.get()
+            try:
+                operation.result = function(*args, **kwargs)
+            except Exception, e:
+                logger.exception('%s failed', operation)
+                operation.error = e
+            finally:
+                operation.finished.set()
+
+    def make_snapshots(self, snapshotter, *args, **kwargs):
+        self.attach(snapshotter)
+        return self.submit(snapshotter.make_snapshots, *args, **kwargs)
+
+    def mount_snapshots(self, snapshotter, *args, **kwargs):
+        self.attach(snapshotter)
+        return self.submit(snapshotter.mount_snapshots, *args, **kwargs)
+
+    def unmount_snapshots(self, snapshotter, *args, **kwargs):
+        self.attach(snapshotter)
+        return self.submit(snapshotter.unmount_snapshots, *args, **kwargs)
+
+    def wait_all(self, operations, timeout=None):
+        '''
+        Waits for all operations and returns their (result, exception)
+        tuples, in the order of operations
+        '''
+        outcomes = []
+        for operation in operations:
+            try:
+                outcomes.append((operation.wait(timeout), None))
+            except exceptions.WaitTimeout:
+                raise
+            except Exception, e:
+                outcomes.append((None, e))
+        return outcomes
@@ -1,4 +1,5 @@
-from snaptastic import Snapshotter, EBSVolume
+from snaptastic.snapshotter import Snapshotter
+from snaptastic.ebs_volume import EBSVolume
 
 
 class TestSnapshotter(Snapshotter):
@@ -49,3 +49,28 @@ class DetachmentException(SnaptasticException):
 
 class DeviceAlreadyExists(SnaptasticException):
     pass
+
+
+class PartialFailure(SnaptasticException):
+    '''
+    Some of the volumes in a batch failed, the others were processed
+
+    results holds the outcome per volume (None for failures) and errors
+    is a list of (volume, exception) tuples
+    '''
+    def __init__(self, message, results=None, errors=None):
+        SnaptasticException.__init__(self, message)
+        self.results = results or []
+        self.errors = errors or []
+
+
+class DependencyFailure(SnaptasticException):
+    pass
+
+
+class WaitTimeout(SnaptasticException):
+    pass
+
+
+class HydrationException(SnaptasticException):
+    pass
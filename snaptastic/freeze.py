@@ -1,5 +1,12 @@
 import subprocess
+import json
 import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
@@ -11,27 +18,255 @@ class FreezeException(Exception):
 class Freeze(object):
     '''
     Context manager to freeze a given mount point
+
+    Measures how long the filesystem stalls writes, split in the freeze
+    command, the time spent frozen (creating the snapshot) and the thaw
+    command. The timings are logged and recorded in stats if given.
+
+    With flush_passes the filesystem is flushed before freezing it, so the
+    kernel only has a small delta left to write while writes are blocked.
+    The flush is part of prepare, which __enter__ runs unless it was
+    called already.
     '''
-    def __init__(self, mount_point, freeze_command="fsfreeze"):
+    def __init__(self, mount_point, freeze_command="fsfreeze",
+                 filesystem=None, stats=None, flush_passes=0):
         self.mount_point = mount_point
         self.freeze_command = freeze_command
+        self.filesystem = filesystem
+        self.stats = stats
+        self.flush_passes = flush_passes
+        self.timings = {}
+        self.flushed = {}
+        self.prepared = False
 
-    def __enter__(self):
+    def prepare(self):
+        '''
+        Checks the mount point can be frozen and flushes it
+        '''
         from snaptastic.utils import is_root_dev
+        if self.prepared:
+            return
         # Freezing the root filesystem will cause the instance to become
         # permanently unresponsive, so let's make sure we don't do that
         root_dev = is_root_dev(self.mount_point)
         if root_dev:
             error_format = 'Refusing to freeze device, as its part of root "/" %s'
             raise FreezeException(error_format % self.mount_point)
+        if self.flush_passes:
+            self.flush()
+        self.prepared = True
+
+    def __enter__(self):
+        self.prepare()
         logger.info('Freezing %s', self.mount_point)
+        self.started = time.time()
         subprocess.check_output(
             [self.freeze_command, '-f', self.mount_point], stderr=subprocess.STDOUT)
+        self.frozen = time.time()
+        self.timings = dict(freeze=self.frozen - self.started)
+        if self.flush_passes:
+            from snaptastic.utils import get_dirty_bytes
+            self.flushed['under_freeze'] = max(
+                self.dirty - get_dirty_bytes(), 0)
+
+    def flush(self):
+        '''
+        Syncs the filesystem, repeating up to flush_passes times as long as
+        the amount of dirty pages keeps dropping
+        '''
+        from snaptastic.utils import syncfs, get_dirty_bytes
+        dirty_start = dirty = get_dirty_bytes()
+        for flush_pass in range(self.flush_passes):
+            logger.info('Flushing %s before freezing, pass %s',
+                        self.mount_point, flush_pass + 1)
+            syncfs(self.mount_point)
+            flushed_dirty = get_dirty_bytes()
+            dropped = flushed_dirty < dirty
+            dirty = flushed_dirty
+            if not dropped:
+                break
+        self.dirty = dirty
+        self.flushed['pre_freeze'] = max(dirty_start - dirty, 0)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         logger.info('Thawing %s', self.mount_point)
-        subprocess.check_output([self.freeze_command, '-u', self.mount_point],
-                                stderr=subprocess.STDOUT)
+        self.prepared = False
+        thawing = time.time()
+        self.timings['snapshot'] = thawing - self.frozen
+        try:
+            subprocess.check_output([self.freeze_command, '-u', self.mount_point],
+                                    stderr=subprocess.STDOUT)
+        finally:
+            self.timings['thaw'] = time.time() - thawing
+            self.timings['total'] = time.time() - self.started
+            self.record()
+
+    def record(self):
+        timings = self.timings
+        log_format = '%s (%s) was frozen for %.3fs: ' \
+            'freeze %.3fs, snapshot %.3fs, thaw %.3fs'
+        logger.info(log_format, self.mount_point, self.filesystem,
+                    timings['total'], timings['freeze'], timings['snapshot'],
+                    timings['thaw'])
+        if self.flushed:
+            logger.info('%s flushed %s bytes before and %s bytes under freeze',
+                        self.mount_point, self.flushed['pre_freeze'],
+                        self.flushed.get('under_freeze', 0))
+        if self.stats is not None:
+            self.stats.record(self.mount_point, self.filesystem, timings,
+                              self.flushed)
+
+
+class FreezeStats(object):
+    '''
+    Rolling window of freeze timings, to keep an eye on the percentiles
+    of the time writes are stalled
+
+    Every recorded freeze has a freeze, snapshot, thaw and total segment,
+    labeled with its mount point and filesystem
+
+    make-snapshots runs a process per run, so with path the window is kept
+    in a file with a JSON line per freeze. The percentiles then cover the
+    earlier runs as well, and other tools can aggregate the samples.
+    '''
+    SEGMENTS = ['freeze', 'snapshot', 'thaw', 'total']
+
+    def __init__(self, window=1000, path=None):
+        self.window = window
+        self.path = path
+        self.freezes = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.loaded = path is None
+        # the number of lines in the file, compacted to the window when
+        # it holds twice as many
+        self.lines = 0
+
+    def load(self):
+        # called with the lock held
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as stats_file:
+                for line in stats_file:
+                    self.lines += 1
+                    try:
+                        self.freezes.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except IOError, e:
+            logger.warn('ignoring the freeze stats %s: %s', self.path, e)
+
+    def save(self, freeze):
+        # called with the lock held
+        from snaptastic.utils import ensure_dir
+        try:
+            ensure_dir(self.path)
+            if self.lines < 2 * self.window:
+                with open(self.path, 'a') as stats_file:
+                    stats_file.write(json.dumps(freeze) + '\n')
+                self.lines += 1
+                return
+            temp_path = '%s.%s' % (self.path, os.getpid())
+            with open(temp_path, 'w') as stats_file:
+                for recorded in self.freezes:
+                    stats_file.write(json.dumps(recorded) + '\n')
+            os.rename(temp_path, self.path)
+            self.lines = len(self.freezes)
+        except (IOError, OSError), e:
+            logger.warn('couldnt write the freeze stats %s: %s', self.path, e)
+
+    def record(self, mount_point, filesystem, timings, flushed=None):
+        freeze = dict(timings, mount_point=mount_point, filesystem=filesystem,
+                      time=time.time())
+        for stage, flushed_bytes in (flushed or {}).items():
+            freeze['flushed_%s' % stage] = flushed_bytes
+        with self.lock:
+            self.load()
+            self.freezes.append(freeze)
+            if self.path:
+                self.save(freeze)
+
+    def percentile(self, segment, percentile, mount_point=None):
+        with self.lock:
+            self.load()
+            values = sorted(f[segment] for f in self.freezes
+                            if mount_point in (None, f['mount_point']))
+        if not values:
+            return None
+        # nearest rank
+        rank = int(math.ceil(percentile / 100.0 * len(values)))
+        return values[min(max(rank, 1), len(values)) - 1]
+
+    def summary(self, mount_point=None):
+        '''
+        Returns count, p50, p99 and max per segment
+        '''
+        summary = {}
+        for segment in self.SEGMENTS:
+            summary[segment] = dict(
+                p50=self.percentile(segment, 50, mount_point),
+                p99=self.percentile(segment, 99, mount_point),
+                max=self.percentile(segment, 100, mount_point))
+        with self.lock:
+            self.load()
+            summary['count'] = len([
+                f for f in self.freezes
+                if mount_point in (None, f['mount_point'])])
+        return summary
+
+
+class FreezeGroup(object):
+    '''
+    Context manager to freeze several mount points at once
+
+    All of them are flushed before the first one is frozen, so no
+    filesystem stays frozen while the others are flushed. If freezing one
+    of them fails the ones already frozen are thawed, on exit all of them
+    are thawed, even if thawing one of them fails
+    '''
+    def __init__(self, freezes):
+        self.freezes = list(freezes)
+        self.frozen = []
+
+    def __enter__(self):
+        for freeze in self.freezes:
+            freeze.prepare()
+        try:
+            for freeze in self.freezes:
+                freeze.__enter__()
+                self.frozen.append(freeze)
+        except:
+            self.__exit__(*sys.exc_info())
+            raise
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        frozen, self.frozen = self.frozen, []
+        thaw_errors = []
+        for freeze in reversed(frozen):
+            try:
+                freeze.__exit__(exc_type, exc_val, exc_tb)
+            except Exception, e:
+                logger.exception('Failed to thaw %s', freeze.mount_point)
+                thaw_errors.append(e)
+        if thaw_errors:
+            raise thaw_errors[0]
+
+
+def get_freeze_stats(name=None):
+    '''
+    Returns the freeze stats of the snapshotter called name, kept in its own
+    file next to the FREEZE_STATS_PATH setting (eg. freeze-stats-redis.jsonl),
+    in memory only if the setting is empty
+    '''
+    from snaptastic import settings
+    path = getattr(settings, 'FREEZE_STATS_PATH', None)
+    if path and name:
+        root, extension = os.path.splitext(path)
+        path = '%s-%s%s' % (root, name, extension)
+    return FreezeStats(path=path)
 
 
 # normalizing name for context manager usage
@@ -0,0 +1,101 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from snaptastic import exceptions
+from snaptastic.utils.concurrency import map_concurrently, TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class Hydrator(object):
+    '''
+    Reads every block of a device restored from a snapshot
+
+    EBS loads the blocks of a restored volume lazily, so the first reads
+    of an application are very slow. Reading the device once, in parallel
+    with large direct I/O reads, pulls all blocks in upfront.
+
+    :param device: the block device, eg. /dev/xvdf
+    :param concurrency: number of chunks read at the same time
+    :param chunk_size: bytes per read, a multiple of a MB
+    :param rate_limit: maximum MB per second, None reads at full speed
+    :param progress: callback receiving the bytes read and the total
+    '''
+    READ_CMD = 'dd if=%(device)s of=/dev/null bs=1M iflag=direct ' \
+        'skip=%(skip)s count=%(count)s'
+    # log progress every this many percent
+    PROGRESS_STEP = 10
+
+    def __init__(self, device, concurrency=8, chunk_size=64 * MB,
+                 rate_limit=None, progress=None):
+        self.device = device
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.rate_limit = rate_limit
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.bytes_read = 0
+        self.reported = 0
+
+    def get_device_size(self):
+        fd = os.open(self.device, os.O_RDONLY)
+        try:
+            return os.lseek(fd, 0, os.SEEK_END)
+        finally:
+            os.close(fd)
+
+    def run(self):
+        self.size = self.get_device_size()
+        self.started = time.time()
+        self.bucket = None
+        if self.rate_limit:
+            self.bucket = TokenBucket(
+                self.rate_limit * MB, max(self.rate_limit * MB, self.chunk_size))
+        offsets = range(0, self.size, self.chunk_size)
+        logger.info('hydrating %s, %s MB in %s chunks with %s workers',
+                    self.device, self.size / MB, len(offsets), self.concurrency)
+        outcomes = map_concurrently(self.read_chunk, offsets, self.concurrency)
+        errors = [error for result, error in outcomes if error is not None]
+        if errors:
+            error_format = 'failed to read %s chunks of %s: %s'
+            raise exceptions.HydrationException(
+                error_format % (len(errors), self.device, errors[0]))
+        logger.info('hydrated %s in %.1f seconds', self.device,
+                    time.time() - self.started)
+        return self.bytes_read
+
+    def read_chunk(self, offset):
+        length = min(self.chunk_size, self.size - offset)
+        if self.bucket is not None:
+            self.bucket.acquire(length)
+        cmd = self.READ_CMD % {
+            'device': self.device,
+            'skip': offset / MB,
+            # dd stops at the end of the device
+            'count': (length + MB - 1) / MB}
+        subprocess.check_output(cmd.split(), stderr=subprocess.STDOUT)
+        self.report(length)
+
+    def report(self, length):
+        with self.lock:
+            self.bytes_read += length
+            bytes_read = self.bytes_read
+            percentage = bytes_read * 100 / self.size
+            if percentage < self.reported + self.PROGRESS_STEP \
+                    and bytes_read < self.size:
+                percentage = None
+            else:
+                self.reported = percentage
+            # under the lock, so the callback sees increasing counts
+            if self.progress is not None:
+                self.progress(bytes_read, self.size)
+        if percentage is not None:
+            elapsed = max(time.time() - self.started, 0.001)
+            logger.info('hydrated %s%% of %s (%.1f MB/s)', percentage,
+                        self.device, bytes_read / elapsed / MB)
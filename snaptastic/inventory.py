@@ -0,0 +1,132 @@
+import logging
+import threading
+
+from snaptastic.utils import iter_snapshots
+from snaptastic.utils.concurrency import map_concurrently
+
+
+logger = logging.getLogger(__name__)
+
+
+class Inventory(object):
+    '''
+    The instances, images, volumes and snapshots of the account, each
+    listed at most once
+
+    Listings are fetched on first access, load fetches several of them
+    concurrently. Deleted resources are removed with the forget methods,
+    so later steps of a cleanup see the current state without listing
+    again.
+
+    :param connection: boto ec2 connection
+    :param owners: the account ids owning our images and snapshots
+    :param catalog: SnapshotCatalog to read the snapshots from
+    :param page_size: snapshots per DescribeSnapshots page
+    '''
+    LISTINGS = ('instances', 'images', 'volumes', 'snapshots')
+    # the device whose snapshot deregister_image(delete_snapshot=True)
+    # deletes along with the image
+    DELETED_SNAPSHOT_DEVICE = '/dev/sda1'
+
+    def __init__(self, connection, owners, catalog=None, page_size=1000):
+        self.con = connection
+        self.owners = owners
+        self.catalog = catalog
+        self.page_size = page_size
+        self.locks = dict((name, threading.Lock()) for name in self.LISTINGS)
+        self.listings = {}
+        # name -> ids of the resources deleted during this run
+        self.forgotten = dict((name, set()) for name in self.LISTINGS)
+
+    def fetch_instances(self):
+        reservations = self.con.get_all_instances()
+        return [i for r in reservations for i in r.instances]
+
+    def fetch_images(self):
+        return self.con.get_all_images(owners=self.owners)
+
+    def fetch_volumes(self):
+        return self.con.get_all_volumes()
+
+    def fetch_snapshots(self):
+        if self.catalog:
+            return self.catalog.iter_snapshots({}, owner=self.owners[0])
+        return iter_snapshots(self.con, owner=self.owners[0],
+                              page_size=self.page_size)
+
+    def get(self, name):
+        # a lock per listing, so concurrent loads of different listings
+        # don't wait for each other
+        with self.locks[name]:
+            if name not in self.listings:
+                listing = list(getattr(self, 'fetch_%s' % name)())
+                logger.info('listed %s %s', len(listing), name)
+                self.listings[name] = listing
+            return self.listings[name]
+
+    def iter_snapshots(self):
+        '''
+        Yields the snapshots page by page without keeping them, unless
+        they were listed already. Forgotten snapshots are skipped, as the
+        listing can still return them for a bit after their deletion.
+        '''
+        with self.locks['snapshots']:
+            snapshots = self.listings.get('snapshots')
+        if snapshots is None:
+            snapshots = self.fetch_snapshots()
+        forgotten = self.forgotten['snapshots']
+        for snapshot in snapshots:
+            if snapshot.id not in forgotten:
+                yield snapshot
+
+    def load(self, *names):
+        '''
+        Fetches the listings concurrently
+        '''
+        names = names or self.LISTINGS
+        outcomes = map_concurrently(self.get, names, len(names))
+        for result, error in outcomes:
+            if error is not None:
+                raise error
+
+    @property
+    def instances(self):
+        return self.get('instances')
+
+    @property
+    def images(self):
+        return self.get('images')
+
+    @property
+    def volumes(self):
+        return self.get('volumes')
+
+    @property
+    def snapshots(self):
+        return self.get('snapshots')
+
+    def forget(self, name, resource_ids):
+        resource_ids = set(resource_ids)
+        with self.locks[name]:
+            self.forgotten[name].update(resource_ids)
+            if name in self.listings:
+                self.listings[name] = [r for r in self.listings[name]
+                                       if r.id not in resource_ids]
+
+    def forget_images(self, image_ids, with_snapshots=False):
+        '''
+        Removes deregistered images, and with_snapshots the snapshots
+        deleted with them. boto's deregister_image(delete_snapshot=True)
+        only deletes the snapshot of /dev/sda1, the snapshots of the other
+        devices are kept, so later steps can still expire them
+        '''
+        image_ids = set(image_ids)
+        if with_snapshots:
+            snapshot_ids = []
+            for image in self.images:
+                device = (image.block_device_mapping or {}).get(
+                    self.DELETED_SNAPSHOT_DEVICE)
+                if image.id in image_ids and device and device.snapshot_id:
+                    snapshot_ids.append(device.snapshot_id)
+            self.forget('snapshots', snapshot_ids)
+        self.forget('images', image_ids)
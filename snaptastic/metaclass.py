@@ -3,7 +3,17 @@ snapshotters = {}
 
 
 def get_snapshotter(snapshotter_name):
+    '''
+    Returns the snapshotter class registered as snapshotter_name
+
+    Snapshotters defined in the settings file are registered when the
+    settings are loaded, the examples only when no snapshotter matches
+    '''
     error_format = 'No Snapshotter %s defined, registered Snapshotters are %s'
+    # loading the settings registers the snapshotters defined in them
+    __import__('snaptastic.settings')
+    if snapshotter_name not in snapshotters:
+        __import__('snaptastic.examples')
     if snapshotter_name not in snapshotters:
         raise ValueError(
             error_format % (snapshotter_name, snapshotters.keys()))
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib2
+
+from snaptastic.utils.concurrency import map_concurrently
+
+
+logger = logging.getLogger(__name__)
+
+
+class PutRequest(urllib2.Request):
+    def get_method(self):
+        return 'PUT'
+
+
+class InstanceMetadata(object):
+    '''
+    Reads the instance metadata and userdata from the metadata service
+
+    Uses IMDSv2 session tokens (falling back to IMDSv1) and reuses the
+    token till it expires. The metadata and userdata are cached in a file
+    per boot, so repeated runs on the same boot don't call the metadata
+    service at all. The token is not written to the cache. The metadata
+    tree, without the EXCLUDED_PATHS, is fetched concurrently and returned
+    as nested dicts in the format of boto's get_instance_metadata.
+    Like boto, the metadata service is always called without a proxy.
+
+    :param cache_dir: directory for the per boot cache, None disables it
+    '''
+    URL = 'http://169.254.169.254/latest/'
+    TOKEN_TTL = 6 * 3600
+    TIMEOUT = 2
+    NUM_RETRIES = 3
+    CONCURRENCY = 8
+    # these change during the life of the instance or hold credentials,
+    # so they are never fetched into the cache
+    EXCLUDED_PATHS = ('meta-data/iam/security-credentials/',
+                      'meta-data/identity-credentials/',
+                      'meta-data/spot/', 'meta-data/events/')
+    BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.cache = None
+        self.token = None
+        self.token_expires = 0
+        # http_proxy must not see the metadata (or its token)
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+    def get_boot_id(self):
+        with open(self.BOOT_ID_PATH) as boot_id_file:
+            return boot_id_file.read().strip()
+
+    def get_cache_path(self):
+        if not self.cache_dir:
+            return None
+        try:
+            boot_id = self.get_boot_id()
+        except IOError:
+            return None
+        # a cache written with other excluded paths is not reused, the
+        # files of older versions and other boots are removed on save
+        paths_hash = hashlib.md5(
+            '\n'.join(sorted(self.EXCLUDED_PATHS))).hexdigest()[:8]
+        return os.path.join(self.cache_dir, 'instance-%s-%s.json' % (
+            paths_hash, boot_id))
+
+    def load_cache(self):
+        # called with the lock held
+        if self.cache is not None:
+            return self.cache
+        self.cache = {}
+        path = self.get_cache_path()
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as cache_file:
+                    self.cache = json.load(cache_file)
+            except (IOError, ValueError), e:
+                logger.warn('ignoring the instance cache %s: %s', path, e)
+        return self.cache
+
+    def save_cache(self):
+        # called with the lock held
+        path = self.get_cache_path()
+        if not path:
+            return
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            for name in os.listdir(self.cache_dir):
+                # files of earlier boots or versions
+                if name.startswith('instance-') and \
+                        name != os.path.basename(path):
+                    os.remove(os.path.join(self.cache_dir, name))
+            # the userdata can hold secrets, only readable by us
+            temp_path = '%s.%s' % (path, os.getpid())
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0600)
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(self.cache, cache_file)
+            os.rename(temp_path, path)
+        except (IOError, OSError), e:
+            logger.warn('couldnt write the instance cache %s: %s', path, e)
+
+    def get_token(self):
+        # called with the lock held
+        if self.token is not None and time.time() < self.token_expires - 60:
+            return self.token
+        request = PutRequest(self.URL + 'api/token', data='', headers={
+            'X-aws-ec2-metadata-token-ttl-seconds': str(self.TOKEN_TTL)})
+        try:
+            self.token = self.opener.open(
+                request, timeout=self.TIMEOUT).read()
+            self.token_expires = time.time() + self.TOKEN_TTL
+        except (urllib2.URLError, IOError), e:
+            logger.info('no IMDSv2 token, falling back to IMDSv1: %s', e)
+            self.token = None
+        return self.token
+
+    def fetch(self, path, token=None):
+        '''
+        Returns the body of path, None if it doesn't exist
+        '''
+        headers = {}
+        if token:
+            headers['X-aws-ec2-metadata-token'] = token
+        for attempt in range(self.NUM_RETRIES):
+            request = urllib2.Request(self.URL + path, headers=headers)
+            try:
+                return self.opener.open(request, timeout=self.TIMEOUT).read()
+            except urllib2.HTTPError, e:
+                if e.code == 404:
+                    return None
+                error = e
+            except (urllib2.URLError, IOError), e:
+                error = e
+            time.sleep(0.1 * 2 ** attempt)
+        raise error
+
+    def is_excluded(self, path):
+        return (path + '/').startswith(self.EXCLUDED_PATHS)
+
+    def parse(self, value):
+        if value and value[0] == '{':
+            try:
+                return json.loads(value)
+            except ValueError:
+                return value
+        if value and '\n' in value:
+            return value.split('\n')
+        return value
+
+    def fetch_tree(self, path, token):
+        '''
+        Walks the metadata below path level by level, fetching all listings
+        and values of a level concurrently
+        '''
+        def fetch(node):
+            return self.fetch(node[-1], token)
+
+        tree = {}
+        # (dict to fill, path of its listing)
+        level = [(tree, path)]
+        while level:
+            leaves = []
+            next_level = []
+            listings = map_concurrently(fetch, level, self.CONCURRENCY)
+            for (node, node_path), (listing, error) in zip(level, listings):
+                if error is not None:
+                    raise error
+                for field in (listing or '').splitlines():
+                    if field.endswith('/'):
+                        if not self.is_excluded(node_path + field[:-1]):
+                            node[field[:-1]] = {}
+                            next_level.append(
+                                (node[field[:-1]], node_path + field))
+                    elif '=' in field:
+                        # public keys are listed as index=name
+                        index, name = field.split('=', 1)
+                        leaves.append((node, name, '%s%s/openssh-key' % (
+                            node_path, index)))
+                    elif field and not self.is_excluded(node_path + field):
+                        leaves.append((node, field, node_path + field))
+            values = map_concurrently(fetch, leaves, self.CONCURRENCY)
+            for (node, key, _), (value, error) in zip(leaves, values):
+                if error is not None:
+                    raise error
+                if value is not None:
+                    node[key] = self.parse(value)
+            level = next_level
+        return tree
+
+    def get(self, name, fetch):
+        with self.lock:
+            cache = self.load_cache()
+            if name in cache:
+                return cache[name]
+            token = self.get_token()
+        logger.info('reading the instance %s', name)
+        value = fetch(token)
+        with self.lock:
+            self.cache[name] = value
+            self.save_cache()
+        return value
+
+    def get_metadata(self):
+        return self.get('metadata', lambda token: self.fetch_tree(
+            'meta-data/', token))
+
+    def get_userdata(self):
+        return self.get('userdata', lambda token: self.fetch(
+            'user-data', token) or '')
+
+
+_instance_metadata = None
+_instance_metadata_lock = threading.Lock()
+
+
+def get_instance_metadata():
+    '''
+    The process wide InstanceMetadata, cached in the directory of the
+    INSTANCE_CACHE_DIR setting
+    '''
+    global _instance_metadata
+    from snaptastic import settings
+    with _instance_metadata_lock:
+        if _instance_metadata is None:
+            _instance_metadata = InstanceMetadata(
+                getattr(settings, 'INSTANCE_CACHE_DIR', None))
+        return _instance_metadata
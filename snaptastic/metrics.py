@@ -0,0 +1,94 @@
+import logging
+from xml.etree import ElementTree
+
+from snaptastic.utils import chunks
+from snaptastic.utils.concurrency import map_concurrently
+
+
+logger = logging.getLogger(__name__)
+
+# the maximum number of metrics in a GetMetricData request
+MAX_METRIC_QUERIES = 500
+
+
+def get_metric_data(con, namespace, metric_name, dimension_name, values,
+                    start, end, period, statistic='Average', batch_size=None,
+                    workers=4):
+    '''
+    Fetches metric_name for every dimension value with GetMetricData,
+    batch_size metrics per request and workers requests at the same time
+
+    boto 2 only supports GetMetricStatistics, a single metric per request,
+    so the request is made and parsed here.
+
+    :returns: dict of dimension value -> datapoints, newest first
+    '''
+    batch_size = min(batch_size or MAX_METRIC_QUERIES, MAX_METRIC_QUERIES)
+
+    def fetch(batch):
+        params = {
+            'StartTime': start.isoformat(),
+            'EndTime': end.isoformat(),
+        }
+        for index, value in enumerate(batch):
+            prefix = 'MetricDataQueries.member.%s.' % (index + 1)
+            metric = prefix + 'MetricStat.Metric.'
+            params[prefix + 'Id'] = 'm%s' % index
+            params[prefix + 'MetricStat.Period'] = period
+            params[prefix + 'MetricStat.Stat'] = statistic
+            params[metric + 'Namespace'] = namespace
+            params[metric + 'MetricName'] = metric_name
+            params[metric + 'Dimensions.member.1.Name'] = dimension_name
+            params[metric + 'Dimensions.member.1.Value'] = value
+        datapoints = {}
+        while True:
+            results, next_token = request(params)
+            for query_id, points in results:
+                value = batch[int(query_id[1:])]
+                datapoints.setdefault(value, []).extend(points)
+            if not next_token:
+                return datapoints.items()
+            params['NextToken'] = next_token
+
+    def request(params):
+        response = con.make_request('GetMetricData', params, '/', 'POST')
+        body = response.read()
+        if response.status != 200:
+            raise con.ResponseError(response.status, response.reason, body)
+        return parse_metric_data(body)
+
+    outcomes = map_concurrently(fetch, chunks(values, batch_size), workers)
+    metric_data = {}
+    for result, error in outcomes:
+        if error is not None:
+            raise error
+        metric_data.update(result)
+    return metric_data
+
+
+def parse_metric_data(body):
+    '''
+    Returns the ([(query id, values)], next token) of a GetMetricData
+    response
+    '''
+    def children(element, name):
+        return [c for c in element if c.tag.split('}')[-1] == name]
+
+    def find(element, *path):
+        for name in path:
+            found = children(element, name)
+            if not found:
+                return None
+            element = found[0]
+        return element
+
+    root = ElementTree.fromstring(body)
+    result = find(root, 'GetMetricDataResult')
+    results = []
+    for member in children(find(result, 'MetricDataResults'), 'member'):
+        values = find(member, 'Values')
+        points = [float(v.text) for v in children(values, 'member')] \
+            if values is not None else []
+        results.append((find(member, 'Id').text, points))
+    next_token = find(result, 'NextToken')
+    return results, next_token.text if next_token is not None else None
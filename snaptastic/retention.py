@@ -0,0 +1,84 @@
+import logging
+from collections import defaultdict
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetainedSnapshot(object):
+    '''
+    The parts of a snapshot the retention policy and the deleter use, so
+    a large account doesn't keep every boto object in memory
+    '''
+    __slots__ = ('id', 'volume_size', 'status', 'start_time')
+
+    def __init__(self, id, volume_size, status, start_time):
+        self.id = id
+        self.volume_size = volume_size
+        self.status = status
+        self.start_time = start_time
+
+    def __repr__(self):
+        return 'Snapshot:%s' % self.id
+
+
+class RetentionPolicy(object):
+    '''
+    Grandfather-father-son retention
+
+    Of the snapshots of a group (a mount point of a cluster), keeps the
+    newest snapshot of each of the last hourly hours, daily days, weekly
+    weeks and monthly months which have snapshots. Everything else is
+    expired. Pending snapshots are always kept, failed ones are expired.
+    '''
+    PERIODS = (
+        ('hourly', lambda t: (t.year, t.month, t.day, t.hour)),
+        ('daily', lambda t: (t.year, t.month, t.day)),
+        ('weekly', lambda t: t.isocalendar()[:2]),
+        ('monthly', lambda t: (t.year, t.month)),
+    )
+
+    def __init__(self, hourly=24, daily=7, weekly=4, monthly=12):
+        self.counts = dict(hourly=hourly, daily=daily, weekly=weekly,
+                           monthly=monthly)
+
+    def __repr__(self):
+        return 'RetentionPolicy(%s)' % ', '.join(
+            '%s=%s' % (name, self.counts[name]) for name, _ in self.PERIODS)
+
+    def get_keep(self, snapshots):
+        '''
+        The ids of the snapshots of a single group to keep, in one pass
+        over the snapshots sorted newest first
+        '''
+        keep = set()
+        # period -> the buckets which already have their snapshot
+        seen = defaultdict(set)
+        for snapshot in sorted(snapshots, key=lambda s: s.start_time,
+                               reverse=True):
+            if snapshot.status == 'pending':
+                keep.add(snapshot.id)
+                continue
+            if snapshot.status != 'completed':
+                # error, never restorable
+                continue
+            for name, get_bucket in self.PERIODS:
+                buckets = seen[name]
+                bucket = get_bucket(snapshot.start_time)
+                if bucket not in buckets and len(buckets) < self.counts[name]:
+                    buckets.add(bucket)
+                    keep.add(snapshot.id)
+        return keep
+
+    def get_expired(self, groups):
+        '''
+        Yields the snapshots to delete, groups maps a group to its
+        snapshots
+        '''
+        for group, snapshots in groups.iteritems():
+            keep = self.get_keep(snapshots)
+            logger.info('keeping %s of %s snapshots of %s', len(keep),
+                        len(snapshots), group)
+            for snapshot in snapshots:
+                if snapshot.id not in keep:
+                    yield snapshot
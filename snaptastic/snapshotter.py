@@ -1,13 +1,22 @@
 import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
 from time import sleep
 from datetime import timedelta, datetime
 
 from snaptastic import exceptions
-from snaptastic import get_ec2_conn
 from snaptastic import metaclass
+from snaptastic.catalog import get_snapshot_catalog
 from snaptastic.ebs_volume import EBSVolume
-from snaptastic.utils import get_userdata_dict, add_tags
+from snaptastic.freeze import FreezeGroup, get_freeze_stats
+from snaptastic.utils import get_ec2_conn, get_userdata_dict
+from snaptastic.utils import get_metadata_dict, get_start_time_filter
+from snaptastic.utils import iter_snapshots
+from snaptastic.utils import bulk_add_tags, create_tagged
+from snaptastic.utils.concurrency import map_concurrently, map_with_dependencies
+from snaptastic.waiter import SnapshotWaiter, VolumeWaiter
 
 
 logger = logging.getLogger(__name__)
@@ -30,12 +39,41 @@ class Snapshotter(object):
     - pre_snapshots, post_snapshots
     '''
     SNAPSHOT_EXPIRY_DAYS = 7
-    NOT_READY_SNAPSHOT_SLEEP = 2
+    # snapshots per DescribeSnapshots page
+    SNAPSHOT_PAGE_SIZE = 1000
+    # only look for snapshots of the last n days, None looks at all of them
+    SNAPSHOT_LOOKUP_DAYS = None
+    # tag snapshots and volumes in their create request (TagSpecification)
+    TAG_ON_CREATE = False
+    # warn when the p99 of the freeze window exceeds this many seconds
+    FREEZE_WARNING_SECONDS = 5
+    # read volumes restored from a snapshot once after mounting them
+    HYDRATE_VOLUMES = False
+    # wait for the hydrations before running post_mounts, when False it
+    # runs right away but the process still waits for them
+    HYDRATE_BLOCKING = True
+    HYDRATE_CONCURRENCY = 8
+    # MB per second per volume, None reads at full speed
+    HYDRATE_RATE_LIMIT = None
+    # the number of volumes to snapshot at the same time
+    SNAPSHOT_CONCURRENCY = 1
+    # the number of volumes to mount at the same time
+    MOUNT_CONCURRENCY = 1
+    # seconds to wait for volume state changes
+    VOLUME_AVAILABLE_TIMEOUT = 45
+    VOLUME_ATTACH_TIMEOUT = 45
+    VOLUME_DETACH_TIMEOUT = 45
+    # seconds to wait for a pending snapshot before mounting it
+    SNAPSHOT_READY_TIMEOUT = 300
+    # times a freeze and snapshot step throttled by EC2 is retried, after
+    # thawing the volumes
+    FROZEN_CREATE_RETRIES = 3
     name = None
 
     __metaclass__ = metaclass.SnapshotterRegisteringMetaClass
 
-    def __init__(self, userdata=None, metadata=None, connection=None, bdm=None):
+    def __init__(self, userdata=None, metadata=None, connection=None, bdm=None,
+                 catalog=None):
         '''
         Goes through the steps needed to mount the specified volume
         - checks if we have a snapshot
@@ -43,20 +81,34 @@ class Snapshotter(object):
         - tag the volume
         - load the data from the snapshot into the volume
 
+        The userdata, metadata and bdm are only fetched when first used
+
         :param userdata: dictionary with the userdata
         :type userdata: dict
         :param metadata: metadata for the instance
         :type metadata: dict
         :param connection: boto connection object
         :param bdm: dictionary describing the device mapping
+        :param catalog: SnapshotCatalog to read snapshots from, defaults to
+            the one configured in the settings, False disables it
 
         '''
-        from boto.utils import get_instance_metadata
-        self.userdata = get_userdata_dict() if userdata is None else userdata
-        self.metadata = get_instance_metadata(
-        ) if metadata is None else metadata
+        self._userdata = userdata
+        self._metadata = metadata
+        self._bdm = bdm
+        # reentrant, get_bdm loads the metadata while holding it
+        self.instance_data_lock = threading.RLock()
         self.con = get_ec2_conn() if connection is None else connection
-        self.bdm = self.get_bdm() if bdm is None else bdm
+        self.volume_waiter = VolumeWaiter(self.con)
+        self.snapshot_waiter = SnapshotWaiter(self.con)
+        self.catalog = get_snapshot_catalog(
+            self.con) if catalog is None else catalog
+        # the time the resources of a run are tagged with, see batch_tags
+        self.tagged_at = None
+        # rolling window of the time our volumes spent frozen, kept apart
+        # from the other snapshotters on the host
+        self.freeze_stats = get_freeze_stats(
+            self.name or self.__class__.__name__)
 
     '''
     These you will need to customize
@@ -88,26 +140,110 @@ class Snapshotter(object):
     Main functions to call when using Snapshotter
     '''
 
-    def make_snapshots(self, volumes=None):
+    def make_snapshots(self, volumes=None, consistency_group=False):
         '''
         Make snapshots of all the volumes
+
+        With consistency_group all volumes are frozen together, so the
+        snapshots share a single point in time
         '''
         volumes = volumes or self.get_volumes()
         logger.info('making snapshots of %s volumes', len(volumes))
         self.pre_snapshots(volumes)
         try:
-            return self._make_snapshots(volumes)
+            with self.batch_tags():
+                if consistency_group:
+                    return self._make_group_snapshots(volumes)
+                return self._make_snapshots(volumes)
         finally:
+            self.log_freeze_stats()
             self.post_snapshots(volumes)
 
+    def log_freeze_stats(self):
+        summary = self.freeze_stats.summary()
+        if not summary['count']:
+            return
+        total = summary['total']
+        log_format = 'freeze window over the last %s freezes: ' \
+            'p50 %.3fs, p99 %.3fs, max %.3fs'
+        log_args = (summary['count'], total['p50'], total['p99'], total['max'])
+        if total['p99'] > self.FREEZE_WARNING_SECONDS:
+            logger.warn(log_format, *log_args)
+        else:
+            logger.info(log_format, *log_args)
+
     def _make_snapshots(self, volumes):
-        snapshots = []
+        outcomes = map_concurrently(
+            self._make_volume_snapshot, volumes, self.SNAPSHOT_CONCURRENCY)
+        return self.collect_outcomes(volumes, outcomes, 'snapshot')
+
+    def _make_volume_snapshot(self, vol):
+        self.pre_snapshot(vol)
+        snapshot = self.make_snapshot(vol)
+        self.post_snapshot(vol)
+        return snapshot
+
+    def _make_group_snapshots(self, volumes):
+        '''
+        Freezes all volumes, creates all snapshots concurrently and thaws
+        the volumes as soon as the last snapshot is created
+        '''
         for vol in volumes:
             self.pre_snapshot(vol)
-            snapshot = self.make_snapshot(vol)
-            snapshots.append(snapshot)
+        tags = [self.get_tags_for_volume(vol) for vol in volumes]
+        requests = [(self.get_volume_id(vol), self.get_snapshot_description(vol),
+                     volume_tags) for vol, volume_tags in zip(volumes, tags)]
+
+        def create(request):
+            volume_id, description, volume_tags = request
+            return self.create_snapshot(volume_id, description, volume_tags)
+
+        def freeze():
+            freezes = [vol.freeze(stats=self.freeze_stats) for vol in volumes]
+            return FreezeGroup(freezes)
+
+        logger.info('freezing %s volumes as a consistency group', len(volumes))
+        outcomes = self.create_frozen(
+            freeze, [lambda request=request: create(request)
+                     for request in requests])
+
+        failed = [(vol, error) for vol, (snapshot, error)
+                  in zip(volumes, outcomes) if error is not None]
+        if failed:
+            # the group is only restorable as a whole, don't leave snapshots
+            # of some of the volumes behind
+            group_error = exceptions.DependencyFailure(
+                'the snapshot of %s in the same consistency group failed, '
+                'deleted the snapshot' % failed[0][0])
+            for index, (snapshot, error) in enumerate(outcomes):
+                if error is None:
+                    self.delete_partial_snapshot(snapshot)
+                    outcomes[index] = (None, group_error)
+            return self.collect_outcomes(volumes, outcomes, 'snapshot')
+
+        for vol, volume_tags, (snapshot, error) in zip(volumes, tags, outcomes):
+            if not self.TAG_ON_CREATE:
+                self.tag_snapshot(snapshot, volume_tags)
             self.post_snapshot(vol)
-        return snapshots
+        return self.collect_outcomes(volumes, outcomes, 'snapshot')
+
+    def collect_outcomes(self, volumes, outcomes, action):
+        '''
+        Turns the (result, exception) outcomes per volume into a list of
+        results, raising PartialFailure if any of the volumes failed
+        '''
+        results = []
+        errors = []
+        for vol, (result, error) in zip(volumes, outcomes):
+            if error is not None:
+                errors.append((vol, error))
+            results.append(result)
+        if errors:
+            error_format = 'failed to %s %s out of %s volumes'
+            raise exceptions.PartialFailure(
+                error_format % (action, len(errors), len(volumes)),
+                results=results, errors=errors)
+        return results
 
     def make_snapshot(self, vol):
         # get a snapshot name
@@ -119,59 +255,159 @@ class Snapshotter(object):
         # get the tags, note that these are used for finding the right snapshot
         tags = self.get_tags_for_volume(vol)
         # Don't freeze more than we need to
-        with vol.freeze():
-            logger.info('creating snapshot')
+        outcomes = self.create_frozen(
+            lambda: vol.freeze(stats=self.freeze_stats),
+            [lambda: self.create_snapshot(volume_id, description, tags)])
+        snapshot, error = outcomes[0]
+        if error is not None:
+            raise error
+        if not self.TAG_ON_CREATE:
+            self.tag_snapshot(snapshot, tags)
+        return snapshot
+
+    def create_frozen(self, freeze, creates):
+        '''
+        Runs the snapshot creates concurrently within the context manager
+        returned by freeze, returning their (result, exception) outcomes
+
+        The creates neither wait for the client side rate limit nor are
+        they retried while the volumes are frozen, their tokens are taken
+        before freezing. If EC2 throttles any of them the volumes are thawed,
+        the snapshots of the attempt are deleted and the whole step is
+        retried after a backoff.
+        '''
+        throttler = getattr(self.con, 'throttler', None)
+
+        def run(create):
+            if throttler is None:
+                return create()
+            with throttler.immediate():
+                return create()
+
+        attempt = 0
+        while True:
+            if throttler is not None:
+                throttler.acquire('CreateSnapshot', len(creates))
+            with freeze():
+                outcomes = map_concurrently(run, creates, len(creates))
+            throttled = throttler is not None and any(
+                error is not None and throttler.is_throttled(error)
+                for _, error in outcomes)
+            if not throttled or attempt >= self.FROZEN_CREATE_RETRIES:
+                return outcomes
+            for snapshot, error in outcomes:
+                if error is None:
+                    self.delete_partial_snapshot(snapshot)
+            delay = throttler.get_delay(attempt)
+            logger.warn('creating snapshots was throttled, retrying in '
+                        '%.1f seconds', delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def delete_partial_snapshot(self, snapshot):
+        '''
+        Removes a snapshot of a consistency group attempt which is retried
+        or of which another snapshot failed
+        '''
+        try:
+            self.con.delete_snapshot(snapshot.id)
+        except Exception, e:
+            logger.warn('couldnt delete the snapshot %s of the partial '
+                        'consistency group: %s', snapshot.id, e)
+
+    def create_snapshot(self, volume_id, description, tags=None):
+        '''
+        Creates the snapshot, with TAG_ON_CREATE the tags are part of
+        the create request
+        '''
+        logger.info('creating snapshot of %s', volume_id)
+        if self.TAG_ON_CREATE:
+            params = {'VolumeId': volume_id}
+            if description:
+                params['Description'] = description[0:255]
+            snapshot = create_tagged(
+                self.con, 'CreateSnapshot', params, 'snapshot', tags or {})
+        else:
             snapshot = self.con.create_snapshot(
                 volume_id, description=description)
-            logger.info('succesfully created snapshot with id %s', snapshot.id)
-        # Add tags
-        logger.info('tagging snapshot %s with tags %s', snapshot.id, tags)
-        add_tags(snapshot, tags)
+        logger.info('succesfully created snapshot with id %s', snapshot.id)
         return snapshot
 
+    def tag_snapshot(self, snapshot, tags):
+        logger.info('tagging snapshot %s with tags %s', snapshot.id, tags)
+        self.tag_resource(snapshot, tags)
+
+    def tag_resource(self, object_, tags):
+        # right away, so the resource isn't left untagged for the whole run
+        bulk_add_tags(self.con, [(object_, tags)])
+
+    @contextmanager
+    def batch_tags(self):
+        '''
+        Snapshots and volumes created within this block share the created
+        and expires timestamps of their tags
+        '''
+        if self.tagged_at is not None:
+            yield
+            return
+        self.tagged_at = datetime.now()
+        try:
+            yield
+        finally:
+            self.tagged_at = None
+
     def clear_snapshot_cache(self):
         if hasattr(self, '_snapshots'):
             del self._snapshots
+        if hasattr(self, '_snapshot_index'):
+            del self._snapshot_index
 
-    def wait_before_attempt(self, attempt_number):
+    def wait_for_snapshots(self, volumes, timeout=None):
         '''
-        Waits an linearly increasing amount of time based on the number of attempts
-        already done.
-
-        It is used to sleep between multiple attempts (eg. request polling)
-
-        :param attempt_number: the number of attempts already done
+        Make sure all volumes have a ready to mount snapshot
 
+        Waits for the pending snapshots with wait_for_snapshot, concurrently
+        so the snapshot waiter polls them together. mount_snapshots doesn't
+        need this, every mount waits for its own snapshot.
         '''
-        seconds_to_sleep = attempt_number * self.NOT_READY_SNAPSHOT_SLEEP
-        sleep(seconds_to_sleep)
-
-    def wait_for_snapshots(self, volumes, max_retries=12):
+        pending = []
+        for vol in volumes:
+            try:
+                snapshot = self.get_snapshot(vol)
+            except exceptions.MissingSnapshot:
+                continue
+            if snapshot.status != 'completed':
+                pending.append(snapshot)
+        outcomes = map_concurrently(
+            lambda snapshot: self.wait_for_snapshot(snapshot, timeout),
+            pending, len(pending))
+        for result, error in outcomes:
+            if error is not None:
+                raise error
+
+    def wait_for_snapshot(self, snapshot, timeout=None):
         '''
-        Make sure all volumes have a ready to mount snapshot
-        before starting to mount them
-        '''
-        retries = 0
-        not_ready = [volumes]
-        while len(not_ready) > 0:
-            self.clear_snapshot_cache()
-            not_ready = [vol for vol in volumes
-                         if self.get_snapshot(vol)
-                         and self.get_snapshot(vol).status != 'completed']
-            if not_ready == []:
-                break
-            if retries >= max_retries:
-                raise exceptions.MissingSnapshot(
-                    'Snapshots are not ready after %s attempts, aborting...' % retries)
-            retries += 1
-            logger.info('Waiting %s seconds for volumes %s to have ready snapshots' % (
-                not_ready, self.NOT_READY_SNAPSHOT_SLEEP))
-            self.wait_before_attempt(retries)
+        Waits for a single snapshot to complete, the snapshots of concurrent
+        mounts are polled together by the shared snapshot waiter. Raises
+        MissingSnapshot if it isn't completed within timeout seconds,
+        SNAPSHOT_READY_TIMEOUT by default
+        '''
+        timeout = timeout or self.SNAPSHOT_READY_TIMEOUT
+        logger.info('Waiting for snapshot %s to complete', snapshot.id)
+        try:
+            return self.snapshot_waiter.wait(
+                snapshot.id, 'completed', timeout=timeout)
+        except exceptions.WaitTimeout, e:
+            raise exceptions.MissingSnapshot(str(e))
 
     def mount_snapshots(self, volumes=None, ignore_mounted=False, dry_run=False):
         ''' Loops through the volumes and runs mount_volume on them
 
-        When ignore_mounted is True it will ignore DeviceAlreadyExists errors
+        Up to MOUNT_CONCURRENCY volumes are mounted at the same time, nested
+        mount points wait for the volume they are mounted in. Every volume
+        starts as soon as its own snapshot is completed.
+        When ignore_mounted is True it will ignore DeviceAlreadyExists errors,
+        otherwise no further volumes are started and the error is raised
         '''
         volumes = volumes or self.get_volumes()
         logger.info('preparing to mount %s volumes', len(volumes))
@@ -184,25 +420,65 @@ class Snapshotter(object):
                     'for volume %s found snapshot %s', vol, snapshot_id)
             return volumes
 
-        self.wait_for_snapshots(volumes)
         self.pre_mounts(volumes)
+        already_exists = []
 
-        for vol in volumes:
-            self.pre_mount(vol)
+        def mount(vol):
+            # an existing device stops the mounts which haven't started yet
+            if already_exists:
+                raise exceptions.MountException(
+                    'not mounting %s, a device already exists' % vol)
             try:
-                self.mount_snapshot(vol)
-            except exceptions.DeviceAlreadyExists:
-                if ignore_mounted:
-                    logger.info("Ignoring {0}".format(vol))
-                else:
-                    raise
-
-            self.post_mount(vol)
+                return self._mount_volume(vol, ignore_mounted)
+            except exceptions.DeviceAlreadyExists, e:
+                already_exists.append(e)
+                raise
+
+        dependencies = self.get_mount_dependencies(volumes)
+        with self.batch_tags():
+            outcomes = map_with_dependencies(
+                mount, volumes, dependencies, self.MOUNT_CONCURRENCY)
+        if already_exists:
+            raise already_exists[0]
+        hydrations = self.collect_outcomes(volumes, outcomes, 'mount')
+        if self.HYDRATE_BLOCKING:
+            self.wait_for_hydrations(volumes, hydrations)
 
         self.post_mounts(volumes)
 
         return volumes
 
+    def _mount_volume(self, vol, ignore_mounted=False):
+        self.pre_mount(vol)
+        hydration = None
+        try:
+            hydration = self.mount_snapshot(vol)
+        except exceptions.DeviceAlreadyExists:
+            if ignore_mounted:
+                logger.info("Ignoring {0}".format(vol))
+            else:
+                raise
+        self.post_mount(vol)
+        return hydration
+
+    def get_mount_dependencies(self, volumes):
+        '''
+        Maps the index of every nested volume to the index of the volume
+        it is mounted in, eg. /var/lib/postgresql waits for /var/lib
+        '''
+        mount_points = [os.path.normpath(v.mount_point) for v in volumes]
+        dependencies = {}
+        for index, mount_point in enumerate(mount_points):
+            parents = []
+            for parent_index, parent in enumerate(mount_points):
+                prefix = parent.rstrip('/') + '/'
+                if parent != mount_point and mount_point.startswith(prefix):
+                    parents.append((len(parent), parent_index))
+            if parents:
+                # the closest parent depends on the ones further up
+                dependencies[index] = [max(parents)[1]]
+        return dependencies
+
     def mount_snapshot(self, ebs_volume):
         '''
         Goes through the steps needed to mount the specified volume
@@ -211,6 +487,9 @@ class Snapshotter(object):
         - tag the volume
         - load the data from the snapshot into the volume
 
+        With HYDRATE_VOLUMES a restored volume is hydrated in the background,
+        the hydration thread is returned
+
         :param ebs_volume: the volume specification, we're mounting
         :type ebs_volume: EBSVolume
         '''
@@ -219,6 +498,9 @@ class Snapshotter(object):
             snapshot_id = self.get_snapshot(ebs_volume)
         except exceptions.MissingSnapshot, e:
             snapshot_id = None
+        # start as soon as our own snapshot is ready
+        if snapshot_id is not None and snapshot_id.status != 'completed':
+            snapshot_id = self.wait_for_snapshot(snapshot_id)
         logger.info('mounting a volume to %s with snapshot %s',
                     ebs_volume.mount_point, snapshot_id)
 
@@ -233,30 +515,82 @@ class Snapshotter(object):
         # mount the volume
         ebs_volume.mount()
 
+        if snapshot_id is not None and self.HYDRATE_VOLUMES:
+            return self.hydrate_volume(ebs_volume)
+
+    def hydrate_volume(self, ebs_volume):
+        '''
+        Starts reading the restored volume once in a thread, which is
+        returned. Its error, if any, is stored as the error attribute.
+        '''
+        kwargs = dict(concurrency=self.HYDRATE_CONCURRENCY,
+                      rate_limit=self.HYDRATE_RATE_LIMIT)
+
+        def hydrate():
+            try:
+                ebs_volume.hydrate(**kwargs)
+            except Exception, e:
+                logger.exception('hydrating %s failed: %s', ebs_volume, e)
+                thread.error = e
+        # not a daemon, the process (eg. mount-snapshots) only exits once
+        # the hydration finishes, it just doesn't hold up the other mounts
+        # and the hooks
+        thread = threading.Thread(target=hydrate)
+        thread.error = None
+        thread.start()
+        return thread
+
+    def wait_for_hydrations(self, volumes, hydrations):
+        '''
+        Waits for the hydration threads started by mount_snapshot, raising
+        PartialFailure if any of them failed
+        '''
+        outcomes = []
+        for hydration in hydrations:
+            if hydration is None:
+                outcomes.append((None, None))
+                continue
+            hydration.join()
+            outcomes.append((None, hydration.error))
+        self.collect_outcomes(volumes, outcomes, 'hydrate')
+
     def unmount_snapshots(self, volumes=None):
         '''
         Unmounting the volumes, mainly for testing
+
+        Runs MOUNT_CONCURRENCY volumes at the same time, nested mount points
+        are unmounted before the volume they are mounted in
         '''
         volumes = volumes or self.get_volumes()
         self.pre_unmounts(volumes)
         logger.info('unmounting volumes %s', volumes)
-        for vol in volumes:
-            # first unmount
-            self.pre_unmount(vol)
-            try:
-                vol.unmount()
-            except exceptions.UnmountException, e:
-                logger.warn(e)
-            try:
-                # now detach
-                volume_id = self.get_volume_id(vol)
-                self.detach_volume(vol, volume_id)
-            except Exception, e:
-                logger.warn(e)
-            self.post_unmount(vol)
+        # the reverse of mounting, parents wait for their children
+        dependencies = {}
+        for child, parents in self.get_mount_dependencies(volumes).items():
+            for parent in parents:
+                dependencies.setdefault(parent, []).append(child)
+        outcomes = map_with_dependencies(
+            self._unmount_volume, volumes, dependencies,
+            self.MOUNT_CONCURRENCY)
+        self.collect_outcomes(volumes, outcomes, 'unmount')
         self.post_unmounts(volumes)
         return volumes
 
+    def _unmount_volume(self, vol):
+        # first unmount
+        self.pre_unmount(vol)
+        try:
+            vol.unmount()
+        except exceptions.UnmountException, e:
+            logger.warn(e)
+        try:
+            # now detach
+            volume_id = self.get_volume_id(vol)
+            self.detach_volume(vol, volume_id)
+        except Exception, e:
+            logger.warn(e)
+        self.post_unmount(vol)
+
     '''
     Volume related functionality
     '''
@@ -280,6 +614,20 @@ class Snapshotter(object):
         # load from a snapshot if we have one
         log_message = 'Creating a volume of size %s in zone %s from snapshot %s'
         logger.info(log_message, vol.size, self.availability_zone, snapshot_id)
+        # we get boto or catalog snapshots, boto only needs the id
+        snapshot_id = getattr(snapshot_id, 'id', snapshot_id)
+        tags = self.get_tags_for_volume(vol)
+        if self.TAG_ON_CREATE:
+            params = {'AvailabilityZone': self.availability_zone,
+                      'Size': vol.size, 'VolumeType': vol.volume_type}
+            if snapshot_id:
+                params['SnapshotId'] = snapshot_id
+            if vol.iops:
+                params['Iops'] = str(vol.iops)
+            boto_volume = create_tagged(
+                self.con, 'CreateVolume', params, 'volume', tags)
+            return boto_volume
+
         # tell boto about the iops if we want them :)
         kwargs = dict()
         if vol.iops:
@@ -291,10 +639,8 @@ class Snapshotter(object):
                                              **kwargs
                                              )
         # tag the volume
-        tags = self.get_tags_for_volume(vol)
         logger.info('tagging volume %s with tags %s', boto_volume.id, tags)
-        add_tags(boto_volume, tags)
-        logger.info('tags added succesfully')
+        self.tag_resource(boto_volume, tags)
 
         return boto_volume
 
@@ -306,13 +652,11 @@ class Snapshotter(object):
             logger.warn("The device %s already exists.",
                         ebs_volume.instance_device)
         # waiting till the volume is available
-        waited = 0
-        MAX_VOLUME_AVAILABLE_WAIT = 45
-        while boto_volume.update() != 'available' and waited < MAX_VOLUME_AVAILABLE_WAIT:
-            logger.info(
-                'Waiting for volume to become available %s' % boto_volume.id)
-            sleep(1)
-            waited += 1
+        logger.info(
+            'Waiting for volume to become available %s', boto_volume.id)
+        self.wait_for_volume(
+            boto_volume.id, 'available', self.VOLUME_AVAILABLE_TIMEOUT,
+            exceptions.AttachmentException)
 
         # attaching a volume to our instance
         message_format = 'Attaching volume %s to instance %s'
@@ -322,52 +666,61 @@ class Snapshotter(object):
 
         logger.info('Starting to poll till volume is fully attached')
         # drink some coffee and wait
-        waited = 0
-        MAX_ATTACHMENT_WAIT = 45
-        while boto_volume.update() != 'in-use' and waited < MAX_ATTACHMENT_WAIT:
-            logger.info('Waiting for volume attachment: %s' % boto_volume.id)
-            sleep(1)
-            waited += 1
-        while not os.path.exists(ebs_volume.instance_device) and waited < MAX_ATTACHMENT_WAIT:
-            logger.info('Waiting for device: %s' % ebs_volume.instance_device)
-            sleep(1)
-            waited += 1
-
-        if waited == MAX_ATTACHMENT_WAIT:
-            error_format = 'Device didnt attach within % seconds'
-            raise exceptions.AttachmentException(
-                error_format, MAX_ATTACHMENT_WAIT)
+        self.wait_for_volume(
+            boto_volume.id, 'in-use', self.VOLUME_ATTACH_TIMEOUT,
+            exceptions.AttachmentException)
+        self.wait_for_device(
+            ebs_volume.instance_device, True, self.VOLUME_ATTACH_TIMEOUT,
+            exceptions.AttachmentException)
 
         return boto_volume
 
     def detach_volume(self, ebs_volume, volume_id):
-        detached = False
-        MAX_DETACHMENT_WAIT = 45
-        waited = 0
         logger.info('now detaching %s', volume_id)
-        while os.path.exists(ebs_volume.instance_device) and waited < MAX_DETACHMENT_WAIT:
-            logger.info('Waiting for device to detach: %s' %
-                        ebs_volume.instance_device)
-            detached = self.con.detach_volume(volume_id)
-            sleep(1)
-            waited += 1
-
-        if waited == MAX_DETACHMENT_WAIT:
-            error_format = 'Device didnt detach within % seconds'
-            raise exceptions.DetachmentException(
-                error_format, MAX_DETACHMENT_WAIT)
+        detached = self.con.detach_volume(volume_id)
+        self.wait_for_volume(
+            volume_id, 'detached', self.VOLUME_DETACH_TIMEOUT,
+            exceptions.DetachmentException)
+        self.wait_for_device(
+            ebs_volume.instance_device, False, self.VOLUME_DETACH_TIMEOUT,
+            exceptions.DetachmentException)
 
         return detached
 
+    def wait_for_volume(self, volume_id, state, timeout, exception_class):
+        '''
+        Waits for the volume to become available, in-use or detached,
+        using the batched polling of the shared volume waiter
+        '''
+        try:
+            return self.volume_waiter.wait(volume_id, state, timeout=timeout)
+        except exceptions.WaitTimeout, e:
+            raise exception_class(str(e))
+
+    def wait_for_device(self, device, exists, timeout, exception_class):
+        '''
+        The device shows up (or disappears) shortly after the state change
+        '''
+        deadline = time.time() + timeout
+        while os.path.exists(device) != exists:
+            if time.time() > deadline:
+                error_format = 'Device %s didnt %s within %s seconds'
+                action = 'appear' if exists else 'disappear'
+                raise exception_class(error_format % (device, action, timeout))
+            logger.info('Waiting for device: %s', device)
+            sleep(1)
+
     def get_bdm(self):
         bdm = self.con.get_instance_attribute(
             self.instance_id, 'blockDeviceMapping')
         return bdm
 
     def get_expiration_tags(self):
+        # resources tagged in one run share their timestamps
+        now = self.tagged_at or datetime.now()
         tags = {
-            'expires': str(datetime.now() + timedelta(days=self.SNAPSHOT_EXPIRY_DAYS)),
-            'created': str(datetime.now()),
+            'expires': str(now + timedelta(days=self.SNAPSHOT_EXPIRY_DAYS)),
+            'created': str(now),
         }
         return tags
 
@@ -399,33 +752,86 @@ class Snapshotter(object):
             raise exceptions.MissingVolume(msg)
         return volume_id
 
-    def get_cached_snapshots(self):
-        if not getattr(self, '_snapshots', None):
-            tags = self.get_filter_tags()
-            filters = {}
-            for key, value in tags.iteritems():
-                filters['tag:%s' % key] = value
-            snapshots = self.con.get_all_snapshots(filters=filters)
-            self._snapshots = snapshots
-        return self._snapshots
+    def get_snapshot_filters(self, vol=None):
+        '''
+        The EC2 filters for finding our snapshots, when given a volume
+        only the snapshots of its mount point are matched
+        '''
+        tags = self.get_filter_tags()
+        if vol is not None:
+            tags['mount_point'] = vol.mount_point
+        filters = {}
+        for key, value in tags.iteritems():
+            filters['tag:%s' % key] = value
+        if self.SNAPSHOT_LOOKUP_DAYS:
+            today = datetime.utcnow().date()
+            filters['start-time'] = get_start_time_filter(
+                today - timedelta(days=self.SNAPSHOT_LOOKUP_DAYS - 1), today)
+        return filters
+
+    def fetch_snapshots(self, filters):
+        if self.catalog:
+            return self.catalog.get_snapshots(filters)
+        return list(iter_snapshots(
+            self.con, filters=filters, page_size=self.SNAPSHOT_PAGE_SIZE))
+
+    def get_cached_snapshots(self, vol=None):
+        '''
+        The snapshots matching the filter tags, cached till the snapshot
+        cache is cleared
 
-    def get_snapshot(self, vol):
-        """ Returns the ID of the most recent snapshot that matches the given tags, or None
-            if no snapshots were found.
+        Given a volume only the snapshots of its mount point are fetched,
+        get_snapshot looks them up through here
+        '''
+        snapshots = getattr(self, '_snapshots', None)
+        if snapshots is None:
+            snapshots = self._snapshots = {}
+        mount_point = vol.mount_point if vol is not None else None
+        if mount_point not in snapshots:
+            snapshots[mount_point] = self.fetch_snapshots(
+                self.get_snapshot_filters(vol))
+        return snapshots[mount_point]
+
+    def get_snapshot_index(self, vol=None):
+        '''
+        Maps every mount_point to its snapshots, the most recent first
+
+        The index is built once per refresh of get_cached_snapshots
+        '''
+        snapshots = self.get_cached_snapshots(vol)
+        indexes = getattr(self, '_snapshot_index', None)
+        if indexes is None:
+            indexes = self._snapshot_index = {}
+        mount_point = vol.mount_point if vol is not None else None
+        indexed_snapshots, index = indexes.get(mount_point, (None, None))
+        if indexed_snapshots is not snapshots:
+            index = {}
+            for snapshot in snapshots:
+                snapshot_mount_point = snapshot.tags.get('mount_point')
+                index.setdefault(snapshot_mount_point, []).append(snapshot)
+            for volume_snapshots in index.values():
+                volume_snapshots.sort(
+                    key=lambda s: s.start_time, reverse=True)
+            indexes[mount_point] = (snapshots, index)
+        return index
+
+    def get_volume_snapshots(self, vol):
+        '''
+        The snapshots of the volume, the most recent first
+        '''
+        return self.get_snapshot_index(vol).get(vol.mount_point, [])
 
-            tags is a dict, used to filter the results from get_all_snapshots.
+    def get_snapshot(self, vol):
+        """ Returns the most recent snapshot that matches the given tags and
+            the mount point of the volume
 
-            This relies on the fact that the API returns snapshots in the order they
-            are created, so we can just return the last element of the list.
+            Raises MissingSnapshot if no snapshots were found.
         """
-        all_snapshots = self.get_cached_snapshots()
-        all_snapshots.sort(key=lambda s: s.start_time, reverse=True)
-        volume_snapshots = [s for s in all_snapshots if s.tags.get(
-            'mount_point') == vol.mount_point]
-        try:
-            latest_snapshot = volume_snapshots[0]
-        except IndexError, e:
-            raise exceptions.MissingSnapshot(e.message)
+        volume_snapshots = self.get_volume_snapshots(vol)
+        if not volume_snapshots:
+            raise exceptions.MissingSnapshot(
+                'No snapshot found for %s' % vol.mount_point)
+        latest_snapshot = volume_snapshots[0]
         return latest_snapshot
 
     def get_snapshot_description_string(self):
@@ -447,6 +853,56 @@ class Snapshotter(object):
     Shortcuts
     '''
 
+    def load_instance_data(self):
+        '''
+        Fetches the userdata and metadata we don't have yet, concurrently
+        '''
+        with self.instance_data_lock:
+            missing = []
+            if self._userdata is None:
+                missing.append(('_userdata', get_userdata_dict))
+            if self._metadata is None:
+                missing.append(('_metadata', get_metadata_dict))
+            outcomes = map_concurrently(
+                lambda item: item[1](), missing, len(missing))
+            for (attribute, _), (value, error) in zip(missing, outcomes):
+                if error is not None:
+                    raise error
+                setattr(self, attribute, value)
+
+    @property
+    def userdata(self):
+        if self._userdata is None:
+            self.load_instance_data()
+        return self._userdata
+
+    @userdata.setter
+    def userdata(self, userdata):
+        self._userdata = userdata
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self.load_instance_data()
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
+
+    @property
+    def bdm(self):
+        if self._bdm is None:
+            # concurrent workers share a single lookup
+            with self.instance_data_lock:
+                if self._bdm is None:
+                    self._bdm = self.get_bdm()
+        return self._bdm
+
+    @bdm.setter
+    def bdm(self, bdm):
+        self._bdm = bdm
+
     @property
     def instance_id(self):
         instance_id = self.metadata['instance-id']
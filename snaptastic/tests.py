@@ -1,6 +1,8 @@
 import sys
 import os
 import subprocess
+import time
+from datetime import datetime, timedelta
 
 path = os.path.abspath(__file__)
 parent = os.path.join(path, '../', '../')
@@ -9,18 +11,62 @@ sys.path.append(parent)
 import unittest2
 import mock
 from snaptastic import EBSVolume
-from snaptastic.freeze import freeze
+from snaptastic.freeze import freeze, FreezeStats
 from snaptastic import Snapshotter
 from snaptastic.ebs_volume import FILESYSTEMS as FS
 from snaptastic import exceptions
 
 
+class Page(list):
+    '''
+    A page of results as returned by boto's get_list
+    '''
+    next_token = None
+
+
 class BaseTest(unittest2.TestCase):
     def setUp(self):
         pass
 
+    def get_pages(self, *pages):
+        results = [Page(page) for page in pages]
+        for page, next_page in zip(results, results[1:]):
+            page.next_token = 'token-%s' % id(next_page)
+        return results
+
+    def get_snapshot(self, snapshot_id, start_time=None, tags=None, **kwargs):
+        '''
+        A boto snapshot, start_time is a datetime or an EC2 timestamp and
+        defaults to now
+        '''
+        if start_time is None:
+            start_time = datetime.utcnow()
+        if isinstance(start_time, datetime):
+            start_time = start_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        attributes = dict(volume_id='vol-1', volume_size=5, status='completed',
+                          description='', owner_id='1')
+        attributes.update(kwargs)
+        return mock.Mock(id=snapshot_id, start_time=start_time,
+                         tags=dict(tags or {}), **attributes)
+
+    def no_delay(self):
+        '''
+        Lets the waiters poll without backing off
+        '''
+        return mock.patch('snaptastic.waiter.ResourceWaiter.get_delay',
+                          return_value=0)
+
+    def set_response(self, con, body, status=200):
+        '''
+        Sets the response of the raw requests made on the connection
+        '''
+        con._mexe.return_value.status = status
+        con._mexe.return_value.read.return_value = body
+
     def get_test_snapshotter(self):
         con = mock.Mock()
+        # not throttled, unless a test wraps it
+        con.throttler = None
         userdata = dict(role='role', environment='test', cluster='cluster')
         placement = dict(instance_id='a123')
         placement['availability-zone'] = 'test-az'
@@ -31,7 +77,7 @@ class BaseTest(unittest2.TestCase):
         mapping['/dev/sdf'] = mock.Mock()
         bdm['blockDeviceMapping'] = mapping
         snap = Snapshotter(userdata, metadata, con, bdm)
-        snap.wait_before_attempt = mock.Mock()
+        snap.freeze_stats = FreezeStats()
         return snap
 
 
@@ -68,6 +114,113 @@ class TestFreeze(BaseTest):
                     check.assert_called_with(
                         [fs.freeze_cmd, '-u', '/mnt/test'], stderr=subprocess.STDOUT)
 
+    def test_freeze_stats(self):
+        stats = FreezeStats()
+        with mock.patch('subprocess.check_output'):
+            with mock.patch('snaptastic.utils.is_root_dev', return_value=False):
+                vol = EBSVolume("/dev/sdf", "/mnt/test", size=1,
+                                check_support=False)
+                for _ in range(3):
+                    with vol.freeze(stats=stats):
+                        pass
+        summary = stats.summary()
+        self.assertEqual(summary['count'], 3)
+        for segment in FreezeStats.SEGMENTS:
+            self.assertGreaterEqual(summary[segment]['p99'], 0)
+        self.assertEqual(stats.summary('/mnt/other')['count'], 0)
+        recorded = stats.freezes[0]
+        self.assertEqual(recorded['filesystem'], 'xfs')
+        self.assertEqual(recorded['mount_point'], '/mnt/test')
+
+    def test_pre_freeze_flush(self):
+        stats = FreezeStats()
+        vol = EBSVolume("/dev/sdf", "/mnt/test", size=1, check_support=False,
+                        flush_passes=5)
+        # 3 passes: 1000 -> 400 -> 100 -> 100, then 40 under the freeze
+        dirty = [1000, 400, 100, 100, 60]
+        with mock.patch('subprocess.check_output'):
+            with mock.patch('snaptastic.utils.is_root_dev', return_value=False):
+                with mock.patch('snaptastic.utils.syncfs') as syncfs:
+                    with mock.patch('snaptastic.utils.get_dirty_bytes',
+                                    side_effect=dirty):
+                        with vol.freeze(stats=stats):
+                            pass
+        self.assertEqual(syncfs.call_count, 3)
+        recorded = stats.freezes[0]
+        self.assertEqual(recorded['flushed_pre_freeze'], 900)
+        self.assertEqual(recorded['flushed_under_freeze'], 40)
+
+    def test_group_flushes_before_freezing(self):
+        from snaptastic.freeze import FreezeGroup
+        calls = []
+        volumes = [EBSVolume("/dev/sdf", mount_point, size=1,
+                             check_support=False, flush_passes=2)
+                   for mount_point in ('/mnt/a', '/mnt/b')]
+        with mock.patch('subprocess.check_output',
+                        side_effect=lambda args, **kwargs: calls.append(
+                            (args[1], args[2]))):
+            with mock.patch('snaptastic.utils.is_root_dev', return_value=False):
+                with mock.patch('snaptastic.utils.syncfs',
+                                side_effect=lambda mount_point: calls.append(
+                                    ('syncfs', mount_point))):
+                    with mock.patch('snaptastic.utils.get_dirty_bytes',
+                                    side_effect=range(100, 0, -10)):
+                        with FreezeGroup(vol.freeze() for vol in volumes):
+                            pass
+        self.assertEqual(calls, [
+            ('syncfs', '/mnt/a'), ('syncfs', '/mnt/a'),
+            ('syncfs', '/mnt/b'), ('syncfs', '/mnt/b'),
+            ('-f', '/mnt/a'), ('-f', '/mnt/b'),
+            ('-u', '/mnt/b'), ('-u', '/mnt/a')])
+
+    def test_freeze_stats_percentiles(self):
+        stats = FreezeStats()
+        for seconds in range(1, 101):
+            stats.record('/mnt/test', 'xfs', dict(
+                freeze=0, snapshot=seconds, thaw=0, total=seconds))
+        self.assertEqual(stats.percentile('total', 50), 50)
+        self.assertEqual(stats.percentile('total', 99), 99)
+        self.assertEqual(stats.percentile('total', 100), 100)
+
+    def test_freeze_stats_persisted(self):
+        import shutil
+        import tempfile
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'freeze-stats.jsonl')
+        # a run per process, like make-snapshots from cron
+        for run in range(5):
+            stats = FreezeStats(window=4, path=path)
+            for seconds in (run, run + 0.5):
+                stats.record('/mnt/test', 'xfs', dict(
+                    freeze=0, snapshot=seconds, thaw=0, total=seconds))
+        stats = FreezeStats(window=4, path=path)
+        self.assertEqual(stats.summary()['count'], 4)
+        self.assertEqual(stats.percentile('total', 100), 4.5)
+        self.assertEqual(stats.percentile('total', 0), 3)
+        # compacted once it holds twice the window
+        with open(path) as stats_file:
+            self.assertTrue(len(stats_file.readlines()) < 8)
+
+    def test_freeze_stats_per_snapshotter(self):
+        from snaptastic import settings
+        from snaptastic.freeze import get_freeze_stats
+        with mock.patch.object(settings, 'FREEZE_STATS_PATH',
+                               '/var/lib/snaptastic/freeze-stats.jsonl',
+                               create=True):
+            stats = get_freeze_stats('redis')
+            self.assertEqual(
+                stats.path, '/var/lib/snaptastic/freeze-stats-redis.jsonl')
+
+            class RedisSnapshotter(Snapshotter):
+                pass
+            snap = RedisSnapshotter({}, {}, mock.Mock(), {}, catalog=False)
+            self.assertEqual(snap.freeze_stats.path, '/var/lib/snaptastic/'
+                             'freeze-stats-RedisSnapshotter.jsonl')
+        with mock.patch.object(settings, 'FREEZE_STATS_PATH', None,
+                               create=True):
+            self.assertIsNone(get_freeze_stats('redis').path)
+
 
 class TestCreateSnapshot(BaseTest):
     def test_make_snapshots(self):
@@ -95,6 +248,166 @@ class TestCreateSnapshot(BaseTest):
         description = kwargs['description']
         self.assertEqual(description, 'cluster snapshot of /mnt/test')
 
+    def test_make_snapshots_concurrently(self):
+        snap = self.get_test_snapshotter()
+        snap.SNAPSHOT_CONCURRENCY = 4
+        volumes = [EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test%s' % i, size=5,
+            check_support=False) for i in range(6)]
+        snap.make_snapshot = lambda vol: vol.mount_point
+        snap.pre_snapshot = mock.Mock()
+        snap.post_snapshot = mock.Mock()
+        snapshots = snap.make_snapshots(volumes)
+        self.assertEqual(snapshots, [v.mount_point for v in volumes])
+        self.assertEqual(snap.pre_snapshot.call_count, 6)
+        self.assertEqual(snap.post_snapshot.call_count, 6)
+
+    def test_make_snapshots_collects_failures(self):
+        snap = self.get_test_snapshotter()
+        snap.SNAPSHOT_CONCURRENCY = 4
+        volumes = [EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test%s' % i, size=5,
+            check_support=False) for i in range(3)]
+
+        def make_snapshot(vol):
+            if vol is volumes[1]:
+                raise ValueError('boom')
+            return vol.mount_point
+        snap.make_snapshot = make_snapshot
+        with self.assertRaises(exceptions.PartialFailure) as context:
+            snap.make_snapshots(volumes)
+        failure = context.exception
+        self.assertEqual(failure.results, ['/mnt/test0', None, '/mnt/test2'])
+        self.assertEqual([v for v, e in failure.errors], [volumes[1]])
+
+    def test_make_group_snapshots(self):
+        snap = self.get_test_snapshotter()
+        snap.bdm['blockDeviceMapping']['/dev/sdg'] = mock.Mock()
+        volumes = [
+            EBSVolume(device='/dev/sdf', mount_point='/mnt/test', size=5,
+                      check_support=False),
+            EBSVolume(device='/dev/sdg', mount_point='/mnt/test2', size=5,
+                      check_support=False)]
+        with mock.patch('subprocess.check_output') as check:
+            with mock.patch('snaptastic.utils.is_root_dev', return_value=False):
+                snapshots = snap.make_snapshots(
+                    volumes, consistency_group=True)
+        self.assertEqual(len(snapshots), 2)
+        self.assertEqual(snap.con.create_snapshot.call_count, 2)
+        commands = [args[0][:2] for args, kwargs in check.call_args_list]
+        self.assertEqual(commands, [
+            ['xfs_freeze', '-f'], ['xfs_freeze', '-f'],
+            ['xfs_freeze', '-u'], ['xfs_freeze', '-u']])
+
+    def test_make_group_snapshots_failure(self):
+        snap = self.get_test_snapshotter()
+        snap.bdm['blockDeviceMapping']['/dev/sdf'].volume_id = 'vol-a'
+        snap.bdm['blockDeviceMapping']['/dev/sdg'] = mock.Mock(
+            volume_id='vol-b')
+        volumes = [
+            EBSVolume(device='/dev/sdf', mount_point='/mnt/a', size=5,
+                      check_support=False),
+            EBSVolume(device='/dev/sdg', mount_point='/mnt/b', size=5,
+                      check_support=False)]
+
+        def create_snapshot(volume_id, description=None):
+            if volume_id == 'vol-b':
+                raise ValueError('boom')
+            return mock.Mock(id='snap-a')
+        snap.con.create_snapshot.side_effect = create_snapshot
+        with mock.patch('subprocess.check_output'):
+            with mock.patch('snaptastic.utils.is_root_dev', return_value=False):
+                with self.assertRaises(exceptions.PartialFailure) as context:
+                    snap.make_snapshots(volumes, consistency_group=True)
+        # the snapshot of /mnt/a alone isn't a consistent point in time
+        snap.con.delete_snapshot.assert_called_once_with('snap-a')
+        self.assertEqual(snap.con.create_tags.call_count, 0)
+        errors = [e for v, e in context.exception.errors]
+        self.assertIsInstance(errors[0], exceptions.DependencyFailure)
+        self.assertIsInstance(errors[1], ValueError)
+        self.assertEqual(context.exception.results, [None, None])
+
+    def test_group_freeze_failure_thaws(self):
+        from snaptastic.freeze import FreezeGroup
+        frozen = mock.MagicMock()
+        failing = mock.MagicMock()
+        failing.__enter__.side_effect = ValueError('boom')
+        with self.assertRaises(ValueError):
+            with FreezeGroup([frozen, failing]):
+                pass
+        self.assertEqual(frozen.__exit__.call_count, 1)
+        self.assertEqual(failing.__exit__.call_count, 0)
+
+    def test_bulk_add_tags(self):
+        from snaptastic.utils import bulk_add_tags
+        con = mock.Mock()
+        first = mock.Mock(id='snap-1', tags={})
+        second = mock.Mock(id='vol-1', tags={})
+        third = mock.Mock(id='vol-2', tags={})
+        bulk_add_tags(con, [
+            (first, dict(role='db', mount_point='/mnt/a')),
+            (second, dict(role='db', mount_point='/mnt/b')),
+            (third, dict(role='db', mount_point='/mnt/b'))])
+        calls = sorted(args for args, kwargs in con.create_tags.call_args_list)
+        # a request per resource, unless their tags are identical
+        self.assertEqual(calls, [
+            (['snap-1'], dict(role='db', mount_point='/mnt/a')),
+            (['vol-1', 'vol-2'], dict(role='db', mount_point='/mnt/b'))])
+        self.assertEqual(second.tags, dict(role='db', mount_point='/mnt/b'))
+
+    def test_make_snapshots_tags(self):
+        snap = self.get_test_snapshotter()
+        snap.bdm['blockDeviceMapping']['/dev/sdg'] = mock.Mock()
+        created = [mock.Mock(id='snap-1', tags={}),
+                   mock.Mock(id='snap-2', tags={})]
+
+        def create_snapshot(volume_id, description=None):
+            # the previous snapshot is tagged before the next one is made
+            self.assertEqual(snap.con.create_tags.call_count,
+                             snap.con.create_snapshot.call_count - 1)
+            return created[snap.con.create_snapshot.call_count - 1]
+        snap.con.create_snapshot.side_effect = create_snapshot
+        volumes = [
+            EBSVolume(device='/dev/sdf', mount_point='/mnt/test', size=5,
+                      check_support=False),
+            EBSVolume(device='/dev/sdg', mount_point='/mnt/test2', size=5,
+                      check_support=False)]
+        with mock.patch('subprocess.check_output'):
+            with mock.patch('snaptastic.utils.is_root_dev', return_value=False):
+                snap.make_snapshots(volumes)
+        # a request per snapshot, with the same timestamps
+        self.assertEqual(snap.con.create_tags.call_count, 2)
+        tags = [args[1] for args, kwargs in snap.con.create_tags.call_args_list]
+        self.assertEqual(tags[0]['created'], tags[1]['created'])
+        self.assertNotEqual(tags[0]['mount_point'], tags[1]['mount_point'])
+
+    def test_tag_on_create(self):
+        snap = self.get_test_snapshotter()
+        snap.TAG_ON_CREATE = True
+        snap.con.APIVersion = '2014-10-01'
+        self.set_response(snap.con, '<CreateSnapshotResponse><snapshotId>'
+                          'snap-1</snapshotId></CreateSnapshotResponse>')
+        volume = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test', size=5,
+            check_support=False)
+        with mock.patch('subprocess.check_output'):
+            with mock.patch('snaptastic.utils.is_root_dev', return_value=False):
+                snapshots = snap.make_snapshots([volume])
+        self.assertEqual(snapshots[0].id, 'snap-1')
+        self.assertEqual(snap.con.create_tags.call_count, 0)
+        self.assertEqual(snap.con.create_snapshot.call_count, 0)
+        args, kwargs = snap.con.build_base_http_request.call_args
+        params = args[3]
+        self.assertEqual(params['Action'], 'CreateSnapshot')
+        self.assertEqual(params['Version'], '2016-11-15')
+        self.assertEqual(params['TagSpecification.1.ResourceType'], 'snapshot')
+        tags = dict((params['TagSpecification.1.Tag.%s.Key' % i],
+                     params['TagSpecification.1.Tag.%s.Value' % i])
+                    for i in range(1, 8))
+        self.assertEqual(tags['mount_point'], '/mnt/test')
+        # the shared connection keeps its own version
+        self.assertEqual(snap.con.APIVersion, '2014-10-01')
+
     def test_snapshot_name(self):
         snap = self.get_test_snapshotter()
         volume = EBSVolume(
@@ -110,9 +423,9 @@ class TestMounting(BaseTest):
         volume = EBSVolume(
             device='/dev/sdf', mount_point='/mnt/test', size=5,
             check_support=False)
-        snap.get_snapshot = mock.Mock()
+        snap.get_snapshot = mock.Mock(
+            return_value=mock.Mock(status='completed'))
         snap.attach_volume = mock.Mock()
-        snap.wait_for_snapshots = mock.Mock()
         with mock.patch('subprocess.check_output'):
             with mock.patch('os.makedirs'):
                 snap.mount_snapshots([volume])
@@ -122,29 +435,224 @@ class TestMounting(BaseTest):
         volume = EBSVolume(
             device='/dev/sdf', mount_point='/mnt/test', size=5, iops=1600,
             check_support=False)
-        snap.get_snapshot = mock.Mock()
+        snap.get_snapshot = mock.Mock(
+            return_value=mock.Mock(status='completed'))
         snap.attach_volume = mock.Mock()
-        snap.wait_for_snapshots = mock.Mock()
         with mock.patch('subprocess.check_output'):
             with mock.patch('os.makedirs'):
                 snap.mount_snapshots([volume])
 
-    def test_not_ready_snapshots_max_retries(self):
+    def test_mount_dependencies(self):
         snap = self.get_test_snapshotter()
-        not_ready_snapshot = mock.Mock()
-        snap.get_snapshot = mock.Mock(return_value=not_ready_snapshot)
-        try:
-            snap.wait_for_snapshots(['volume 1'], max_retries=3)
-        except exceptions.MissingSnapshot:
-            pass
-        assert snap.wait_before_attempt.call_count == 3
+        volumes = [EBSVolume(device='/dev/sdf', mount_point=mount_point,
+                             check_support=False) for mount_point in
+                   ['/var/lib/postgresql/main', '/var/lib', '/srv',
+                    '/var/lib/postgresql', '/var/libs']]
+        dependencies = snap.get_mount_dependencies(volumes)
+        self.assertEqual(dependencies, {0: [3], 3: [1]})
 
-    def test_not_ready_snapshots_exit(self):
+    def test_mount_snapshots_nested(self):
         snap = self.get_test_snapshotter()
-        not_ready_snapshot = mock.Mock()
+        snap.MOUNT_CONCURRENCY = 4
+        volumes = [EBSVolume(device='/dev/sdf', mount_point=mount_point,
+                             check_support=False) for mount_point in
+                   ['/var/lib/postgresql', '/srv', '/var/lib']]
+        mounted = []
+
+        def mount_snapshot(vol):
+            mounted.append(vol.mount_point)
+        snap.mount_snapshot = mount_snapshot
+        snap.mount_snapshots(volumes)
+        self.assertEqual(len(mounted), 3)
+        self.assertLess(mounted.index('/var/lib'),
+                        mounted.index('/var/lib/postgresql'))
+
+    def test_mount_snapshots_failed_parent(self):
+        snap = self.get_test_snapshotter()
+        snap.MOUNT_CONCURRENCY = 4
+        volumes = [EBSVolume(device='/dev/sdf', mount_point=mount_point,
+                             check_support=False) for mount_point in
+                   ['/var/lib/postgresql', '/var/lib']]
+        snap.mount_snapshot = mock.Mock(
+            side_effect=exceptions.MountException('boom'))
+        with self.assertRaises(exceptions.PartialFailure) as context:
+            snap.mount_snapshots(volumes)
+        errors = [e for v, e in context.exception.errors]
+        self.assertIsInstance(errors[0], exceptions.DependencyFailure)
+        self.assertIsInstance(errors[1], exceptions.MountException)
+        self.assertEqual(snap.mount_snapshot.call_count, 1)
+
+    def test_mount_snapshots_device_exists(self):
+        snap = self.get_test_snapshotter()
+        volumes = [EBSVolume(device='/dev/sdf', mount_point=mount_point,
+                             check_support=False) for mount_point in
+                   ['/mnt/a', '/mnt/b', '/mnt/c']]
+        snap.mount_snapshot = mock.Mock(
+            side_effect=exceptions.DeviceAlreadyExists('exists'))
+        with self.assertRaises(exceptions.DeviceAlreadyExists):
+            snap.mount_snapshots(volumes)
+        self.assertEqual(snap.mount_snapshot.call_count, 1)
+
+        snap.mount_snapshot.reset_mock()
+        snap.mount_snapshots(volumes, ignore_mounted=True)
+        self.assertEqual(snap.mount_snapshot.call_count, 3)
+
+    def test_create_volume_tag_on_create(self):
+        snap = self.get_test_snapshotter()
+        snap.TAG_ON_CREATE = True
+        snap.con.APIVersion = '2016-11-15'
+        self.set_response(snap.con, '<CreateVolumeResponse><volumeId>'
+                          'vol-1</volumeId></CreateVolumeResponse>')
+        volume = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test', size=5, iops=100,
+            check_support=False)
+        with mock.patch('os.path.exists', return_value=False):
+            boto_volume = snap.create_volume(volume, snapshot_id='snap-1')
+        self.assertEqual(boto_volume.id, 'vol-1')
+        args, kwargs = snap.con.build_base_http_request.call_args
+        params = args[3]
+        self.assertEqual(params['Action'], 'CreateVolume')
+        self.assertEqual(params['SnapshotId'], 'snap-1')
+        self.assertEqual(params['Iops'], '100')
+        self.assertEqual(params['TagSpecification.1.ResourceType'], 'volume')
+        self.assertEqual(snap.con.create_tags.call_count, 0)
+
+    def test_unmount_snapshots_nested(self):
+        snap = self.get_test_snapshotter()
+        snap.MOUNT_CONCURRENCY = 4
+        volumes = [EBSVolume(device='/dev/sdf', mount_point=mount_point,
+                             check_support=False) for mount_point in
+                   ['/var/lib', '/srv', '/var/lib/postgresql']]
+        unmounted = []
+        snap._unmount_volume = lambda vol: unmounted.append(vol.mount_point)
+        snap.unmount_snapshots(volumes)
+        self.assertEqual(len(unmounted), 3)
+        self.assertLess(unmounted.index('/var/lib/postgresql'),
+                        unmounted.index('/var/lib'))
+
+    def test_not_ready_snapshots_timeout(self):
+        snap = self.get_test_snapshotter()
+        not_ready_snapshot = mock.Mock(id='snap-1', status='pending')
         snap.get_snapshot = mock.Mock(return_value=not_ready_snapshot)
+        snap.con.get_all_snapshots.return_value = [not_ready_snapshot]
+        with self.no_delay():
+            with self.assertRaises(exceptions.MissingSnapshot):
+                snap.wait_for_snapshots(['volume 1'], timeout=0.1)
+
+    def test_snapshots_become_ready(self):
+        snap = self.get_test_snapshotter()
+        pending = dict((i, mock.Mock(id=i, status='pending'))
+                       for i in ('snap-1', 'snap-2'))
+        snap.get_snapshot = mock.Mock(side_effect=lambda vol: pending[vol])
+        snap.con.get_all_snapshots.side_effect = lambda snapshot_ids: [
+            mock.Mock(id=i, status='completed') for i in snapshot_ids]
+        with self.no_delay():
+            snap.wait_for_snapshots(['snap-1', 'snap-2'])
+        polled = set()
+        for args, kwargs in snap.con.get_all_snapshots.call_args_list:
+            polled.update(kwargs['snapshot_ids'])
+        self.assertEqual(polled, set(['snap-1', 'snap-2']))
+
+    def test_mount_waits_for_own_snapshot(self):
+        snap = self.get_test_snapshotter()
+        volume = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test', size=5,
+            check_support=False)
+        pending = mock.Mock(id='snap-1', status='pending')
+        completed = mock.Mock(id='snap-1', status='completed')
+        snap.get_snapshot = mock.Mock(return_value=pending)
+        snap.con.get_all_snapshots.return_value = [completed]
+        snap.create_volume = mock.Mock()
+        snap.attach_volume = mock.Mock()
+        with self.no_delay():
+            with mock.patch('subprocess.check_output'):
+                with mock.patch('os.makedirs'):
+                    snap.mount_snapshot(volume)
+        snap.create_volume.assert_called_with(volume, snapshot_id=completed)
+
+    def test_get_snapshot(self):
+        snap = self.get_test_snapshotter()
+        volume = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test', size=5,
+            check_support=False)
+        snapshots = [
+            self.get_snapshot('snap-1', '2013-01-01T00:00:00.000Z',
+                              dict(mount_point='/mnt/test')),
+            self.get_snapshot('snap-2', '2013-01-03T00:00:00.000Z',
+                              dict(mount_point='/mnt/other')),
+            self.get_snapshot('snap-3', '2013-01-02T00:00:00.000Z',
+                              dict(mount_point='/mnt/test'))]
+        snapshots = [s for s in snapshots
+                     if s.tags['mount_point'] == '/mnt/test']
+        snap.con.get_list.side_effect = self.get_pages(
+            snapshots[:1], snapshots[1:])
+        self.assertIs(snap.get_snapshot(volume), snapshots[1])
+        self.assertIs(snap.get_snapshot(volume), snapshots[1])
+        self.assertEqual(snap.con.get_list.call_count, 2)
+        args, kwargs = snap.con.build_filter_params.call_args
+        self.assertEqual(args[1]['tag:mount_point'], '/mnt/test')
+
+        newer = self.get_snapshot('snap-4', '2013-01-04T00:00:00.000Z',
+                                  dict(mount_point='/mnt/test'))
+        snap.con.get_list.side_effect = self.get_pages(snapshots + [newer])
+        snap.clear_snapshot_cache()
+        self.assertIs(snap.get_snapshot(volume), newer)
+
+        missing = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/missing', size=5,
+            check_support=False)
+        snap.con.get_list.side_effect = self.get_pages([])
         with self.assertRaises(exceptions.MissingSnapshot):
-            snap.wait_for_snapshots(['volume 1'])
+            snap.get_snapshot(missing)
+
+    def test_get_cached_snapshots(self):
+        snap = self.get_test_snapshotter()
+        snapshots = [self.get_snapshot('snap-1', '2013-01-01T00:00:00.000Z',
+                                       dict(mount_point='/mnt/test'))]
+        snap.con.get_list.side_effect = self.get_pages(snapshots)
+        self.assertEqual(snap.get_cached_snapshots(), snapshots)
+        self.assertEqual(snap.get_cached_snapshots(), snapshots)
+        self.assertEqual(snap.con.get_list.call_count, 1)
+        args, kwargs = snap.con.build_filter_params.call_args
+        self.assertNotIn('tag:mount_point', args[1])
+        snap.clear_snapshot_cache()
+        snap.con.get_list.side_effect = self.get_pages(snapshots)
+        snap.get_cached_snapshots()
+        self.assertEqual(snap.con.get_list.call_count, 2)
+
+    def test_get_snapshot_uses_cached_snapshots(self):
+        snap = self.get_test_snapshotter()
+        volume = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test', size=5,
+            check_support=False)
+        latest = self.get_snapshot('snap-1', '2013-01-02T00:00:00.000Z',
+                                   dict(mount_point='/mnt/test'))
+        other = self.get_snapshot('snap-2', '2013-01-03T00:00:00.000Z',
+                                  dict(mount_point='/mnt/other'))
+        # eg. a subclass returning the snapshots of all mount points
+        snap.get_cached_snapshots = mock.Mock(return_value=[other, latest])
+        self.assertIs(snap.get_snapshot(volume), latest)
+        snap.get_cached_snapshots.assert_called_with(volume)
+        self.assertEqual(snap.con.get_list.call_count, 0)
+
+    def test_snapshot_index(self):
+        snap = self.get_test_snapshotter()
+        volume = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test', size=5,
+            check_support=False)
+        snapshots = [self.get_snapshot('snap-%s' % day, datetime(2013, 1, day),
+                                       dict(mount_point='/mnt/test'))
+                     for day in (1, 3, 2)]
+        snap.get_cached_snapshots = mock.Mock(return_value=snapshots)
+        index = snap.get_snapshot_index(volume)
+        self.assertEqual(index['/mnt/test'],
+                         [snapshots[1], snapshots[2], snapshots[0]])
+        # built once per list of cached snapshots
+        self.assertIs(snap.get_snapshot_index(volume), index)
+        snap.get_cached_snapshots.return_value = snapshots[:1]
+        self.assertIs(snap.get_snapshot(volume), snapshots[0])
+        snap.clear_snapshot_cache()
+        self.assertIsNot(snap.get_snapshot_index(volume), index)
 
     def test_ready_snapshots(self):
         snap = self.get_test_snapshotter()
@@ -154,6 +662,1018 @@ class TestMounting(BaseTest):
         snap.wait_for_snapshots(['volume 1'])
 
 
+class TestWaiter(BaseTest):
+    def get_volume(self, volume_id, status, attach_status=None):
+        volume = mock.Mock()
+        volume.id = volume_id
+        volume.status = status
+        volume.attach_data.status = attach_status
+        return volume
+
+    def test_batched_polling(self):
+        from snaptastic.utils.concurrency import map_concurrently
+        from snaptastic.waiter import VolumeWaiter
+        con = mock.Mock()
+        con.get_all_volumes.return_value = [
+            self.get_volume('vol-1', 'available'),
+            self.get_volume('vol-2', 'in-use', 'attached')]
+        waiter = VolumeWaiter(con)
+        with self.no_delay():
+            outcomes = map_concurrently(
+                lambda request: waiter.wait(*request, timeout=5),
+                [('vol-1', 'available'), ('vol-2', 'in-use')], workers=2)
+        self.assertEqual([r.id for r, e in outcomes], ['vol-1', 'vol-2'])
+        for args, kwargs in con.get_all_volumes.call_args_list:
+            self.assertTrue(len(kwargs['volume_ids']) <= 2)
+
+    def test_detached(self):
+        from snaptastic.waiter import VolumeWaiter
+        con = mock.Mock()
+        con.get_all_volumes.side_effect = [
+            [self.get_volume('vol-1', 'in-use', 'detaching')],
+            [self.get_volume('vol-1', 'available')]]
+        waiter = VolumeWaiter(con)
+        with self.no_delay():
+            volume = waiter.wait('vol-1', 'detached', timeout=5)
+        self.assertEqual(volume.status, 'available')
+        self.assertGreaterEqual(con.get_all_volumes.call_count, 2)
+
+    def test_not_found_isolated(self):
+        from snaptastic.utils.concurrency import map_concurrently
+        from snaptastic.waiter import ResourceWaiter
+
+        def describe(volume_ids):
+            if 'vol-gone' in volume_ids:
+                error = Exception('vol-gone does not exist')
+                error.error_code = 'InvalidVolume.NotFound'
+                raise error
+            return [self.get_volume(v, 'available') for v in volume_ids]
+        describe = mock.Mock(side_effect=describe)
+        waiter = ResourceWaiter(describe, 'volume')
+        waiter.has_state = lambda volume, state: volume.status == state
+        with self.no_delay():
+            outcomes = map_concurrently(
+                lambda volume_id: waiter.wait(
+                    volume_id, 'available', timeout=0.5),
+                ['vol-1', 'vol-gone'], workers=2)
+        self.assertEqual(outcomes[0][0].id, 'vol-1')
+        self.assertIsInstance(outcomes[1][1], exceptions.WaitTimeout)
+        self.assertIn('vol-gone', waiter.missing)
+        # once isolated the other ids are described without it
+        self.assertIn(mock.call(['vol-1']), describe.call_args_list)
+
+    def test_new_resource_interrupts_backoff(self):
+        import threading
+        from snaptastic.waiter import VolumeWaiter
+        con = mock.Mock()
+        con.get_all_volumes.side_effect = lambda volume_ids: [
+            self.get_volume(v, 'creating' if v == 'vol-1' else 'available')
+            for v in volume_ids]
+        waiter = VolumeWaiter(con)
+        waiter.MIN_DELAY = waiter.MAX_DELAY = 30
+        slow = threading.Thread(target=lambda: self.assertRaises(
+            exceptions.WaitTimeout, waiter.wait, 'vol-1', 'available',
+            timeout=1))
+        slow.start()
+        # the poller is backed off for 15 to 30 seconds now
+        while not con.get_all_volumes.called:
+            time.sleep(0.01)
+        started = time.time()
+        self.assertEqual(waiter.wait('vol-2', 'available', timeout=5).id,
+                         'vol-2')
+        self.assertLess(time.time() - started, 1)
+        slow.join()
+        # nobody waits for them anymore
+        self.assertEqual(waiter.observed, {})
+
+    def test_timeout(self):
+        from snaptastic.waiter import VolumeWaiter
+        con = mock.Mock()
+        con.get_all_volumes.return_value = [
+            self.get_volume('vol-1', 'creating')]
+        waiter = VolumeWaiter(con)
+        with self.no_delay():
+            with self.assertRaises(exceptions.WaitTimeout):
+                waiter.wait('vol-1', 'available', timeout=0.1)
+
+    def test_attach_volume(self):
+        snap = self.get_test_snapshotter()
+        snap.wait_for_volume = mock.Mock()
+        volume = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test', size=5,
+            check_support=False)
+        boto_volume = mock.Mock()
+        with mock.patch('os.path.exists', return_value=True):
+            snap.attach_volume(volume, boto_volume)
+        states = [args[1] for args, kwargs in
+                  snap.wait_for_volume.call_args_list]
+        self.assertEqual(states, ['available', 'in-use'])
+        snap.con.attach_volume.assert_called_with(
+            boto_volume.id, 'instance-id', '/dev/sdf')
+
+
+class TestHydrate(BaseTest):
+    def test_hydrate(self):
+        from snaptastic.hydrate import Hydrator, MB
+        progress = mock.Mock()
+        hydrator = Hydrator('/dev/xvdf', concurrency=4, chunk_size=4 * MB,
+                            progress=progress)
+        hydrator.get_device_size = mock.Mock(return_value=10 * MB)
+        with mock.patch('subprocess.check_output') as check:
+            self.assertEqual(hydrator.run(), 10 * MB)
+        commands = sorted(' '.join(args[0]) for args, kwargs
+                          in check.call_args_list)
+        self.assertEqual(commands, [
+            'dd if=/dev/xvdf of=/dev/null bs=1M iflag=direct skip=0 count=4',
+            'dd if=/dev/xvdf of=/dev/null bs=1M iflag=direct skip=4 count=4',
+            'dd if=/dev/xvdf of=/dev/null bs=1M iflag=direct skip=8 count=2'])
+        progress.assert_called_with(10 * MB, 10 * MB)
+
+    def test_hydrate_failure(self):
+        from snaptastic.hydrate import Hydrator, MB
+        hydrator = Hydrator('/dev/xvdf', chunk_size=4 * MB)
+        hydrator.get_device_size = mock.Mock(return_value=8 * MB)
+        error = subprocess.CalledProcessError(1, 'dd')
+        with mock.patch('subprocess.check_output', side_effect=error):
+            with self.assertRaises(exceptions.HydrationException):
+                hydrator.run()
+
+    def test_token_bucket(self):
+        from snaptastic.utils.concurrency import TokenBucket
+        bucket = TokenBucket(rate=10, capacity=10)
+        self.assertEqual(bucket.acquire(10), 0)
+        with mock.patch('time.sleep') as sleep:
+            bucket.acquire(5)
+        self.assertTrue(sleep.called)
+
+    def test_mount_hydrates_restored_volume(self):
+        import threading
+        snap = self.get_test_snapshotter()
+        snap.HYDRATE_VOLUMES = True
+        volumes = [EBSVolume(device='/dev/sdf', mount_point=mount_point,
+                             size=5, check_support=False)
+                   for mount_point in ('/mnt/a', '/mnt/b')]
+        second_mounted = threading.Event()
+        events = []
+
+        def hydrate(**kwargs):
+            # the next volume is mounted while the first one hydrates
+            self.assertTrue(second_mounted.wait(5))
+            events.append('hydrated')
+        volumes[0].hydrate = mock.Mock(side_effect=hydrate)
+        volumes[1].hydrate = mock.Mock(side_effect=Exception('boom'))
+        snap.pre_mount = lambda vol: vol is volumes[1] and second_mounted.set()
+        snap.post_mounts = lambda volumes: events.append('post_mounts')
+        snap.get_snapshot = mock.Mock(
+            return_value=mock.Mock(status='completed'))
+        snap.attach_volume = mock.Mock()
+        with mock.patch('subprocess.check_output'):
+            with mock.patch('os.makedirs'):
+                with self.assertRaises(exceptions.PartialFailure) as context:
+                    snap.mount_snapshots(volumes)
+        self.assertEqual(context.exception.errors[0][0], volumes[1])
+        volumes[0].hydrate.assert_called_with(concurrency=8, rate_limit=None)
+        self.assertEqual(snap.con.create_tags.call_count, 2)
+
+        events[:] = []
+        volumes[1].hydrate.side_effect = None
+        with mock.patch('subprocess.check_output'):
+            with mock.patch('os.makedirs'):
+                snap.mount_snapshots(volumes)
+        self.assertEqual(events, ['hydrated', 'post_mounts'])
+
+
+class TestThrottle(BaseTest):
+    def get_throttle_error(self):
+        from boto.exception import EC2ResponseError
+        body = ('<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                '<Message>Request limit exceeded.</Message></Error></Errors>'
+                '</Response>')
+        return EC2ResponseError(503, 'Service Unavailable', body)
+
+    def test_api_classes(self):
+        from snaptastic.throttle import Throttler
+        throttler = Throttler()
+        self.assertEqual(throttler.get_api_class('DescribeSnapshots'),
+                         'describe')
+        self.assertEqual(throttler.get_api_class('CreateTags'), 'tags')
+        self.assertEqual(throttler.get_api_class('CreateSnapshot'), 'mutate')
+
+    def test_retry_throttled(self):
+        from snaptastic.throttle import Throttler
+        throttler = Throttler()
+        con = mock.Mock()
+        con.throttler = None
+        get_object = con.get_object
+        get_object.side_effect = [self.get_throttle_error(), 'snapshot']
+        throttler.wrap(con)
+        with mock.patch('time.sleep') as sleep:
+            result = con.get_object('CreateSnapshot', {})
+        self.assertEqual(result, 'snapshot')
+        self.assertEqual(get_object.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+        stats = throttler.stats()['mutate']
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['throttled'], 1)
+
+    def test_other_errors_raise(self):
+        from snaptastic.throttle import Throttler
+        throttler = Throttler()
+        function = mock.Mock(side_effect=ValueError('broken'))
+        with self.assertRaises(ValueError):
+            throttler.call('DescribeVolumes', function)
+        self.assertEqual(function.call_count, 1)
+
+    def get_throttled_snapshotter(self, calls, failures):
+        '''
+        A snapshotter whose create_snapshot fails with a throttling error
+        failures times, logging the freeze commands and sleeps to calls
+        '''
+        from snaptastic.throttle import Throttler
+        snap = self.get_test_snapshotter()
+        throttler = Throttler()
+        # an empty bucket, so any wait for the rate limit would sleep
+        throttler.buckets['mutate'].tokens = 0
+        throttler.buckets['mutate'].rate = 100.0
+        errors = [self.get_throttle_error()] * failures
+
+        def get_object(*args):
+            if errors:
+                raise errors.pop()
+            return mock.Mock(id='snap-1')
+        snap.con.get_object.side_effect = get_object
+        snap.con.create_snapshot.side_effect = lambda *args, **kwargs: (
+            snap.con.get_object('CreateSnapshot', {}))
+        throttler.wrap(snap.con)
+        patchers = [
+            mock.patch('subprocess.check_output',
+                       side_effect=lambda args, **kwargs: calls.append(
+                           args[1])),
+            mock.patch('time.sleep',
+                       side_effect=lambda delay: calls.append('sleep')),
+            mock.patch('snaptastic.utils.is_root_dev', return_value=False)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return snap
+
+    def assert_not_stalled(self, calls):
+        frozen = False
+        for call in calls:
+            frozen = {'-f': True, '-u': False}.get(call, frozen)
+            self.assertFalse(frozen and call == 'sleep', calls)
+
+    def test_no_waits_while_frozen(self):
+        calls = []
+        snap = self.get_throttled_snapshotter(calls, failures=2)
+        volume = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test', size=5,
+            check_support=False)
+        snapshot = snap.make_snapshot(volume)
+        self.assertEqual(snapshot.id, 'snap-1')
+        self.assertEqual(calls.count('-f'), 3)
+        self.assertEqual(calls.count('-u'), 3)
+        self.assert_not_stalled(calls)
+
+    def test_no_waits_while_group_frozen(self):
+        calls = []
+        snap = self.get_throttled_snapshotter(calls, failures=1)
+        volumes = [EBSVolume(device='/dev/sdf', mount_point=mount_point,
+                             size=5, check_support=False)
+                   for mount_point in ('/mnt/a', '/mnt/b')]
+        snapshots = snap.make_snapshots(volumes, consistency_group=True)
+        self.assertEqual(len(snapshots), 2)
+        self.assert_not_stalled(calls)
+        # the snapshot of the throttled attempt is removed
+        snap.con.delete_snapshot.assert_called_once_with('snap-1')
+
+    def test_give_up(self):
+        from boto.exception import EC2ResponseError
+        from snaptastic.throttle import Throttler
+        throttler = Throttler()
+        throttler.MAX_RETRIES = 2
+        function = mock.Mock(side_effect=self.get_throttle_error())
+        with mock.patch('time.sleep'):
+            with self.assertRaises(EC2ResponseError):
+                throttler.call('DeleteSnapshot', function)
+        self.assertEqual(function.call_count, 3)
+
+
+class TestConnections(BaseTest):
+    def setUp(self):
+        from snaptastic.utils import clear_connections
+        from snaptastic import settings
+        clear_connections()
+        self.addCleanup(clear_connections)
+        patcher = mock.patch.multiple(
+            settings, create=True, REGION='us-east-1',
+            AWS_ACCESS_KEY_ID='key', AWS_SECRET_ACCESS_KEY='secret')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connection_reused(self):
+        from snaptastic.utils import get_connection, get_connection_stats
+        connect = mock.Mock(side_effect=lambda *a, **kw: mock.Mock())
+        first = get_connection('ec2', connect)
+        second = get_connection('ec2', connect)
+        self.assertIs(first, second)
+        self.assertEqual(connect.call_count, 1)
+        other = get_connection('cloudwatch', connect)
+        self.assertIsNot(first, other)
+        stats = get_connection_stats()
+        self.assertEqual(stats['ec2_created'], 1)
+        self.assertEqual(stats['ec2_reused'], 1)
+        self.assertEqual(stats['cloudwatch_created'], 1)
+
+    def test_ec2_conn_throttled(self):
+        from snaptastic.utils import get_ec2_conn
+        con = get_ec2_conn()
+        self.assertIs(con, get_ec2_conn())
+        self.assertIsNotNone(con.throttler)
+
+
+class TestEngine(BaseTest):
+    def test_engine(self):
+        from snaptastic.engine import Engine
+        engine = Engine(workers=2)
+        first = self.get_test_snapshotter()
+        second = self.get_test_snapshotter()
+        second.con = first.con
+        first.make_snapshots = mock.Mock(return_value=['snap-1'])
+        second.make_snapshots = mock.Mock(
+            side_effect=exceptions.PartialFailure('boom'))
+        operations = [engine.make_snapshots(first),
+                      engine.make_snapshots(second)]
+        outcomes = engine.wait_all(operations, timeout=5)
+        self.assertEqual(outcomes[0], (['snap-1'], None))
+        self.assertIsInstance(outcomes[1][1], exceptions.PartialFailure)
+        self.assertIs(first.volume_waiter, second.volume_waiter)
+        self.assertIs(first.snapshot_waiter, second.snapshot_waiter)
+        with self.assertRaises(exceptions.PartialFailure):
+            operations[1].wait()
+
+
+class TestCatalog(BaseTest):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'catalog.db')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def get_snapshot(self, snapshot_id, start_time=None, **kwargs):
+        return super(TestCatalog, self).get_snapshot(
+            snapshot_id, start_time, dict(mount_point='/mnt/test'), **kwargs)
+
+    def test_catalog(self):
+        from snaptastic.catalog import SnapshotCatalog
+        con = mock.Mock()
+        con.get_list.side_effect = self.get_pages(
+            [self.get_snapshot('snap-1')],
+            [self.get_snapshot('snap-2', status='pending')])
+        catalog = SnapshotCatalog(con, self.path, ttl=60)
+        filters = {'tag:role': 'role'}
+        snapshots = catalog.get_snapshots(filters)
+        self.assertEqual(sorted(s.id for s in snapshots), ['snap-1', 'snap-2'])
+        self.assertEqual(snapshots[0].tags, dict(mount_point='/mnt/test'))
+        con.build_filter_params.assert_called_once_with(mock.ANY, filters)
+
+        # within the ttl the catalog doesn't touch the API
+        catalog.get_snapshots(filters)
+        self.assertEqual(con.get_list.call_count, 2)
+
+        # afterwards only new and pending snapshots are fetched
+        catalog.ttl = 0
+        con.get_list.side_effect = self.get_pages(
+            [self.get_snapshot('snap-3')])
+        con.get_all_snapshots.return_value = [self.get_snapshot('snap-2')]
+        snapshots = catalog.get_snapshots(filters)
+        args, kwargs = con.build_filter_params.call_args
+        new_filters = args[1]
+        self.assertEqual(new_filters['tag:role'], 'role')
+        self.assertEqual(new_filters['start-time'],
+                         ['%s*' % snapshots[0].start_time[:10]])
+        con.get_all_snapshots.assert_called_once_with(
+            snapshot_ids=['snap-2'])
+        statuses = dict((s.id, s.status) for s in snapshots)
+        self.assertEqual(statuses, {'snap-1': 'completed',
+                                    'snap-2': 'completed',
+                                    'snap-3': 'completed'})
+
+        catalog.forget(['snap-1'])
+        catalog.ttl = 60
+        snapshots = catalog.get_snapshots(filters)
+        self.assertEqual(sorted(s.id for s in snapshots), ['snap-2', 'snap-3'])
+
+    def test_lookup_window(self):
+        import sqlite3
+        from snaptastic.catalog import SnapshotCatalog
+        con = mock.Mock()
+        old = self.get_snapshot('snap-old', datetime(2013, 1, 1))
+        con.get_list.side_effect = self.get_pages(
+            [self.get_snapshot('snap-1'), old])
+        catalog = SnapshotCatalog(con, self.path, ttl=60)
+        today = datetime.utcnow().date()
+        filters = {'tag:role': 'role', 'start-time': [
+            '%s*' % (today - timedelta(days=d)).isoformat()
+            for d in range(2)]}
+        snapshots = catalog.get_snapshots(filters)
+        self.assertEqual([s.id for s in snapshots], ['snap-1'])
+        # the window moved a day, the scope stays the same
+        filters['start-time'] = filters['start-time'][:1]
+        self.assertEqual(
+            [s.id for s in catalog.get_snapshots(filters)], ['snap-1'])
+        self.assertEqual(con.get_list.call_count, 1)
+        db = sqlite3.connect(self.path)
+        self.assertEqual(db.execute(
+            'SELECT COUNT(*) FROM scopes').fetchone()[0], 1)
+        # scopes which weren't used since the last full refresh are purged
+        db.execute('UPDATE scopes SET refreshed_at = 0')
+        db.commit()
+        con.get_list.side_effect = self.get_pages([self.get_snapshot('snap-2')])
+        catalog.get_snapshots({'tag:role': 'other'})
+        self.assertEqual(db.execute(
+            'SELECT COUNT(*) FROM scopes').fetchone()[0], 1)
+        self.assertEqual(db.execute(
+            'SELECT id FROM snapshots').fetchall(), [('snap-2',)])
+        db.close()
+
+    def test_snapshotter_catalog(self):
+        from snaptastic.catalog import SnapshotCatalog
+        snap = self.get_test_snapshotter()
+        snap.con.get_list.side_effect = self.get_pages(
+            [self.get_snapshot('snap-1')])
+        snap.catalog = SnapshotCatalog(snap.con, self.path)
+        volume = EBSVolume(
+            device='/dev/sdf', mount_point='/mnt/test', size=5,
+            check_support=False)
+        self.assertEqual(snap.get_snapshot(volume).id, 'snap-1')
+        snap.clear_snapshot_cache()
+        snap.get_snapshot(volume)
+        self.assertEqual(snap.con.get_list.call_count, 1)
+
+    def test_iter_snapshots(self):
+        from snaptastic.catalog import SnapshotCatalog
+        from snaptastic.inventory import Inventory
+        con = mock.Mock()
+        con.get_list.side_effect = self.get_pages(
+            [self.get_snapshot('snap-%s' % i) for i in range(5)])
+        catalog = SnapshotCatalog(con, self.path)
+        catalog.READ_BATCH_SIZE = 2
+        inventory = Inventory(con, ['1'], catalog=catalog)
+        snapshots = inventory.iter_snapshots()
+        self.assertEqual(next(snapshots).id, 'snap-0')
+        # the catalog isn't locked while the rows are handled
+        catalog.forget(['snap-0', 'snap-3'])
+        self.assertEqual([s.id for s in snapshots],
+                         ['snap-1', 'snap-2', 'snap-4'])
+
+
+class TestStartup(BaseTest):
+    # generous, importing the cli takes a few tens of ms
+    STARTUP_BUDGET = 1.0
+    EAGER_MODULES = ('boto', 'snaptastic.settings', 'snaptastic.examples',
+                     'snaptastic.snapshotter', 'snaptastic.utils.log')
+
+    def run_python(self, code):
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], stderr=subprocess.STDOUT,
+            cwd=os.path.join(os.path.dirname(__file__), '..'))
+        return output.strip().splitlines()[-1]
+
+    def test_cli_import_is_lazy(self):
+        code = ('import sys, time; t = time.time(); import snaptastic.cli; '
+                'loaded = [m for m in sys.modules if sys.modules[m] and '
+                'm.startswith(%r)]; print time.time() - t, loaded')
+        output = self.run_python(code % (self.EAGER_MODULES,))
+        elapsed, loaded = output.split(' ', 1)
+        self.assertEqual(loaded, '[]')
+        self.assertLess(float(elapsed), self.STARTUP_BUDGET)
+
+    def test_lazy_attributes(self):
+        code = ('import snaptastic; from snaptastic import Snapshotter, '
+                'EBSVolume, get_ec2_conn, get_snapshotter; '
+                'print Snapshotter.__module__')
+        self.assertEqual(self.run_python(code), 'snaptastic.snapshotter')
+
+    def test_version(self):
+        code = ('import sys; sys.argv = ["snaptastic", "--version"]; '
+                'from snaptastic.cli import main; main(); '
+                'print "snaptastic.settings" in sys.modules')
+        self.assertEqual(self.run_python(code), 'False')
+
+    def test_help(self):
+        code = ('import sys; sys.argv = ["snaptastic", "--help"]\n'
+                'from snaptastic.cli import main\n'
+                'try: main()\n'
+                'except SystemExit: pass\n'
+                'print "snaptastic.settings" in sys.modules')
+        self.assertEqual(self.run_python(code), 'False')
+
+
+class TestInstanceMetadata(BaseTest):
+    RESPONSES = {
+        'meta-data/': 'instance-id\nplacement/\npublic-keys/\niam/',
+        'meta-data/instance-id': 'i-123',
+        'meta-data/placement/': 'availability-zone',
+        'meta-data/placement/availability-zone': 'us-east-1a',
+        'meta-data/public-keys/': '0=deploy',
+        'meta-data/public-keys/0/openssh-key': 'ssh-rsa AAA',
+        'meta-data/iam/': 'security-credentials/',
+        'meta-data/identity-credentials/': 'ec2/',
+        'user-data': '{"role": "db"}',
+    }
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def get_instance_metadata(self):
+        from snaptastic.metadata import InstanceMetadata
+        instance_metadata = InstanceMetadata(self.directory)
+        instance_metadata.get_boot_id = mock.Mock(return_value='boot-1')
+        instance_metadata.get_token = mock.Mock(return_value='token')
+        instance_metadata.fetch = mock.Mock(
+            side_effect=lambda path, token: self.RESPONSES.get(path))
+        return instance_metadata
+
+    def test_metadata_tree(self):
+        instance_metadata = self.get_instance_metadata()
+        metadata = instance_metadata.get_metadata()
+        self.assertEqual(metadata, {
+            'instance-id': 'i-123',
+            'placement': {'availability-zone': 'us-east-1a'},
+            'public-keys': {'deploy': 'ssh-rsa AAA'},
+            'iam': {}})
+        paths = [args[0] for args, kwargs
+                 in instance_metadata.fetch.call_args_list]
+        self.assertNotIn('meta-data/iam/security-credentials/', paths)
+        self.assertNotIn('meta-data/identity-credentials/', paths)
+        self.assertTrue(instance_metadata.is_excluded(
+            'meta-data/identity-credentials/ec2/security-credentials'))
+
+    def test_no_proxy(self):
+        import urllib2
+        from snaptastic.metadata import InstanceMetadata
+        with mock.patch.dict(os.environ, http_proxy='http://proxy:3128'):
+            instance_metadata = InstanceMetadata()
+        # the default ProxyHandler, reading http_proxy, is left out
+        proxy_handlers = [h for h in instance_metadata.opener.handlers
+                          if isinstance(h, urllib2.ProxyHandler)]
+        self.assertEqual(proxy_handlers, [])
+        instance_metadata.opener = mock.Mock()
+        instance_metadata.opener.open.return_value.read.return_value = 'v'
+        with mock.patch('urllib2.urlopen') as urlopen:
+            self.assertEqual(instance_metadata.get_token(), 'v')
+            self.assertEqual(instance_metadata.fetch('user-data', 'v'), 'v')
+        self.assertFalse(urlopen.called)
+        self.assertEqual(instance_metadata.opener.open.call_count, 2)
+
+    def test_boot_cache(self):
+        import json
+        # written by an earlier version, with the whole tree and the token
+        old_path = os.path.join(self.directory, 'instance-boot-1.json')
+        with open(old_path, 'w') as old_file:
+            old_file.write('{"token": "token"}')
+        first = self.get_instance_metadata()
+        self.assertEqual(first.get_userdata(), '{"role": "db"}')
+        first.get_metadata()
+        path = first.get_cache_path()
+        self.assertTrue(path.endswith('-boot-1.json'))
+        self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+        self.assertFalse(os.path.exists(old_path))
+        with open(path) as cache_file:
+            self.assertEqual(sorted(json.load(cache_file)),
+                             ['metadata', 'userdata'])
+        second = self.get_instance_metadata()
+        self.assertEqual(second.get_metadata()['instance-id'], 'i-123')
+        self.assertEqual(second.get_userdata(), '{"role": "db"}')
+        self.assertFalse(second.fetch.called)
+        # other excluded paths don't reuse the cache
+        other = self.get_instance_metadata()
+        other.EXCLUDED_PATHS += ('meta-data/public-keys/',)
+        self.assertNotEqual(other.get_cache_path(), path)
+        # a new boot starts with an empty cache
+        third = self.get_instance_metadata()
+        third.get_boot_id.return_value = 'boot-2'
+        third.get_userdata()
+        self.assertTrue(third.fetch.called)
+        self.assertFalse(os.path.exists(path))
+
+    def test_snapshotter_lazy(self):
+        with mock.patch('snaptastic.snapshotter.get_metadata_dict') as meta:
+            with mock.patch('snaptastic.snapshotter.get_userdata_dict') as user:
+                meta.return_value = dict(placement={
+                    'availability-zone': 'us-east-1a'})
+                user.return_value = dict(role='db')
+                snap = Snapshotter(connection=mock.Mock(), catalog=False)
+                self.assertFalse(meta.called or user.called)
+                self.assertEqual(snap.availability_zone, 'us-east-1a')
+                self.assertEqual(snap.userdata, dict(role='db'))
+                snap.userdata
+        self.assertEqual(meta.call_count, 1)
+        self.assertEqual(user.call_count, 1)
+        self.assertFalse(snap.con.get_instance_attribute.called)
+
+    def test_bdm_loaded_once(self):
+        import time
+        from snaptastic.utils.concurrency import map_concurrently
+        con = mock.Mock()
+
+        def get_instance_attribute(instance_id, attribute):
+            time.sleep(0.05)
+            return dict(blockDeviceMapping={})
+        con.get_instance_attribute.side_effect = get_instance_attribute
+        with mock.patch('snaptastic.snapshotter.get_metadata_dict') as meta:
+            meta.return_value = {'instance-id': 'i-1'}
+            snap = Snapshotter(userdata={}, connection=con, catalog=False)
+            outcomes = map_concurrently(lambda i: snap.bdm, range(4), 4)
+        self.assertEqual([error for bdm, error in outcomes], [None] * 4)
+        self.assertEqual(con.get_instance_attribute.call_count, 1)
+        self.assertEqual(meta.call_count, 1)
+
+
+class TestCheckBackups(BaseTest):
+    def get_volume(self, volume_id, environment, cluster, role, mount_point):
+        return mock.Mock(id=volume_id, tags=dict(
+            environment=environment, cluster=cluster, role=role,
+            mount_point=mount_point))
+
+    def test_check_many_backups(self):
+        from snaptastic.utils import check_many_backups
+        con = mock.Mock()
+        con.get_all_volumes.return_value = [
+            self.get_volume('vol-1', 'prod', 'db', 'master', '/mnt/a'),
+            self.get_volume('vol-2', 'prod', 'db', 'master', '/mnt/b'),
+            self.get_volume('vol-3', 'prod', 'web', 'app', '/mnt/a'),
+            # matches the combined filters, but isn't one of our targets
+            self.get_volume('vol-4', 'prod', 'db', 'app', '/mnt/a'),
+        ]
+        con.get_all_snapshots.side_effect = lambda filters: [
+            self.get_snapshot('snap-%s' % volume_id, datetime.utcnow() -
+                              timedelta(hours=hours), volume_id=volume_id)
+            for volume_id, hours
+            in [('vol-1', 2), ('vol-2', 30), ('vol-3', 1), ('vol-4', 1)]
+            if volume_id in filters['volume-id']]
+        targets = [('prod', 'db', 'master'), ('prod', 'web', 'app')]
+        with mock.patch('snaptastic.utils.get_ec2_conn', return_value=con):
+            results = check_many_backups(
+                24 * 3600, targets, catalog=False, chunk_size=1)
+        self.assertEqual(results, {
+            ('prod', 'db', 'master'): {'/mnt/b': ['vol-2']},
+            ('prod', 'web', 'app'): {},
+        })
+        # one volume query per chunk of targets
+        self.assertEqual(con.get_all_volumes.call_count, 2)
+        self.assertEqual(con.get_all_snapshots.call_count, 3)
+        filters = con.get_all_snapshots.call_args[1]['filters']
+        self.assertEqual(len(filters['start-time']), 2)
+
+    def test_read_backup_targets(self):
+        from snaptastic.utils import read_backup_targets
+        lines = ['# environment cluster role', 'prod db master',
+                 '', 'prod,web, app  # frontends']
+        self.assertEqual(read_backup_targets(lines), [
+            ('prod', 'db', 'master'), ('prod', 'web', 'app')])
+        with self.assertRaises(ValueError):
+            read_backup_targets(['prod db'])
+
+
+class TestCleaner(BaseTest):
+    def get_cleaner(self):
+        from snaptastic.cleaner import Cleaner
+        return Cleaner(connection=mock.Mock(), catalog=False)
+
+    def get_snapshot(self, snapshot_id, description='', days_ago=30):
+        start_time = datetime.utcnow() - timedelta(days=days_ago)
+        return super(TestCleaner, self).get_snapshot(
+            snapshot_id, start_time, description=description)
+
+    def test_expired_snapshots_skip_amis(self):
+        cleaner = self.get_cleaner()
+        image = mock.Mock(id='ami-12345678', owner_id='1')
+        image.block_device_mapping = {
+            '/dev/sda1': mock.Mock(snapshot_id='snap-1'),
+            '/dev/sdb': mock.Mock(snapshot_id=None)}
+        cleaner.con.get_all_images.return_value = [image]
+        snapshots = [
+            self.get_snapshot('snap-1'),
+            self.get_snapshot('snap-2', 'Created by CreateImage(i-1) for '
+                              'ami-12345678 from vol-1'),
+            # a longer id containing ours isn't ours
+            self.get_snapshot('snap-3', 'Copied for ami-123456789'),
+            self.get_snapshot('snap-4', 'database backup'),
+            self.get_snapshot('snap-5', 'database backup', days_ago=1),
+        ]
+        cleaner.con.get_list.side_effect = self.get_pages(
+            snapshots[:2], snapshots[2:])
+        expired = cleaner.get_expired_snapshots()
+        self.assertEqual([s.id for s in expired], ['snap-3', 'snap-4'])
+        self.assertEqual(cleaner.con.get_all_images.call_count, 1)
+
+
+class TestStreaming(BaseTest):
+    def test_imap_concurrently_bounded(self):
+        import threading
+        from snaptastic.utils.concurrency import imap_concurrently
+        lock = threading.Lock()
+        processed = []
+        read_ahead = []
+
+        def items():
+            for i in range(100):
+                with lock:
+                    read_ahead.append(i - len(processed))
+                yield i
+
+        def function(item):
+            with lock:
+                processed.append(item)
+            if item == 13:
+                raise ValueError('unlucky')
+            return item * 2
+
+        outcomes = list(imap_concurrently(
+            function, items(), workers=4, buffer_size=8))
+        self.assertEqual(len(outcomes), 100)
+        errors = [item for item, (result, error) in outcomes if error]
+        self.assertEqual(errors, [13])
+        self.assertTrue(all(result == item * 2 for item, (result, error)
+                            in outcomes if not error))
+        # the iterator is never far ahead of the workers
+        self.assertLessEqual(max(read_ahead), 8 + 4 + 1)
+
+    def test_cleanup_streams_snapshots(self):
+        from snaptastic.cleaner import Cleaner
+        from snaptastic import settings
+        con = mock.Mock()
+        con.get_all_images.return_value = []
+        pages = self.get_pages(*[
+            [self.get_snapshot('snap-%s-%s' % (p, i), datetime(2012, 1, 1))
+             for i in range(3)] for p in range(4)])
+        deleted_before_page = []
+
+        def get_list(*args, **kwargs):
+            deleted_before_page.append(con.delete_snapshot.call_count)
+            return pages.pop(0)
+        con.get_list.side_effect = get_list
+        cleaner = Cleaner(connection=con, catalog=False)
+        cleaner.DELETE_CONCURRENCY = 1
+        with mock.patch.object(settings, 'CLEANUP_JOURNAL_DIR', None):
+            cleaner.cleanup_snapshots()
+        self.assertEqual(con.delete_snapshot.call_count, 12)
+        # deletes started before the later pages were fetched
+        self.assertEqual(deleted_before_page, [0, 3, 6, 9])
+
+
+class TestRetention(BaseTest):
+    def get_snapshots(self, group, count, status='completed'):
+        newest = datetime(2013, 3, 15, 18, 0)
+        tags = dict(environment='prod', cluster='db', role='master',
+                    mount_point=group)
+        return [self.get_snapshot(
+            '%s-%s' % (group, k), newest - timedelta(hours=6 * k), tags,
+            status=status, volume_size=10) for k in range(count)]
+
+    def test_get_keep(self):
+        from snaptastic.retention import RetentionPolicy, RetainedSnapshot
+        from snaptastic.cleaner import Cleaner
+        cleaner = Cleaner(connection=mock.Mock(), catalog=False)
+        snapshots = [RetainedSnapshot(s.id, s.volume_size, s.status,
+                                      cleaner.get_start_time(s))
+                     for s in self.get_snapshots('a', 240)]
+        snapshots[200].status = 'pending'
+        # failed snapshots aren't kept, nor do they take a bucket
+        snapshots[1].status = 'error'
+        policy = RetentionPolicy(hourly=2, daily=2, weekly=1, monthly=2)
+        keep = policy.get_keep(snapshots)
+        # two hours, yesterday evening, the end of february and the pending
+        self.assertEqual(keep, set(['a-0', 'a-2', 'a-4', 'a-60', 'a-200']))
+
+    def test_cleaner_retention(self):
+        from snaptastic.cleaner import Cleaner
+        from snaptastic import settings
+        con = mock.Mock()
+        con.get_all_images.return_value = []
+        other = self.get_snapshot('other', datetime(2012, 1, 1),
+                                  volume_size=1)
+        snapshots = self.get_snapshots('/mnt/a', 10) + \
+            self.get_snapshots('/mnt/b', 3) + [other]
+        # explicit expiry tags keep the flat expiry, in the future here
+        explicit = self.get_snapshots('/mnt/c', 2) + \
+            self.get_snapshots('/mnt/d', 2)
+        explicit[0].tags = dict(explicit[0].tags, expiry='2099-01-01')
+        explicit[1].tags = dict(explicit[1].tags, expiry='2099-01-01')
+        explicit[2].tags = dict(explicit[2].tags, expiry_delta='365000')
+        explicit[3].tags = dict(explicit[3].tags, expiry_delta='365000')
+        # a malformed expiry_delta is ignored, retention applies
+        malformed = self.get_snapshots('/mnt/e', 2)
+        for snapshot in malformed:
+            snapshot.tags = dict(snapshot.tags, expiry_delta='a year')
+        con.get_list.side_effect = self.get_pages(
+            snapshots + explicit + malformed)
+        cleaner = Cleaner(connection=con, catalog=False)
+        retention = dict(hourly=1, daily=1, weekly=0, monthly=0)
+        with mock.patch.object(settings, 'SNAPSHOT_RETENTION', retention):
+            expired = cleaner.get_expired_snapshots()
+        self.assertEqual(sorted(s.id for s in expired), [
+            '/mnt/a-%s' % k for k in range(1, 10)] + [
+            '/mnt/b-1', '/mnt/b-2', '/mnt/e-1', 'other'])
+
+    def test_expiry_delta_tag(self):
+        import datetime
+        from snaptastic.cleaner import Cleaner
+        cleaner = Cleaner(connection=mock.Mock(), catalog=False)
+        snapshot = self.get_snapshots('/mnt/a', 1)[0]
+        start_time = cleaner.get_start_time(snapshot)
+        for expiry_delta, days in [('30', 30), ('1.5', 1.5), ('a', 7),
+                                   ('', 7), ('1e300', None)]:
+            snapshot.tags = dict(snapshot.tags, expiry_delta=expiry_delta)
+            expiry_date = cleaner.get_snapshot_expiry_date(snapshot)
+            if days is None:
+                self.assertEqual(expiry_date, datetime.datetime.max)
+            else:
+                self.assertEqual(expiry_date - start_time,
+                                 datetime.timedelta(days=days))
+
+
+class TestInventory(BaseTest):
+    def test_clean_all_lists_once(self):
+        from snaptastic.cleaner import Cleaner
+        from snaptastic import settings
+        con = mock.Mock()
+        cleaner = Cleaner(connection=con, catalog=False)
+        image = mock.Mock(id='ami-1', owner_id='1')
+        image.block_device_mapping = {
+            '/dev/sda1': mock.Mock(snapshot_id='snap-ami'),
+            '/dev/xvdb': mock.Mock(snapshot_id='snap-data')}
+        instance = mock.Mock(state='running', image_id='ami-2')
+        con.get_all_instances.return_value = [
+            mock.Mock(instances=[instance])]
+        con.get_all_images.return_value = [image]
+        con.get_all_volumes.return_value = [
+            mock.Mock(id='vol-1', status='available', size=5),
+            mock.Mock(id='vol-2', status='in-use', size=5)]
+        con.get_list.side_effect = self.get_pages([
+            self.get_snapshot(snapshot_id, datetime(2012, 1, 1), volume_size=8)
+            for snapshot_id in ('snap-ami', 'snap-data', 'snap-old')])
+        with mock.patch.object(settings, 'CLEANUP_JOURNAL_DIR', None):
+            cleaner.clean('all')
+        for listing in (con.get_all_instances, con.get_all_images,
+                        con.get_all_volumes, con.get_list):
+            self.assertEqual(listing.call_count, 1)
+        con.deregister_image.assert_called_once_with(
+            'ami-1', delete_snapshot=True)
+        # the root snapshot of the deregistered image is gone with it, the
+        # snapshot of its data device is expired like any other
+        self.assertEqual(
+            sorted(args[0] for args, _ in con.delete_snapshot.call_args_list),
+            ['snap-data', 'snap-old'])
+        self.assertEqual([v.id for v in cleaner.inventory.volumes], ['vol-2'])
+
+
+class TestMetrics(BaseTest):
+    RESPONSE = '''<GetMetricDataResponse
+        xmlns="http://monitoring.amazonaws.com/doc/2010-08-01/">
+      <GetMetricDataResult>
+        <MetricDataResults>%s</MetricDataResults>
+      </GetMetricDataResult>
+    </GetMetricDataResponse>'''
+    MEMBER = '''<member><Id>%s</Id><StatusCode>Complete</StatusCode>
+        <Values>%s</Values></member>'''
+
+    def get_connection(self, utilization):
+        con = mock.Mock()
+
+        def make_request(action, params, path, verb):
+            members = []
+            index = 1
+            while 'MetricDataQueries.member.%s.Id' % index in params:
+                prefix = 'MetricDataQueries.member.%s.' % index
+                instance_id = params[
+                    prefix + 'MetricStat.Metric.Dimensions.member.1.Value']
+                values = ''.join('<member>%s</member>' % v
+                                 for v in utilization.get(instance_id, []))
+                members.append(self.MEMBER % (params[prefix + 'Id'], values))
+                index += 1
+            response = mock.Mock(status=200)
+            response.read.return_value = self.RESPONSE % ''.join(members)
+            return response
+        con.make_request.side_effect = make_request
+        return con
+
+    def test_get_metric_data(self):
+        from snaptastic.metrics import get_metric_data
+        utilization = dict(('i-%s' % i, [float(i)]) for i in range(5))
+        con = self.get_connection(utilization)
+        end = datetime.utcnow()
+        data = get_metric_data(
+            con, 'AWS/EC2', 'CPUUtilization', 'InstanceId',
+            sorted(utilization), end - timedelta(days=1), end, 86400,
+            batch_size=2)
+        self.assertEqual(data, utilization)
+        self.assertEqual(con.make_request.call_count, 3)
+
+    def test_low_utilized_instances(self):
+        from snaptastic.cleaner import Cleaner
+        cleaner = Cleaner(connection=mock.Mock(), catalog=False)
+        instances = [mock.Mock(id='i-1'), mock.Mock(id='i-2'),
+                     mock.Mock(id='i-3')]
+        con = self.get_connection({'i-1': [2.0, 50.0], 'i-2': [40.0]})
+        with mock.patch('snaptastic.cleaner.get_cloudwatch_conn',
+                        return_value=con):
+            low = cleaner.get_low_utilized_instances(instances)
+        self.assertEqual(low, instances[:1])
+        self.assertEqual(low[0].cpu_utilization, 2.0)
+
+
+class TestDeleter(BaseTest):
+    def setUp(self):
+        import tempfile
+        from snaptastic import settings
+        self.directory = tempfile.mkdtemp()
+        patcher = mock.patch.object(
+            settings, 'CLEANUP_JOURNAL_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def get_cleaner(self):
+        from snaptastic.cleaner import Cleaner
+        return Cleaner(connection=mock.Mock(), catalog=mock.Mock())
+
+    def get_snapshots(self, count):
+        return [mock.Mock(id='snap-%s' % i, volume_size=10)
+                for i in range(count)]
+
+    def test_delete_snapshots(self):
+        cleaner = self.get_cleaner()
+        snapshots = self.get_snapshots(20)
+        cleaner.delete_snapshots(snapshots)
+        deleted = sorted(args[0] for args, kwargs
+                         in cleaner.con.delete_snapshot.call_args_list)
+        self.assertEqual(deleted, sorted(s.id for s in snapshots))
+        forgotten = cleaner.catalog.forget.call_args[0][0]
+        self.assertEqual(len(forgotten), 20)
+        # a completed cleanup removes its journal
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_resume(self):
+        from boto.exception import EC2ResponseError
+        cleaner = self.get_cleaner()
+        snapshots = self.get_snapshots(4)
+        not_found = EC2ResponseError(400, 'Bad Request', (
+            '<Response><Errors><Error><Code>InvalidSnapshot.NotFound</Code>'
+            '<Message>gone</Message></Error></Errors></Response>'))
+
+        def delete_snapshot(snapshot_id):
+            if snapshot_id == 'snap-1':
+                raise ValueError('broken')
+            if snapshot_id == 'snap-2':
+                raise not_found
+        cleaner.con.delete_snapshot.side_effect = delete_snapshot
+        with self.assertRaises(exceptions.PartialFailure) as context:
+            cleaner.delete_snapshots(snapshots)
+        self.assertEqual(len(context.exception.errors), 1)
+        forgotten = cleaner.catalog.forget.call_args[0][0]
+        self.assertEqual(sorted(forgotten), ['snap-0', 'snap-2', 'snap-3'])
+
+        # the next run only retries the failed snapshot
+        cleaner.con.delete_snapshot.reset_mock()
+        cleaner.con.delete_snapshot.side_effect = None
+        cleaner.delete_snapshots(snapshots)
+        cleaner.con.delete_snapshot.assert_called_once_with('snap-1')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_listing_fails(self):
+        cleaner = self.get_cleaner()
+        snapshots = self.get_snapshots(10)
+
+        def listing():
+            for snapshot in snapshots:
+                yield snapshot
+            raise RuntimeError('listing failed')
+
+        def delete_snapshot(snapshot_id):
+            time.sleep(0.01)
+        cleaner.con.delete_snapshot.side_effect = delete_snapshot
+        with self.assertRaises(RuntimeError):
+            cleaner.delete_snapshots(listing())
+        # the deletes already started finished before the error was raised
+        self.assertEqual(cleaner.con.delete_snapshot.call_count, 10)
+        forgotten = cleaner.catalog.forget.call_args[0][0]
+        self.assertEqual(sorted(forgotten), sorted(s.id for s in snapshots))
+
+
 class TestLogLevel(BaseTest):
     def test_loglevel(self):
         import logging
@@ -0,0 +1,174 @@
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from snaptastic.utils.concurrency import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+
+class Throttler(object):
+    '''
+    Client side rate limiting and retries for EC2 API calls
+
+    EC2 throttles per API class, so every class gets its own token bucket.
+    Calls rejected with a throttling error are retried with exponential
+    backoff and equal jitter, other errors are raised right away. All boto
+    calls go through get_list, get_object and get_status, so wrapping those
+    on a connection covers every caller, including the raw requests in
+    snaptastic.utils.
+
+    Share a single throttler between connections to the same account, so
+    the buckets apply to the whole process.
+
+    Calls made while a filesystem is frozen must not wait, for those take
+    the tokens up front with acquire and make the calls within immediate.
+    '''
+    # api class -> (requests per second, burst), matching the EC2 buckets
+    RATES = {
+        'describe': (20, 100),
+        'mutate': (5, 50),
+        'tags': (10, 100),
+    }
+    TAG_ACTIONS = ('CreateTags', 'DeleteTags')
+    DESCRIBE_PREFIXES = ('Describe', 'Get', 'List')
+    THROTTLE_ERRORS = ('RequestLimitExceeded', 'Throttling',
+                       'ThrottlingException', 'TooManyRequestsException')
+    WRAPPED_METHODS = ('get_list', 'get_object', 'get_status')
+    MAX_RETRIES = 8
+    MIN_DELAY = 0.5
+    MAX_DELAY = 20
+
+    def __init__(self, rates=None):
+        rates = dict(self.RATES, **(rates or {}))
+        self.buckets = dict((api_class, TokenBucket(rate, burst))
+                            for api_class, (rate, burst) in rates.items())
+        self.lock = threading.Lock()
+        # api class -> counter name -> value
+        self.counters = defaultdict(lambda: defaultdict(float))
+        # per thread, set within immediate
+        self.local = threading.local()
+
+    def get_api_class(self, action):
+        if action in self.TAG_ACTIONS:
+            return 'tags'
+        if action.startswith(self.DESCRIBE_PREFIXES):
+            return 'describe'
+        return 'mutate'
+
+    def is_throttled(self, error):
+        return getattr(error, 'error_code', None) in self.THROTTLE_ERRORS
+
+    def get_delay(self, attempt):
+        delay = min(self.MIN_DELAY * 2 ** attempt, self.MAX_DELAY)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def count(self, api_class, counter, value=1):
+        with self.lock:
+            self.counters[api_class][counter] += value
+
+    def acquire(self, action, tokens=1):
+        '''
+        Blocks till the rate limit of action allows tokens calls
+        '''
+        api_class = self.get_api_class(action)
+        bucket = self.buckets.get(api_class)
+        if bucket is not None:
+            waited = bucket.acquire(tokens)
+            if waited:
+                self.count(api_class, 'waited', waited)
+
+    @contextmanager
+    def immediate(self):
+        '''
+        Calls of this thread within the block neither wait for the rate
+        limit nor are they retried, throttling errors are raised right away
+        '''
+        self.local.immediate = True
+        try:
+            yield
+        finally:
+            self.local.immediate = False
+
+    def call(self, action, function, *args, **kwargs):
+        '''
+        Runs function (an API call for action) within the rate limit,
+        retrying it while EC2 throttles it
+        '''
+        api_class = self.get_api_class(action)
+        immediate = getattr(self.local, 'immediate', False)
+        attempt = 0
+        while True:
+            if not immediate:
+                self.acquire(action)
+            self.count(api_class, 'calls')
+            try:
+                return function(*args, **kwargs)
+            except Exception, e:
+                if not self.is_throttled(e):
+                    raise
+                self.count(api_class, 'throttled')
+                if immediate:
+                    raise
+                if attempt >= self.MAX_RETRIES:
+                    logger.warn('%s still throttled after %s retries',
+                                action, attempt)
+                    raise
+                delay = self.get_delay(attempt)
+                logger.info('%s was throttled, retrying in %.1f seconds',
+                            action, delay)
+                self.count(api_class, 'retries')
+                time.sleep(delay)
+                attempt += 1
+
+    def wrap(self, con):
+        '''
+        Routes all API calls of the boto connection through the throttler
+        '''
+        if getattr(con, 'throttler', None) is not None:
+            return con
+        for name in self.WRAPPED_METHODS:
+            setattr(con, name, self.wrap_method(getattr(con, name)))
+        con.throttler = self
+        return con
+
+    def wrap_method(self, method):
+        def throttled(action, *args, **kwargs):
+            return self.call(action, method, action, *args, **kwargs)
+        return throttled
+
+    def stats(self):
+        '''
+        Returns the counters per api class: calls, throttled, retries and
+        the seconds waited for the client side rate limit
+        '''
+        with self.lock:
+            return dict((api_class, dict(counters))
+                        for api_class, counters in self.counters.items())
+
+    def log_stats(self):
+        for api_class, counters in sorted(self.stats().items()):
+            logger.info('%s calls: %d made, %d throttled, %.1f seconds '
+                        'rate limited', api_class, counters.get('calls', 0),
+                        counters.get('throttled', 0),
+                        counters.get('waited', 0))
+
+
+_throttler = None
+_throttler_lock = threading.Lock()
+
+
+def get_throttler():
+    '''
+    The process wide throttler, configured by the EC2_RATE_LIMITS setting
+    '''
+    global _throttler
+    from snaptastic import settings
+    with _throttler_lock:
+        if _throttler is None:
+            _throttler = Throttler(getattr(settings, 'EC2_RATE_LIMITS', None))
+        return _throttler
@@ -2,39 +2,222 @@ from collections import defaultdict
 from datetime import datetime, timedelta
 import logging
 import os
+import threading
 
 
 logger = logging.getLogger(__name__)
 
 
 def add_tags(object_, tags):
-    for key, value in tags.iteritems():
-        object_.add_tag(key, value)
+    '''
+    Tags the object with a single create_tags request
+    '''
+    bulk_add_tags(object_.connection, [(object_, tags)])
+
+
+def bulk_add_tags(con, tagged_objects):
+    '''
+    Tags several objects with a create_tags request per resource, sending
+    all of its tags at once
+
+    create_tags sets the same tags on all resources in the request, so only
+    resources with exactly the same tags share a request
+
+    :param tagged_objects: list of (boto object, tags dict) tuples
+    '''
+    resources_per_tags = defaultdict(list)
+    for object_, tags in tagged_objects:
+        tags_key = tuple(sorted(tags.iteritems()))
+        resources_per_tags[tags_key].append(object_.id)
+    for tags_key, resource_ids in sorted(resources_per_tags.iteritems()):
+        con.create_tags(resource_ids, dict(tags_key))
+    # keep the local objects in sync, like boto's add_tag does
+    for object_, tags in tagged_objects:
+        object_.tags.update(tags)
+
+
+# the first EC2 API version which supports TagSpecification
+TAG_SPECIFICATION_API_VERSION = '2016-11-15'
+
+
+def create_tagged(con, action, params, resource_type, tags):
+    '''
+    Runs a CreateSnapshot or CreateVolume request with the tags in its
+    TagSpecification, so the resource never exists without its tags
+
+    boto 2 defaults to an API version without tag specifications and
+    make_request always sends the version of the connection. The
+    connection is shared by the whole process, so instead of changing its
+    version the request is built here with the version it needs.
+    '''
+    import xml.sax
+    from boto.ec2.snapshot import Snapshot
+    from boto.ec2.volume import Volume
+    from boto.handler import XmlHandler
+    resource_class = dict(snapshot=Snapshot, volume=Volume)[resource_type]
+    params = dict(params)
+    params['Action'] = action
+    params['Version'] = max(con.APIVersion, TAG_SPECIFICATION_API_VERSION)
+    params['TagSpecification.1.ResourceType'] = resource_type
+    for index, (key, value) in enumerate(sorted(tags.items())):
+        params['TagSpecification.1.Tag.%s.Key' % (index + 1)] = key
+        params['TagSpecification.1.Tag.%s.Value' % (index + 1)] = value
+
+    def request():
+        http_request = con.build_base_http_request(
+            'POST', '/', None, params, {}, '', con.host)
+        response = con._mexe(http_request)
+        body = response.read()
+        if response.status != 200:
+            raise con.ResponseError(response.status, response.reason, body)
+        return body
+
+    throttler = getattr(con, 'throttler', None)
+    if throttler is not None:
+        body = throttler.call(action, request)
+    else:
+        body = request()
+    resource = resource_class(con)
+    xml.sax.parseString(body, XmlHandler(resource, con))
+    resource.tags.update(tags)
+    return resource
+
+
+def iter_snapshots(con, filters=None, owner=None, page_size=1000):
+    '''
+    Yields snapshots page by page using NextToken pagination, so only
+    a single page is held in memory at a time
+    '''
+    from boto.ec2.snapshot import Snapshot
+    params = {'MaxResults': page_size}
+    if owner:
+        con.build_list_params(params, owner, 'Owner')
+    if filters:
+        con.build_filter_params(params, filters)
+    while True:
+        page = con.get_list('DescribeSnapshots', params,
+                            [('item', Snapshot)], verb='POST')
+        for snapshot in page:
+            yield snapshot
+        if not page.next_token:
+            break
+        params['NextToken'] = page.next_token
+
+
+def get_start_time_filter(first_day, last_day):
+    '''
+    The start-time filter matching the snapshots started from first_day
+    till last_day
+
+    EC2 only supports wildcards on start-time, so there is a pattern per
+    day
+    '''
+    return ['%s*' % (first_day + timedelta(days=d)).isoformat()
+            for d in range((last_day - first_day).days + 1)]
+
+
+def ensure_dir(path):
+    '''
+    Creates the directory of the file at path if it doesn't exist yet
+    '''
+    path_dir = os.path.dirname(path)
+    if path_dir and not os.path.isdir(path_dir):
+        os.makedirs(path_dir)
 
 
 def get_userdata_dict():
     from json import loads
-    from boto.utils import get_instance_userdata
-    userdata = loads(get_instance_userdata())
+    from snaptastic.metadata import get_instance_metadata
+    userdata = loads(get_instance_metadata().get_userdata())
     return userdata
 
 
+def get_metadata_dict():
+    from snaptastic.metadata import get_instance_metadata
+    return get_instance_metadata().get_metadata()
+
+
+# (service, region, access key, secret key) -> boto connection
+_connections = {}
+_connections_lock = threading.Lock()
+_connection_stats = defaultdict(int)
+
+
+def get_connection(service, connect):
+    '''
+    Returns the process wide connection to service, creating it with
+    connect(region, **credentials) the first time
+
+    boto connections keep their HTTP connections alive in a thread safe
+    pool, so sharing them saves the TLS handshakes and the credential
+    lookups of the snapshotters, the cleaner and check_backups.
+    '''
+    from snaptastic import settings
+    key = (service, settings.REGION, settings.AWS_ACCESS_KEY_ID,
+           settings.AWS_SECRET_ACCESS_KEY)
+    with _connections_lock:
+        con = _connections.get(key)
+        if con is None:
+            _connection_stats['%s_created' % service] += 1
+            con = connect(settings.REGION,
+                          aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                          aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
+            _connections[key] = con
+        else:
+            _connection_stats['%s_reused' % service] += 1
+    return con
+
+
+def get_connection_stats():
+    '''
+    Counts of created and reused connections per service, plus the number
+    of idle HTTP connections kept alive in their pools
+    '''
+    with _connections_lock:
+        stats = dict(_connection_stats)
+        for (service, region, _, _), con in _connections.items():
+            pool = getattr(con, '_pool', None)
+            if pool is not None:
+                stats['%s_idle_http' % service] = pool.size()
+    return stats
+
+
+def log_connection_stats():
+    '''
+    Logs the throttling and connection stats, if a connection was made
+    '''
+    with _connections_lock:
+        connections = _connections.values()
+    throttlers = set(getattr(con, 'throttler', None) for con in connections)
+    throttlers.discard(None)
+    for throttler in throttlers:
+        throttler.log_stats()
+    if connections:
+        logger.debug('connections: %s', get_connection_stats())
+
+
+def clear_connections():
+    with _connections_lock:
+        _connections.clear()
+        _connection_stats.clear()
+
+
 def get_ec2_conn():
     from snaptastic import settings
     from boto import ec2
-    ec2_conn = ec2.connect_to_region(settings.REGION,
-                                     aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                                     aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
-    return ec2_conn
+
+    def connect(region, **credentials):
+        ec2_conn = ec2.connect_to_region(region, **credentials)
+        if getattr(settings, 'EC2_THROTTLING', True):
+            from snaptastic.throttle import get_throttler
+            get_throttler().wrap(ec2_conn)
+        return ec2_conn
+    return get_connection('ec2', connect)
 
 
 def get_cloudwatch_conn():
-    from snaptastic import settings
     from boto.ec2 import cloudwatch
-    conn = cloudwatch.connect_to_region(settings.REGION,
-                                        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                                        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
-    return conn
+    return get_connection('cloudwatch', cloudwatch.connect_to_region)
 
 
 def is_root_dev(mount_point):
@@ -42,6 +225,38 @@ def is_root_dev(mount_point):
     return is_root_dev
 
 
+def syncfs(path):
+    '''
+    Flushes the dirty pages of the filesystem containing path, using
+    syncfs(2) and falling back to a full sync where it isn't available
+    '''
+    import ctypes
+    import ctypes.util
+    import subprocess
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'syncfs'):
+        subprocess.check_output(['sync'], stderr=subprocess.STDOUT)
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc.syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+    finally:
+        os.close(fd)
+
+
+def get_dirty_bytes():
+    '''
+    The amount of dirty page cache waiting to be written, system wide
+    '''
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('Dirty:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
 def setup_file_logging(LOGGING_CONFIG):
     '''
     Try to log to
@@ -55,12 +270,6 @@ def setup_file_logging(LOGGING_CONFIG):
     try:
         error_log_path = os.path.join('/var', 'log', 'snaptastic', 'error.log')
         log_path = os.path.join('/var', 'log', 'snaptastic', 'info.log')
-
-        def ensure_dir(path):
-            path_dir, filename = os.path.split(path)
-            if not os.path.isdir(path_dir):
-                os.makedirs(path_dir)
-
         ensure_dir(error_log_path)
         ensure_dir(log_path)
 
@@ -103,62 +312,132 @@ def age_to_seconds(age):
     return int(age[:-1]) * TIME_PERIODS[token]
 
 
-def check_backups(max_age, environment, cluster, role):
-    import dateutil.parser
-    import pytz
+def check_backups(max_age, environment, cluster, role, catalog=None):
+    '''
+    Returns the number of mount points of the (environment, cluster, role)
+    volumes without a snapshot younger than max_age seconds
+    '''
+    target = (environment, cluster, role)
+    missing = check_many_backups(max_age, [target], catalog=catalog)[target]
 
-    ec2 = get_ec2_conn()
-    now = datetime.utcnow().replace(tzinfo=pytz.utc)
+    if missing:
+        logger.warning("Some volumes are missing a recent snapshot \
+            (cluster={}, env={}, role={}):".format(cluster, environment, role))
+
+        for mp in missing:
+            logger.warning("\t* {} on volume(s) {}".format(
+                mp, ", ".join(missing[mp])))
+
+    return len(missing)
 
-    tag_filters = {
-        'tag:environment': environment,
-        'tag:cluster': cluster,
-        'tag:role': role,
-        'status': 'in-use',
-    }
 
-    vols = ec2.get_all_volumes(filters=tag_filters)
+def chunks(items, size):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
-    ids = []
-    mountpoints = defaultdict(list)
 
-    for vol in vols:
-        ids.append(vol.id)
-        mountpoints[vol.tags['mount_point']].append(vol.id)
+def check_many_backups(max_age, targets, catalog=None, chunk_size=100,
+                       workers=4):
+    '''
+    Checks the backups of many (environment, cluster, role) targets at once
+
+    The volumes and snapshots of all targets are fetched with chunked,
+    concurrent queries and joined in memory.
 
-    # filter snapshots with 1 day resolution
-    limit = (datetime.now() - timedelta(days=(max_age - 1) // (24 * 3600)))
+    :returns: dict of target -> {mount point: volume ids} for the mount
+        points without a snapshot younger than max_age seconds
+    '''
+    import dateutil.parser
+    import pytz
+    from snaptastic.catalog import get_snapshot_catalog
+    from snaptastic.utils.concurrency import map_concurrently
 
-    snaps = ec2.get_all_snapshots(
-        filters={
-            'volume_id': ids,
-            'start-time': "{}*".format(limit.date().isoformat())
+    ec2 = get_ec2_conn()
+    if catalog is None:
+        catalog = get_snapshot_catalog(ec2)
+    now = datetime.utcnow().replace(tzinfo=pytz.utc)
+    targets = set(targets)
+
+    def get_tag_filters(target_chunk):
+        environments, clusters, roles = zip(*target_chunk)
+        return {
+            'tag:environment': sorted(set(environments)),
+            'tag:cluster': sorted(set(clusters)),
+            'tag:role': sorted(set(roles)),
         }
-    )
-    dones = {}
-    for snap in snaps:
-        mp = snap.tags['mount_point']
-        start_time = dateutil.parser.parse(snap.start_time)
 
+    def run_chunks(function, items):
+        results = []
+        outcomes = map_concurrently(function, chunks(items, chunk_size),
+                                    workers)
+        for result, error in outcomes:
+            if error is not None:
+                raise error
+            results.extend(result)
+        return results
+
+    def get_volumes(target_chunk):
+        filters = get_tag_filters(target_chunk)
+        filters['status'] = 'in-use'
+        return ec2.get_all_volumes(filters=filters)
+
+    # the filters match every combination of the tags, so chunks can
+    # overlap and return volumes of other targets
+    # target -> mount point -> volume ids
+    mountpoints = dict((target, defaultdict(list)) for target in targets)
+    volume_mountpoints = {}
+    for vol in run_chunks(get_volumes, sorted(targets)):
+        target = tuple(vol.tags.get(k)
+                       for k in ('environment', 'cluster', 'role'))
+        if vol.id in volume_mountpoints:
+            continue
+        if target in targets and 'mount_point' in vol.tags:
+            mountpoints[target][vol.tags['mount_point']].append(vol.id)
+            volume_mountpoints[vol.id] = (target, vol.tags['mount_point'])
+
+    # snapshots started from the day of the oldest acceptable snapshot
+    first_day = (now - timedelta(seconds=max_age)).date()
+    start_times = get_start_time_filter(first_day, now.date())
+
+    if catalog:
+        snaps = [s for s in run_chunks(
+            lambda target_chunk: catalog.get_snapshots(
+                get_tag_filters(target_chunk)), sorted(targets))
+            if s.start_time >= first_day.isoformat()]
+    else:
+        snaps = run_chunks(lambda volume_ids: ec2.get_all_snapshots(
+            filters={
+                'volume-id': volume_ids,
+                'start-time': start_times,
+            }), sorted(volume_mountpoints))
+
+    for snap in snaps:
+        if snap.volume_id not in volume_mountpoints:
+            continue
         # do a finer grain age check in python
+        start_time = dateutil.parser.parse(snap.start_time)
         if (now - start_time) > timedelta(seconds=max_age):
             continue
+        target, mp = volume_mountpoints[snap.volume_id]
+        mountpoints[target].pop(mp, None)
 
-        logger.info("Checking mountpoint {}".format(mp))
-
-        # pop any accounted for mountpoints
-        if snap.volume_id in mountpoints[mp]:
-            dones[mp] = mountpoints.pop(mp)
-        else:
-            if mp in dones:
-                mountpoints.pop(mp)
+    return dict((target, dict(missing))
+                for target, missing in mountpoints.items())
 
-    if len(mountpoints.keys()) > 0:
-        logger.warning("Some volumes are missing a recent snapshot \
-            (cluster={}, env={}, role={}):".format(cluster, environment, role))
 
-        for mp in mountpoints:
-            logger.warning("\t* {} on volume(s) {}".format(
-                mp, ", ".join(mountpoints[mp])))
-
-    return len(mountpoints.keys())
+def read_backup_targets(lines):
+    '''
+    Parses "environment cluster role" lines, separated by whitespace or
+    commas; blank lines and # comments are skipped
+    '''
+    targets = []
+    for line in lines:
+        line = line.split('#', 1)[0].replace(',', ' ').strip()
+        if not line:
+            continue
+        fields = line.split()
+        if len(fields) != 3:
+            raise ValueError(
+                'expected environment, cluster and role, got %r' % line)
+        targets.append(tuple(fields))
+    return targets
@@ -0,0 +1,202 @@
+import logging
+import sys
+import threading
+import time
+import Queue
+
+from snaptastic import exceptions
+
+
+logger = logging.getLogger(__name__)
+
+
+def map_concurrently(function, items, workers=1):
+    '''
+    Calls function for every item, using at most workers threads
+
+    Returns a list of (result, exception) tuples in the order of items.
+    Exceptions are collected per item instead of aborting the others.
+    '''
+    return map_with_dependencies(function, items, {}, workers)
+
+
+def call(function, item):
+    '''
+    Returns the (result, exception) of calling function with item
+    '''
+    try:
+        return (function(item), None)
+    except Exception, e:
+        logger.exception('error while processing %s', item)
+        return (None, e)
+
+
+def imap_concurrently(function, items, workers=1, buffer_size=None):
+    '''
+    Like map_concurrently, but reads items lazily and yields
+    (item, (result, exception)) tuples as the calls finish
+
+    At most buffer_size items are read ahead of the workers, so long
+    iterators (eg. pages of an API listing) are processed with bounded
+    memory while they are still being fetched. If reading the items
+    raises, the calls already started still finish and are yielded
+    before the error is raised.
+    '''
+    if workers <= 1:
+        for item in items:
+            yield item, call(function, item)
+        return
+    stop = object()
+    tasks = Queue.Queue(buffer_size or workers * 2)
+    finished = Queue.Queue()
+
+    def worker():
+        while True:
+            item = tasks.get()
+            if item is stop:
+                return
+            finished.put((item, call(function, item)))
+
+    threads = []
+    for _ in range(workers):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    pending = 0
+    error = None
+    try:
+        for item in items:
+            tasks.put(item)
+            pending += 1
+            while not finished.empty():
+                yield finished.get()
+                pending -= 1
+    except Exception:
+        error = sys.exc_info()
+    finally:
+        for thread in threads:
+            tasks.put(stop)
+    while pending:
+        yield finished.get()
+        pending -= 1
+    for thread in threads:
+        thread.join()
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+
+def map_with_dependencies(function, items, dependencies, workers=1):
+    '''
+    Like map_concurrently, but an item only starts after the items it
+    depends on have finished
+
+    dependencies maps the index of an item to the indexes of the items it
+    has to wait for. Items whose dependencies failed are not started and
+    get a DependencyFailure as their exception.
+    '''
+    items = list(items)
+    outcomes = [None] * len(items)
+    pending = range(len(items))
+    finished = set()
+    failed = set()
+    running = []
+    condition = threading.Condition()
+
+    def next_item():
+        # called with the condition held, returns None if nothing is ready
+        for index in pending:
+            blockers = dependencies.get(index, ())
+            failed_blockers = [b for b in blockers if b in failed]
+            if failed_blockers:
+                error_format = '%s depends on %s, which failed'
+                error = exceptions.DependencyFailure(error_format % (
+                    items[index], items[failed_blockers[0]]))
+                pending.remove(index)
+                finish(index, (None, error))
+                return next_item()
+            if all(b in finished for b in blockers):
+                pending.remove(index)
+                running.append(index)
+                return index
+        if pending and not running:
+            # nothing runs and nothing can start, the dependencies are cyclic
+            index = pending.pop(0)
+            error_format = '%s has cyclic or unknown dependencies'
+            error = exceptions.DependencyFailure(error_format % items[index])
+            finish(index, (None, error))
+            return next_item()
+
+    def finish(index, outcome):
+        outcomes[index] = outcome
+        finished.add(index)
+        if outcome[1] is not None:
+            failed.add(index)
+        condition.notify_all()
+
+    def run(index):
+        return call(function, items[index])
+
+    def worker():
+        while True:
+            with condition:
+                index = next_item()
+                while index is None:
+                    if not pending:
+                        return
+                    condition.wait()
+                    index = next_item()
+            outcome = run(index)
+            with condition:
+                running.remove(index)
+                finish(index, outcome)
+
+    if workers <= 1 or len(items) <= 1:
+        worker()
+        return outcomes
+
+    threads = []
+    for _ in range(min(workers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+class TokenBucket(object):
+    '''
+    Limits the rate of something to rate tokens per second, allowing
+    bursts of up to capacity tokens. Thread safe.
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        # called with the lock held
+        now = time.time()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        '''
+        Blocks till the tokens are available, returns the seconds waited
+        '''
+        tokens = min(tokens, self.capacity)
+        waited = 0
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
@@ -0,0 +1,193 @@
+import logging
+import random
+import threading
+import time
+
+from snaptastic import exceptions
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceWaiter(object):
+    '''
+    Waits for EC2 resources to reach a given state
+
+    All resources being waited on are polled together, with a single
+    describe call per tick. The delay between ticks grows exponentially
+    (with jitter), a new resource cuts it short and resets it.
+    The waiter is thread safe, so concurrent mounts can share it.
+
+    Ids which the describe call rejects as not found (deleted, or not
+    visible yet) are split off and described one by one, so they don't
+    fail the batch of the other resources.
+
+    :param describe: function returning the resources of a list of ids
+    :param resource_name: what is waited for, used in the logs
+    '''
+    MIN_DELAY = 1
+    MAX_DELAY = 10
+    BACKOFF = 2
+    NOT_FOUND_ERRORS = ('InvalidVolume.NotFound', 'InvalidSnapshot.NotFound')
+
+    def __init__(self, describe, resource_name='resource'):
+        self.describe = describe
+        self.resource_name = resource_name
+        self.condition = threading.Condition()
+        # resource id -> number of threads waiting for it
+        self.waiting = {}
+        # resource id -> (tick, resource) of the last observation
+        self.observed = {}
+        self.tick = 0
+        self.poller = None
+        self.reset_delay = False
+        # ids which were not found, described separately
+        self.missing = set()
+
+    def has_state(self, resource, state):
+        return resource.status == state
+
+    def get_delay(self, delay):
+        '''
+        Equal jitter, sleeps between half and the full delay
+        '''
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def wait(self, resource_id, state, timeout=45):
+        '''
+        Blocks till the resource reaches state and returns it
+
+        Only observations made after calling wait count, so a stale status
+        from an earlier tick is never mistaken for the new state.
+        '''
+        deadline = time.time() + timeout
+        with self.condition:
+            registered_tick = self.tick
+            self.waiting[resource_id] = self.waiting.get(resource_id, 0) + 1
+            self.reset_delay = True
+            self.ensure_poller()
+            # wakes the poller if it is backed off
+            self.condition.notify_all()
+            try:
+                while True:
+                    tick, resource = self.observed.get(
+                        resource_id, (0, None))
+                    if tick > registered_tick and self.has_state(resource, state):
+                        return resource
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        error_format = '%s %s didnt become %s within %s seconds'
+                        raise exceptions.WaitTimeout(error_format % (
+                            self.resource_name, resource_id, state, timeout))
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting[resource_id] -= 1
+                if not self.waiting[resource_id]:
+                    del self.waiting[resource_id]
+                    self.observed.pop(resource_id, None)
+
+    def ensure_poller(self):
+        # called with the condition held
+        if self.poller is None:
+            self.poller = threading.Thread(target=self.poll)
+            self.poller.daemon = True
+            self.poller.start()
+
+    def poll(self):
+        delay = self.MIN_DELAY
+        while True:
+            with self.condition:
+                resource_ids = sorted(self.waiting)
+                if not resource_ids:
+                    self.poller = None
+                    return
+                if self.reset_delay:
+                    delay = self.MIN_DELAY
+                    self.reset_delay = False
+            logger.info('polling the status of %s %ss',
+                        len(resource_ids), self.resource_name)
+            resources = self.describe_batch(resource_ids)
+            with self.condition:
+                self.tick += 1
+                for resource in resources:
+                    if resource.id in self.waiting:
+                        self.observed[resource.id] = (self.tick, resource)
+                self.condition.notify_all()
+                self.pause(self.get_delay(delay))
+            delay = min(delay * self.BACKOFF, self.MAX_DELAY)
+
+    def pause(self, delay):
+        '''
+        Waits delay seconds between ticks, or till a new resource is added
+        '''
+        # called with the condition held
+        deadline = time.time() + delay
+        while not self.reset_delay:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            self.condition.wait(remaining)
+
+    def is_not_found(self, error):
+        return getattr(error, 'error_code', None) in self.NOT_FOUND_ERRORS
+
+    def describe_batch(self, resource_ids):
+        '''
+        Describes the resources, the known ones with a single call and the
+        missing ones one by one
+        '''
+        missing = [r for r in resource_ids if r in self.missing]
+        known = [r for r in resource_ids if r not in self.missing]
+        resources = []
+        if known:
+            try:
+                resources = list(self.describe(known))
+            except Exception, e:
+                if not self.is_not_found(e):
+                    logger.warn('failed to describe %s: %s', known, e)
+                    return []
+                # find the ids which failed the batch
+                missing += known
+        for resource_id in missing:
+            try:
+                resources += self.describe([resource_id])
+            except Exception, e:
+                if not self.is_not_found(e):
+                    logger.warn('failed to describe %s: %s', resource_id, e)
+                    continue
+                # eventual consistency, new resources can be unknown for a bit
+                logger.info('%s %s was not found', self.resource_name,
+                            resource_id)
+                self.missing.add(resource_id)
+            else:
+                self.missing.discard(resource_id)
+        return resources
+
+
+class VolumeWaiter(ResourceWaiter):
+    '''
+    Waits for volumes to become available, in-use or detached
+    '''
+    def __init__(self, connection):
+        def describe(volume_ids):
+            return connection.get_all_volumes(volume_ids=volume_ids)
+        super(VolumeWaiter, self).__init__(describe, 'volume')
+
+    def has_state(self, volume, state):
+        if state == 'detached':
+            attach_data = getattr(volume, 'attach_data', None)
+            attached = attach_data is not None and attach_data.status
+            return volume.status == 'available' and not attached
+        return volume.status == state
+
+
+class SnapshotWaiter(ResourceWaiter):
+    '''
+    Waits for snapshots to complete
+    '''
+    MAX_DELAY = 30
+
+    def __init__(self, connection):
+        def describe(snapshot_ids):
+            return connection.get_all_snapshots(snapshot_ids=snapshot_ids)
+        super(SnapshotWaiter, self).__init__(describe, 'snapshot')